@@ -1,6 +1,8 @@
 import pandas as pd
 from google.cloud import bigquery
 import os
+from cms_rollups import ROLLUPS
+from materialized_views import refresh_materialized_views
 
 # Define absolute paths to the CSV files
 base_dir = 'E:/HealthCare Project/data/transformed/'
@@ -15,6 +17,10 @@ if not os.path.exists(encounters_file):
     raise FileNotFoundError(f"File not found: {encounters_file}")
 if not os.path.exists(cms_file):
     raise FileNotFoundError(f"File not found: {cms_file}")
+rollup_files = {name: os.path.join(base_dir, f'{name}.csv') for name in ROLLUPS}
+for rollup_file in rollup_files.values():
+    if not os.path.exists(rollup_file):
+        raise FileNotFoundError(f"File not found: {rollup_file}")
 
 # Read CSV files
 patients_data = pd.read_csv(patients_file)
@@ -28,6 +34,9 @@ tables = {
     'encounters_data': encounters_data,
     'cms_data': cms_data,
 }
+# CMS rollup cubes queried by the dashboard instead of the full cms_data table
+for rollup_name, rollup_file in rollup_files.items():
+    tables[rollup_name] = pd.read_csv(rollup_file)
 
 client = bigquery.Client()
 dataset_ref = client.dataset(dataset_id)
@@ -52,4 +61,8 @@ for table_name, df in tables.items():
     )
     job = client.load_table_from_dataframe(df, table_ref, job_config=job_config)
     job.result()  
-    print(f"Table {table_name} Created and Data Uploaded.")
\ No newline at end of file
+    print(f"Table {table_name} Created and Data Uploaded.")
+
+# Rebuild the materialized views over the freshly uploaded tables
+refreshed = refresh_materialized_views(client, dataset_id, tables.keys())
+print(f"{refreshed} Materialized Views Refreshed.")
\ No newline at end of file
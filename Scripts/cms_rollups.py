@@ -0,0 +1,93 @@
+import pandas as pd
+
+# Rollup cubes over cms_data, declared smallest first so routing picks the
+# cheapest cube that can answer a query. Facility Name and State depend on
+# Facility ID, so the facility cube can also group/filter on them.
+ROLLUPS = {
+    "cms_rollup_measure": ["Measure Name"],
+    "cms_rollup_state_measure": ["State", "Measure Name"],
+    "cms_rollup_facility": ["Facility ID", "Facility Name", "State"],
+}
+
+# SQL re-aggregation of each rollup measure, per chart aggregate ("sum" for
+# pie slices, "mean" for grouped line charts). Means are plain per-row means,
+# the same statistic the charts compute from the loaded rows.
+ROLLUP_METRICS = {
+    "Number of Discharges": {
+        "sum": "SUM(`Number of Discharges`)",
+        "mean": "SAFE_DIVIDE(SUM(`Number of Discharges`), SUM(`Record Count`))",
+    },
+    "Number of Readmissions": {
+        "sum": "SUM(`Number of Readmissions`)",
+        "mean": "SAFE_DIVIDE(SUM(`Number of Readmissions`), SUM(`Record Count`))",
+    },
+    "Excess Readmission Ratio": {
+        "mean": "SAFE_DIVIDE(SUM(`ERR Sum`), SUM(`Record Count`))",
+    },
+}
+
+
+# Build every rollup cube from the cleaned cms_data frame
+def build_rollups(cms_data):
+    data = cms_data.copy()
+    for col in ("Number of Discharges", "Number of Readmissions", "Excess Readmission Ratio"):
+        data[col] = pd.to_numeric(data[col], errors='coerce').fillna(0)
+
+    rollups = {}
+    for rollup_name, dims in ROLLUPS.items():
+        cube = data.groupby(dims).agg(**{
+            "Number of Discharges": ("Number of Discharges", "sum"),
+            "Number of Readmissions": ("Number of Readmissions", "sum"),
+            "ERR Sum": ("Excess Readmission Ratio", "sum"),
+            "Record Count": ("Measure Name", "size"),
+        }).reset_index()
+        cube["Excess Readmission Ratio"] = cube["ERR Sum"] / cube["Record Count"]
+        rollups[rollup_name] = cube
+    return rollups
+
+
+# Return the CREATE OR REPLACE statements rebuilding every rollup cube from the
+# cms_data table, the SQL counterpart of build_rollups for admin writes
+def rollup_definitions(dataset_id):
+    numeric = {
+        col: f"IFNULL(SAFE_CAST(`{col}` AS FLOAT64), 0)"
+        for col in ("Number of Discharges", "Number of Readmissions", "Excess Readmission Ratio")
+    }
+    statements = []
+    for rollup_name, dims in ROLLUPS.items():
+        dim_list = ", ".join(f"`{dim}`" for dim in dims)
+        statements.append(
+            f"CREATE OR REPLACE TABLE `{dataset_id}.{rollup_name}` AS "
+            f"SELECT {dim_list}, "
+            f"SUM({numeric['Number of Discharges']}) AS `Number of Discharges`, "
+            f"SUM({numeric['Number of Readmissions']}) AS `Number of Readmissions`, "
+            f"SUM({numeric['Excess Readmission Ratio']}) AS `ERR Sum`, "
+            f"COUNT(*) AS `Record Count`, "
+            f"AVG({numeric['Excess Readmission Ratio']}) AS `Excess Readmission Ratio` "
+            f"FROM `{dataset_id}.cms_data` GROUP BY {dim_list}"
+        )
+    return statements
+
+
+# Return the smallest rollup holding every grouped and filtered column
+def route_rollup(group_cols, filter_cols=()):
+    needed = set(group_cols) | set(filter_cols)
+    for rollup_name, dims in ROLLUPS.items():
+        if needed <= set(dims):
+            return rollup_name
+    return None
+
+
+# Build the query answering a grouped chart from a rollup, or None when no
+# rollup can answer it and the caller should aggregate the base table
+def rollup_chart_query(dataset_id, group_col, metric, agg, filter_cols=(), where_conditions=()):
+    expression = ROLLUP_METRICS.get(metric, {}).get(agg)
+    rollup_name = route_rollup([group_col], filter_cols)
+    if expression is None or rollup_name is None:
+        return None
+
+    query = f"SELECT `{group_col}`, {expression} AS `{metric}` FROM `{dataset_id}.{rollup_name}`"
+    if where_conditions:
+        query += " WHERE " + " AND ".join(where_conditions)
+    query += f" GROUP BY `{group_col}`"
+    return query
@@ -1,4 +1,5 @@
 import pandas as pd
+from cms_rollups import build_rollups
 
 patients = pd.read_csv('data/synthea/patients.csv')
 encounters = pd.read_csv('data/synthea/encounters.csv')
@@ -44,4 +45,6 @@ provider_productivity.to_csv('data/transformed/provider_productivity.csv', index
 appointment_analytics.to_csv('data/transformed/appointment_analytics.csv', index=False)
 cms_data.to_csv('data/transformed/cms_data.csv', index=False)
 readmission_rates.to_csv('data/transformed/readmission_rates.csv', index=False)
+for rollup_name, rollup in build_rollups(cms_data).items():
+    rollup.to_csv(f'data/transformed/{rollup_name}.csv', index=False)
 print("Columns in provider_productivity table:", provider_productivity.columns.tolist())
\ No newline at end of file
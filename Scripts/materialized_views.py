@@ -0,0 +1,153 @@
+import logging
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Number of rows kept by each top-N view, the Bar Chart shows the top 10
+TOP_N_LIMIT = 10
+
+# Seconds to wait after the last write to a table before refreshing its views,
+# so a burst of admin edits triggers a single refresh job
+REFRESH_DELAY_SECONDS = 30
+
+# Materialized aggregates declared per base table. "top_n" keeps the
+# TOP_N_LIMIT highest rows for each metric, "group_by" keeps the per-value
+# SUM and COUNT of every top_n metric for each categorical column.
+MATERIALIZED_VIEWS = {
+    "provider_productivity": {
+        "top_n": ["encounter_count"],
+        "group_by": [],
+    },
+    "appointment_analytics": {
+        "top_n": ["avg_days_between_appointments"],
+        "group_by": [],
+    },
+    "cms_data": {
+        "top_n": [
+            "Number of Discharges",
+            "Excess Readmission Ratio",
+            "Predicted Readmission Rate",
+            "Expected Readmission Rate",
+        ],
+        "group_by": ["State", "Measure Name", "Start Date", "End Date"],
+    },
+}
+
+
+def _slug(column):
+    return re.sub(r'\W+', '_', column).strip('_').lower()
+
+
+def top_n_view_name(table_name, metric):
+    return f"mv_{table_name}_top_{_slug(metric)}"
+
+
+def group_by_view_name(table_name, group_col):
+    return f"mv_{table_name}_by_{_slug(group_col)}"
+
+
+# Return the CREATE OR REPLACE statements for every view of the given tables
+def view_definitions(dataset_id, table_names=None):
+    statements = []
+    for table_name, views in MATERIALIZED_VIEWS.items():
+        if table_names is not None and table_name not in table_names:
+            continue
+        source = f"`{dataset_id}.{table_name}`"
+        for metric in views["top_n"]:
+            statements.append(
+                f"CREATE OR REPLACE TABLE `{dataset_id}.{top_n_view_name(table_name, metric)}` AS "
+                f"SELECT * FROM {source} ORDER BY `{metric}` DESC LIMIT {TOP_N_LIMIT}"
+            )
+        for group_col in views["group_by"]:
+            aggregates = ", ".join(
+                f"SUM(`{metric}`) AS `{metric} Sum`, COUNT(`{metric}`) AS `{metric} Count`"
+                for metric in views["top_n"]
+            )
+            statements.append(
+                f"CREATE OR REPLACE TABLE `{dataset_id}.{group_by_view_name(table_name, group_col)}` AS "
+                f"SELECT `{group_col}`, {aggregates} FROM {source} GROUP BY `{group_col}`"
+            )
+    return statements
+
+
+# Refresh hook, rebuilds the views of the given tables (all when None) in a
+# single multi-statement job. Run it after every upload or write to a base table.
+def refresh_materialized_views(client, dataset_id, table_names=None):
+    statements = view_definitions(dataset_id, table_names)
+    if not statements:
+        return 0
+    logger.info(f"Refreshing {len(statements)} materialized views")
+    client.query(";\n".join(statements)).result()
+    return len(statements)
+
+
+# Debounced background refresh of the views of written tables. Tables stay
+# stale from their first write until a refresh covering it succeeds, so callers
+# can route their queries to the base table in the meantime.
+class ViewRefresher:
+    def __init__(self, refresh, delay=REFRESH_DELAY_SECONDS):
+        self._refresh = refresh  # Called with the set of table names to refresh
+        self._delay = delay
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._stale = set()
+        self._timer = None
+
+    # Schedule a refresh of a table's views, restarting the delay
+    def schedule(self, table_name):
+        with self._lock:
+            self._pending.add(table_name)
+            self._stale.add(table_name)
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self._delay, self._run)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def is_stale(self, table_name):
+        with self._lock:
+            return table_name in self._stale
+
+    def _run(self):
+        with self._lock:
+            table_names, self._pending = self._pending, set()
+            self._timer = None
+        try:
+            self._refresh(table_names)
+        except Exception as e:
+            # The tables stay stale until a later write schedules another refresh
+            logger.error(f"Background view refresh failed: {e}")
+            return
+        with self._lock:
+            # Tables written again during the refresh wait for the next one
+            self._stale -= table_names - self._pending
+
+
+# Rewrite a "top rows by metric" request to its top-N view. Filtered requests
+# and requests beyond the stored limit need the base table, so return None.
+def rewrite_top_n_query(dataset_id, table_name, index_col, metric, where_conditions=(), limit=TOP_N_LIMIT):
+    views = MATERIALIZED_VIEWS.get(table_name)
+    if views is None or metric not in views["top_n"] or where_conditions or limit > TOP_N_LIMIT:
+        return None
+    return (
+        f"SELECT `{index_col}`, `{metric}` FROM `{dataset_id}.{top_n_view_name(table_name, metric)}` "
+        f"ORDER BY `{metric}` DESC LIMIT {limit}"
+    )
+
+
+# Rewrite a per-category aggregate ("sum" or "mean") to its group-by view. The
+# view can only apply filters on its own grouping column.
+def rewrite_group_by_query(dataset_id, table_name, group_col, metric, agg, filter_columns=(), where_conditions=()):
+    views = MATERIALIZED_VIEWS.get(table_name)
+    if (views is None or group_col not in views["group_by"] or metric not in views["top_n"]
+            or agg not in ("sum", "mean") or set(filter_columns) - {group_col}):
+        return None
+    if agg == "sum":
+        expression = f"`{metric} Sum`"
+    else:
+        expression = f"SAFE_DIVIDE(`{metric} Sum`, `{metric} Count`)"
+    query = f"SELECT `{group_col}`, {expression} AS `{metric}` FROM `{dataset_id}.{group_by_view_name(table_name, group_col)}`"
+    if where_conditions:
+        query += " WHERE " + " AND ".join(where_conditions)
+    return query
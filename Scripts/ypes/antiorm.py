@@ -77,6 +77,23 @@ The simplest version is simply accessing everything::
   for obj in TestTable.select(connection):
       # Access obj.id, obj.username and more.
 
+To go through a large result set without loading it in memory, stream it; this
+fetches the rows in batches, on a server-side cursor if you ask for one and the
+driver supports them (e.g. psycopg2)::
+
+  for obj in TestTable.select_stream(connection, batchsize=5000, named=True):
+      # Access obj.id, obj.username and more.
+
+Many rows can be inserted at once, as multi-row VALUES lists (or with COPY
+where the driver supports it, e.g. psycopg2), and the generated keys returned::
+
+  objs = TestTable.insert_many(connection,
+                               [{'firstname': u'Adriana'},
+                                {'firstname': u'Manuel'}],
+                               returning=('id',))
+
+upsert_many() does the same but updates the rows that conflict on a key.
+
 Update (U)
 ----------
 Update statements are provided as well::
@@ -93,6 +110,36 @@ Deleting rows can be done similarly::
   TestTable.delete('WHERE id = %s', (1,))
 
 
+Caching
+-------
+
+Tables that are read much more often than they are written (e.g. reference
+data) can cache the objects that get() fetches, by setting 'cacheable' on the
+table::
+
+  class Payers(MormTable):
+      table = 'payers'
+      cacheable = True
+
+The objects are then kept in two places.  The first is an identity map per
+transaction, so that the same get() in the same transaction returns the same
+object.  The second is a cache shared by the process, which keeps the rows,
+up to 'cache_size' of them per table.  Both keep their entries for at most
+'cache_ttl' seconds.  Inserts, updates and deletes done through any MormTable
+of the same table clear both, and clear the shared cache again when their
+transaction ends, since other connections may have cached the rows they
+changed meanwhile.  The connection that wrote to the table stops using the
+shared cache until the end of its transaction, so that it does not share rows
+that are not committed.  Changes made by other processes, or with
+execute() or your own queries, are only picked up when the rows expire; call
+invalidate() after them.
+
+The end of a transaction is noticed when the connection reports that it is
+idle (as sqlite3 and psycopg2 connections do), or when an antipool connection
+is committed, rolled back or released.  With other connections, call
+MormTable.end_transaction() after committing or rolling back.
+
+
 Lower-Level APIs
 ----------------
 
@@ -108,7 +155,29 @@ See doc/ in distribution for additional notes.
 __author__ = 'Martin Blais <blais@furius.ca>'
 
 
-__all__ = ['MormTable', 'MormObject', 'MormError',
+import binascii, itertools, keyword, re, threading, weakref
+from collections import OrderedDict
+
+# Cache entries expire on a monotonic clock when there is one (3.3+).
+try:
+    from time import monotonic as _clock
+except ImportError:
+    from time import time as _clock
+
+# The first module is Python 2.x, the second is 3.x.
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# Binary values: bytes is str in Python 2.x, where drivers use buffers.
+try:
+    _binary_types = (bytearray, buffer)
+except NameError:
+    _binary_types = (bytes, bytearray, memoryview)
+
+
+__all__ = ['MormTable', 'MormObject', 'MormRow', 'MormError', 'MormCache',
            'MormConv', 'MormConvUnicode', 'MormConvString',
            'MormDecoder', 'MormEncoder']
 
@@ -120,6 +189,13 @@ class NODEF(object):
     """
 
 
+_def_batchsize = 1000
+"Number of rows fetched at a time when iterating over the results."
+
+_cursor_names = itertools.count(1)
+"Counter for naming the server-side cursors uniquely."
+
+
 
 class MormObject(object):
     """
@@ -128,6 +204,26 @@ class MormObject(object):
     """
 
 
+class MormRow(MormObject):
+    """
+    Base class of the row classes that the decoders generate for each set of
+    columns, with a slot per column.  Instances still accept other attributes,
+    and are pickled as plain MormObject instances.
+    """
+    __slots__ = ()
+
+    def __reduce__(self):
+        state = dict((name, getattr(self, name))
+                     for name in self.__slots__ if hasattr(self, name))
+        state.update(getattr(self, '__dict__', {}))
+        return (_restore_object, (state,))
+
+def _restore_object(state):
+    obj = MormObject()
+    obj.__dict__.update(state)
+    return obj
+
+
 class MormTable(object):
     """
     Class for declarations that relate to a table.
@@ -151,6 +247,15 @@ class MormTable(object):
     converters = {}
     "Custom converter map for columns"
 
+    cacheable = False
+    "Whether get() caches the objects, see the Caching section above."
+
+    cache_ttl = 300
+    "Number of seconds the results of get() are kept in the caches."
+
+    cache_size = 1000
+    "Maximum number of rows of this table kept in the shared cache."
+
     #---------------------------------------------------------------------------
     # Misc methods.
 
@@ -182,16 +287,35 @@ class MormTable(object):
     @classmethod
     def count(cls, conn, cond=None, args=None, distinct=None):
         """
-        Counts the number of selected rows.
+        Counts the number of selected rows.  The counting is done by the server,
+        which only returns the count.
         """
         assert conn is not None
 
-        # Perform the select.
-        cursor = MormDecoder.do_select(conn, (cls,), ('1',),
-                                       cond, args, distinct)
+        # Wrap the select, so that any ORDER BY or LIMIT in the condition
+        # still applies.
+        sql = MormDecoder.select_sql((cls,), distinct and ('*',) or ('1',),
+                                     cond, distinct)
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM (%s) AS morm_count" % sql,
+                       _condargs(args))
+        count = cursor.fetchone()[0]
+        cursor.close()
+        return count
+
+    @classmethod
+    def exists(cls, conn, cond=None, args=None):
+        """
+        Returns true if the condition selects at least one row.
+        """
+        assert conn is not None
 
-        # Return the number of matches.
-        return cursor.rowcount
+        sql = MormDecoder.select_sql((cls,), ('1',), cond)
+        cursor = conn.cursor()
+        cursor.execute("SELECT EXISTS (%s)" % sql, _condargs(args))
+        exists = cursor.fetchone()[0]
+        cursor.close()
+        return bool(exists)
 
     @classmethod
     def select(cls, conn, cond=None, args=None, cols=None,
@@ -235,6 +359,54 @@ class MormTable(object):
 
         return objects
 
+    @classmethod
+    def select_stream(cls, conn, cond=None, args=None, cols=None,
+                      objcls=None, distinct=None, batchsize=None,
+                      batches=False, named=False):
+        """
+        Convenience method that executes a select and generates the results,
+        wrapped in objects with attributes, without holding them all in memory.
+        The rows are fetched 'batchsize' at a time.  If 'named' is true, they
+        are fetched from a server-side (named) cursor, a psycopg2-style
+        extension that the driver must support, so that the server does not
+        send the whole result set at once.  If 'batches' is true, lists of
+        objects are generated, one per fetch.
+
+        Note: named cursors only live within a transaction, so the connection
+        must not be committed while you iterate.
+        """
+        assert conn is not None
+        if batchsize is None:
+            batchsize = _def_batchsize
+
+        if named:
+            cursor = conn.cursor('morm_%s_%d' % (cls.tname(),
+                                                 next(_cursor_names)))
+        else:
+            cursor = conn.cursor()
+
+        try:
+            # Perform the select.
+            MormDecoder.do_select(conn, (cls,), cols, cond, args, distinct,
+                                  cursor=cursor)
+
+            dec = None
+            while True:
+                rows = cursor.fetchmany(batchsize)
+                if not rows:
+                    break
+                # Named cursors may only describe the results once fetched.
+                if dec is None:
+                    dec = MormDecoder(cls, cursor)
+                objects = [dec.decode(row, objcls=objcls) for row in rows]
+                if batches:
+                    yield objects
+                else:
+                    for obj in objects:
+                        yield obj
+        finally:
+            cursor.close()
+
     @classmethod
     def select_one(cls, conn, cond=None, args=None, cols=None,
                    objcls=None, distinct=None):
@@ -242,14 +414,12 @@ class MormTable(object):
         Convenience method that executes a select the first object that matches,
         and that also checks that there is a single object that matches.
         """
-        it = cls.select(conn, cond, args, cols, objcls, distinct)
-        if len(it) > 1:
+        objects = cls.select_first(conn, 2, cond, args, cols, objcls, distinct)
+        if len(objects) > 1:
             raise MormError("select_one() matches more than one row.")
-        try:
-            o = it.next()
-        except StopIteration:
-            o = None
-        return o
+        if objects:
+            return objects[0]
+        return None
 
     @classmethod
     def get(cls, conn, cols=None, default=NODEF, **constraints):
@@ -262,16 +432,149 @@ class MormTable(object):
             args.append(colvalue)
 
         cond = 'WHERE ' + ' AND '.join(cons)
-        it = cls.select(conn, cond, args, cols)
-        try:
-            if len(it) == 0:
+        if cls.cacheable:
+            key = (cls, cols and tuple(cols),
+                   tuple(sorted(constraints.items())))
+            try:
+                hash(key)
+            except TypeError:
+                pass
+            else:
+                return cls._get_cached(conn, key, cond, args, cols, default,
+                                       constraints)
+
+        objects = cls.select_first(conn, 1, cond, args, cols)
+        if not objects:
+            if default is NODEF:
+                raise MormError("Object not found (%s)." % str(constraints))
+            else:
+                return default
+        return objects[0]
+
+    @classmethod
+    def _get_cached(cls, conn, key, cond, args, cols, default, constraints):
+        """
+        Guts of get() for cacheable tables.
+        """
+        tname = cls.tname()
+        local = _connection_cache(conn)
+        if local is not None:
+            objects = local.objects.setdefault(tname, {})
+            entry = objects.get(key)
+            if entry is not None:
+                if entry[0] > _clock():
+                    return entry[1]
+                del objects[key]
+
+        # The shared cache holds the rows, so that each connection decodes its
+        # own objects.  Connections whose writes cannot be tracked only read it.
+        if _writers:
+            _end_writes()
+        shared = local is not None and tname not in local.written
+        cache = _table_cache(tname, cls)
+        entry = (local is None or shared) and cache.get(key)
+        if entry:
+            dec, row = entry
+        else:
+            # Rows read while the cache gets cleared may predate the write.
+            generation = cache.generation
+            cursor = MormDecoder.do_select(conn, (cls,), cols,
+                                           cond + ' LIMIT 1', args)
+            rows = cursor.fetchmany(1)
+            dec = MormDecoder(cls, cursor)
+            cursor.close()
+            if not rows:
                 if default is NODEF:
                     raise MormError("Object not found (%s)." % str(constraints))
                 else:
                     return default
-            return it.next()
-        finally:
-            del it
+            row = rows[0]
+            if shared:
+                cache.put(key, (dec, row), generation)
+
+        obj = dec.decode(row)
+        if local is not None:
+            objects[key] = (_clock() + cls.cache_ttl, obj)
+        return obj
+
+    @classmethod
+    def invalidate(cls, conn=None):
+        """
+        Discard the cached objects of this table, in the shared cache and in the
+        identity map of 'conn' if given.  The writing methods do this for you.
+        """
+        tname = cls.tname()
+        cache = _caches.get(tname)
+        if cache is not None:
+            cache.clear()
+        if conn is not None:
+            local = _connection_cache(conn)
+            if local is not None:
+                local.objects.pop(tname, None)
+
+    @classmethod
+    def _written(cls, conn):
+        """
+        Invalidate the cached objects of this table after a write on 'conn',
+        which does not share its objects from then on.
+        """
+        cls.invalidate(conn)
+        local = _connection_cache(conn)
+        if local is not None:
+            local.written.add(cls.tname())
+            _writers_lock.acquire()
+            try:
+                _writers[conn] = local
+            finally:
+                _writers_lock.release()
+
+    @staticmethod
+    def end_transaction(conn):
+        """
+        Forget the objects cached in the transaction of 'conn', and the tables
+        it wrote to.  Call this after committing or rolling back a connection
+        that does not report the end of its transactions (see Caching).
+        """
+        try:
+            local = _connection_caches.get(conn)
+        except TypeError:
+            return
+        if local is not None:
+            local.clear()
+
+    @classmethod
+    def cache_stats(cls):
+        """
+        Return the statistics of the shared cache of this table, see
+        MormCache.stats().
+        """
+        return _table_cache(cls.tname(), cls).stats()
+
+    @classmethod
+    def select_first(cls, conn, limit, cond=None, args=None, cols=None,
+                     objcls=None, distinct=None):
+        """
+        Convenience method that executes a select and returns a list of at most
+        'limit' of the results, wrapped in objects with attributes.  The limit
+        is added to the query unless the condition already has one, so the
+        server does not send more rows.
+        """
+        assert conn is not None
+
+        if cond is None:
+            cond = ''
+        cond = _limit_cond(cond, limit)
+
+        # Perform the select.
+        cursor = MormDecoder.do_select(conn, (cls,), cols,
+                                       cond, args, distinct)
+
+        # Decode the first rows.
+        dec = MormDecoder(cls, cursor)
+        objects = [dec.decode(row, objcls=objcls)
+                   for row in cursor.fetchmany(limit)]
+        cursor.close()
+        return objects
 
     @classmethod
     def getsequence(cls, conn, pkseq=None):
@@ -325,6 +628,7 @@ class MormTable(object):
         statement.  Returns the encoder.
         """
         enc = cls.encoder(**fields)
+        cls._written(conn)
         return enc.insert(conn, cond, args)
 
     @classmethod
@@ -342,6 +646,141 @@ class MormTable(object):
         seq = cls.getsequence(conn, pkseq)
         return cls.get(conn, **{pk: seq})
 
+    @classmethod
+    def insert_many(cls, conn, rows, cols=None, returning=None, method=None,
+                    batchsize=None):
+        """
+        Insert many rows, given as dicts of column values, in a few statements.
+        The columns are those of the first row unless 'cols' is given, and all
+        the rows must have the same.  The rows are sent according to 'method':
+
+        - 'values': up to 'batchsize' rows per INSERT, as a multi-row VALUES
+          list;
+        - 'executemany': a single-row INSERT passed to executemany();
+        - 'copy': COPY ... FROM STDIN, 'batchsize' rows at a time, with drivers
+          that provide cursor.copy_expert() (e.g. psycopg2).
+
+        The default is 'copy' if the driver supports it and 'values' otherwise.
+        If 'returning' is a sequence of column names (e.g. the primary key),
+        the inserted rows return these columns (INSERT ... RETURNING, which
+        requires the 'values' method) and a list of the decoded objects is
+        returned.  Otherwise the number of rows is returned.  Note: this does
+        not commit the connection.
+        """
+        return cls._insert_many(conn, rows, cols, '', returning, method,
+                                batchsize)
+
+    @classmethod
+    def upsert_many(cls, conn, rows, key=('id',), cols=None, update=None,
+                    returning=None, method=None, batchsize=None):
+        """
+        Like insert_many(), but the rows that conflict with existing ones on the
+        'key' columns (which must have a unique constraint) update the 'update'
+        columns instead, by default all the columns that are not in the key
+        (INSERT ... ON CONFLICT, PostgreSQL 9.5+ or SQLite 3.24+).  If there is
+        nothing to update, the conflicting rows are skipped, and they are not
+        returned.  'method' can be 'values' (the default) or 'executemany'.
+        """
+        if isinstance(key, str):
+            key = (key,)
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return [] if returning else 0
+        if cols is None:
+            cols = list(first)
+        if update is None:
+            update = [c for c in cols if c not in key]
+
+        if update:
+            action = 'DO UPDATE SET %s' % ', '.join(
+                '%s = EXCLUDED.%s' % (c, c) for c in update)
+        else:
+            action = 'DO NOTHING'
+        conflict = ' ON CONFLICT (%s) %s' % (', '.join(key), action)
+
+        if method == 'copy':
+            raise MormError("COPY cannot update conflicting rows.")
+        return cls._insert_many(conn, itertools.chain((first,), rows), cols,
+                                conflict, returning, method or 'values',
+                                batchsize)
+
+    @classmethod
+    def _insert_many(cls, conn, rows, cols, suffix, returning, method,
+                     batchsize):
+        """
+        Guts of insert_many() and upsert_many(); 'suffix' is added after the
+        VALUES list.
+        """
+        assert conn
+        if batchsize is None:
+            batchsize = _def_batchsize
+
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return [] if returning else 0
+        if cols is None:
+            cols = list(first)
+        rows = itertools.chain((first,), rows)
+
+        # Resolve the converters once for all the rows.
+        encode = MormEncoder.row_encoder((cls,), cols)
+        cls._written(conn)
+
+        cursor = conn.cursor()
+        if method is None:
+            if returning or not hasattr(cursor, 'copy_expert'):
+                method = 'values'
+            else:
+                method = 'copy'
+        if returning and method != 'values':
+            raise MormError("Returning columns requires the 'values' method.")
+
+        head = "INSERT INTO %s (%s) VALUES " % (cls.tname(), ', '.join(cols))
+        plhold = '(%s)' % ', '.join(['%s'] * len(cols))
+        tail = suffix
+        if returning:
+            tail += ' RETURNING %s' % ', '.join(returning)
+
+        count, objects = 0, []
+        if method == 'executemany':
+            values = [encode(row) for row in rows]
+            cursor.executemany(head + plhold + tail, values)
+            count = len(values)
+
+        elif method in ('values', 'copy'):
+            while True:
+                values = [encode(row)
+                          for row in itertools.islice(rows, batchsize)]
+                if not values:
+                    break
+                count += len(values)
+
+                if method == 'copy':
+                    buf = StringIO()
+                    for value in values:
+                        buf.write('\t'.join(map(_copy_text, value)))
+                        buf.write('\n')
+                    buf.seek(0)
+                    cursor.copy_expert("COPY %s (%s) FROM STDIN" %
+                                       (cls.tname(), ', '.join(cols)), buf)
+                    continue
+
+                sql = head + ', '.join([plhold] * len(values)) + tail
+                cursor.execute(sql, [v for value in values for v in value])
+                if returning:
+                    dec = MormDecoder(cls, cursor)
+                    objects.extend(dec.decode(row)
+                                   for row in cursor.fetchall())
+        else:
+            raise MormError("Unknown insert method '%s'." % method)
+
+        cursor.close()
+        if returning:
+            return objects
+        return count
+
     @classmethod
     def update(cls, conn, cond=None, args=None, **fields):
         """
@@ -349,6 +788,7 @@ class MormTable(object):
         statement.  Returns the encoder.
         """
         enc = cls.encoder(**fields)
+        cls._written(conn)
         return enc.update(conn, cond, args)
 
     @classmethod
@@ -365,6 +805,7 @@ class MormTable(object):
 
         # Run the query.
         assert conn
+        cls._written(conn)
         cursor = conn.cursor()
         cursor.execute("DELETE FROM %s %s" % (cls.table, cond),
                        list(args))
@@ -372,6 +813,219 @@ class MormTable(object):
 
 
 
+class MormCache(object):
+    """
+    A cache shared between threads, whose entries expire after 'ttl' seconds
+    and that discards the least recently used entries beyond 'maxsize'.
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self.generation = 0
+        "Incremented by clear(), to drop the values computed before it."
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the value for 'key', or None if it is missing or expired.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > _clock():
+                # Put it back at the most recently used end.
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+        finally:
+            self._lock.release()
+
+    def put(self, key, value, generation=None):
+        """
+        Store 'value' for 'key', unless the cache was cleared since the given
+        'generation'.
+        """
+        self._lock.acquire()
+        try:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (_clock() + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self.generation += 1
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Return a dict of the 'hits' and 'misses' counts and of the number of
+        entries ('size').
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries)}
+
+_caches = {}
+"The shared caches of the cacheable tables, by table name."
+
+_caches_lock = threading.Lock()
+
+def _table_cache(tname, cls):
+    """
+    Return the shared cache of the given table, creating it with the settings of
+    'cls' if needed.
+    """
+    cache = _caches.get(tname)
+    if cache is None:
+        _caches_lock.acquire()
+        try:
+            cache = _caches.setdefault(tname, MormCache(cls.cache_size,
+                                                        cls.cache_ttl))
+        finally:
+            _caches_lock.release()
+    return cache
+
+
+class _ConnectionCache(object):
+    """
+    The identity map of the transaction of a connection, and the tables it
+    wrote to.  The identity map holds (expiry time, object) pairs.
+    """
+    __slots__ = ('objects', 'written')
+
+    def __init__(self):
+        self.objects = {}
+        self.written = set()
+
+    def clear(self):
+        """
+        Forget everything at the end of a transaction, and the shared rows of
+        the tables it wrote to, which other connections may have cached before
+        the writes were committed.
+        """
+        for tname in self.written:
+            cache = _caches.get(tname)
+            if cache is not None:
+                cache.clear()
+        self.objects.clear()
+        self.written.clear()
+
+_connection_caches = weakref.WeakKeyDictionary()
+"The caches of the connections, which go away with them."
+
+def _connection_cache(conn):
+    """
+    Return the cache of the current transaction of a connection, or None if
+    the connection object does not allow weak references.
+    """
+    try:
+        local = _connection_caches.get(conn)
+        if local is None:
+            local = _connection_caches[conn] = _ConnectionCache()
+            # Pooled connections tell when their transaction ends.
+            on_transaction_end = getattr(conn, 'on_transaction_end', None)
+            if on_transaction_end is not None:
+                on_transaction_end(local.clear)
+    except TypeError:
+        return None
+    if _idle(conn):
+        local.clear()
+    return local
+
+_writers = weakref.WeakKeyDictionary()
+"The connections that wrote in their transaction, mapped to their cache."
+
+_writers_lock = threading.Lock()
+
+def _end_writes():
+    """
+    Clear the caches of the connections that wrote, once they report the end of
+    their transaction, so that the committed writes are seen without waiting
+    for the writers to be used again.
+    """
+    _writers_lock.acquire()
+    try:
+        for conn, local in list(_writers.items()):
+            if not local.written:
+                del _writers[conn]
+            elif _idle(conn):
+                local.clear()
+                del _writers[conn]
+    finally:
+        _writers_lock.release()
+
+def _idle(conn):
+    """
+    Return true if the connection reports that it is not in a transaction:
+    sqlite3-style 'in_transaction', or the transaction status of psycopg.
+    """
+    in_transaction = getattr(conn, 'in_transaction', None)
+    if in_transaction is not None:
+        return not in_transaction
+    info = getattr(conn, 'info', None)
+    # TRANSACTION_STATUS_IDLE, in psycopg2 and psycopg 3.
+    return getattr(info, 'transaction_status', None) == 0
+
+
+def _copy_text(value):
+    "Render a value for the text format of COPY."
+    if value is None:
+        return '\\N'
+    if isinstance(value, _binary_types):
+        # The hex format of bytea, with its backslash escaped for COPY.
+        return '\\\\x' + binascii.hexlify(bytes(value)).decode('ascii')
+    return ('%s' % value).replace('\\', '\\\\').replace(
+        '\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+_rowcount_pattern = r'(\d+|ALL|%s|%\(\w+\)s)'
+"Matches a literal or parameter row count in a LIMIT, OFFSET or FETCH clause."
+
+_limit_regexp = re.compile(
+    r'\b(LIMIT\s+%s(\s+OFFSET\s+%s(\s+ROWS?)?)?|'
+    r'FETCH\s+(FIRST|NEXT)(\s+%s)?\s+ROWS?\s+(ONLY|WITH\s+TIES))\s*$'
+    % (_rowcount_pattern, _rowcount_pattern, _rowcount_pattern), re.I)
+"Matches the conditions that end with a clause limiting the rows returned."
+
+_locking_regexp = re.compile(
+    r'(\s+FOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)'
+    r'(\s+OF\s+[\w.]+(\s*,\s*[\w.]+)*)?(\s+(NOWAIT|SKIP\s+LOCKED))?)+\s*$',
+    re.I)
+"Matches the locking clauses at the end of a condition, which follow LIMIT."
+
+def _limit_cond(cond, limit):
+    """
+    Add a LIMIT clause to a select condition, before its locking clauses,
+    unless it already ends with one.
+    """
+    match = _locking_regexp.search(cond)
+    if match is not None:
+        cond, locking = cond[:match.start()], cond[match.start():]
+    else:
+        locking = ''
+    if not _limit_regexp.search(cond):
+        cond = '%s LIMIT %d' % (cond, limit)
+    return cond + locking
+
+def _condargs(condargs):
+    "Check and default the arguments of a select condition."
+    if condargs is None:
+        return []
+    assert isinstance(condargs, (tuple, list, dict))
+    return condargs
+
+
+
 class MormError(Exception):
     """
     Error happening in this module.
@@ -495,6 +1149,9 @@ class MormDecoder(MormEndecBase):
         self.attrnames = dict((c, c.split('.')[-1]) for c in colnames)
         assert len(self.attrnames) == len(self.colnames)
 
+        self.compiled = _compile_decoder(self.tables, tuple(colnames))
+        """The decoding functions specialized for these tables and columns."""
+
     def cols(self):
         """
         Return a list of field names, suitable for insertion in a query.
@@ -505,74 +1162,66 @@ class MormDecoder(MormEndecBase):
         """
         Decode a row.
         """
-        if len(self.colnames) != len(row):
-            raise MormError("Row has incorrect length for decoder.")
-
         # Convert all the values right away.  We assume that the query is
         # minimal and that we're going to need to access all the values.
-        if obj is None:
-            if objcls is not None:
-                # Use the given class if present.
-                obj = objcls()
-            else:
-                # Otherwise look in the list of tables, one-by-one until we find
-                # an object class to use.
-                for table in self.tables:
-                    if table.objcls is not None:
-                        obj = table.objcls()
-                        break
+        make, fill, defcls = self.compiled
+        try:
+            if obj is None:
+                if objcls is not None:
+                    # Use the given class if present.
+                    obj = objcls()
+                elif make is not None:
+                    # The tables use the default class, create a row with
+                    # slots for the columns.
+                    return make(row)
                 else:
-                    # Otherwise just use the default
-                    obj = MormObject()
-
-        for cname, cvalue in zip(self.colnames, row):
-            if '.' in cname:
-                # Get the table with the matching name and use the converter on
-                # this table if there is one.
-                comps = cname.split('.')
-                tablename, cname = comps[0], comps[-1]
-                for cls in self.tables:
-                    if cls.tname() == tablename:
-                        converter = cls.converters.get(cname, None)
-                        if converter is not None:
-                            cvalue = converter.to_python(cvalue)
-                        break
-            else:
-                # Look in the table list for the first appropriate found
-                # converter.
-                for cls in self.tables:
-                    converter = cls.converters.get(cname, None)
-                    if converter is not None:
-                        cvalue = converter.to_python(cvalue)
-                        break
-
-            ## setattr(obj, self.attrnames[cname], cvalue)
-            setattr(obj, cname, cvalue)
-        return obj
-
-    def iter(self, cursor, objcls=None):
+                    obj = defcls()
+            return fill(obj, row)
+        except ValueError:
+            if len(self.colnames) != len(row):
+                raise MormError("Row has incorrect length for decoder.")
+            raise
+
+    def iter(self, cursor, objcls=None, batchsize=None):
         """
         Create an iterator on the given cursor.
         This also deals with the case where a cursor has no results.
         """
         if cursor is None:
             raise MormError("No cursor to iterate.")
-        return MormDecoderIterator(self, cursor, objcls)
+        return MormDecoderIterator(self, cursor, objcls, batchsize)
 
 
     #---------------------------------------------------------------------------
 
     @staticmethod
     def do_select(conn, tables, colnames=None, cond=None, condargs=None,
-                  distinct=None):
+                  distinct=None, cursor=None):
         """
         Guts of the select methods.  You need to pass in a valid connection
-        'conn'.  This returns a new cursor from the given connection.
+        'conn'.  This returns a new cursor from the given connection, or the
+        given 'cursor' if you want the query to run on a specific one.
 
         Note that this method is limited to be able to select on a single table
         only.  If you want to select on multiple tables at once you will need to
         do the select yourself.
         """
+        assert conn is not None
+
+        # Run the query.
+        if cursor is None:
+            cursor = conn.cursor()
+
+        sql = MormDecoder.select_sql(tables, colnames, cond, distinct)
+        cursor.execute(sql, _condargs(condargs))
+
+        return cursor
+
+    @staticmethod
+    def select_sql(tables, colnames=None, cond=None, distinct=None):
+        """
+        Return the SQL of the select statement run by do_select().
+        """
         tablenames = ','.join(x.tname() for x in tables)
 
         if colnames is None:
@@ -580,33 +1229,131 @@ class MormDecoder(MormEndecBase):
 
         if cond is None:
             cond = ''
-        if condargs is None:
-            condargs = []
-        else:
-            assert isinstance(condargs, (tuple, list, dict))
 
-        assert conn is not None
+        distinct = distinct and 'DISTINCT' or ''
+        return "SELECT %s %s FROM %s %s" % (distinct, ', '.join(colnames),
+                                            tablenames, cond)
 
-        # Run the query.
-        cursor = conn.cursor()
 
-        distinct = distinct and 'DISTINCT' or ''
-        sql = "SELECT %s %s FROM %s %s" % (distinct, ', '.join(colnames),
-                                           tablenames, cond)
-        cursor.execute(sql, condargs)
 
-        return cursor
+_decoders = {}
+"Cache of the compiled decoding functions, by tables and column names."
+
+_max_decoders = 256
+"The number of compiled decoders beyond which the cache above starts over."
+
+_identifier = re.compile('[A-Za-z_][A-Za-z0-9_]*$')
+
+def _compile_decoder(tables, colnames):
+    """
+    Return the functions that decode a row with the given columns for the given
+    tables, as a (make, fill, defcls) triple: 'make(row)' creates a MormRow
+    for the row, 'fill(obj, row)' sets the attributes of 'obj' and returns it,
+    and 'defcls' is the object class of the tables.  'make' is None if the
+    tables declare their own object class, or if the columns are not valid
+    attribute names.
+
+    The converters and attribute names are looked up here once, so that
+    decoding a row does no lookups.  They are cached, so changing the
+    converters of a table afterwards has no effect on the columns already
+    decoded.
+    """
+    key = (tables, colnames)
+    try:
+        return _decoders[key]
+    except KeyError:
+        pass
+
+    attrs, converters = [], []
+    for cname in colnames:
+        converter = None
+        if '.' in cname:
+            # Get the table with the matching name and use the converter on
+            # this table if there is one.
+            comps = cname.split('.')
+            tablename, cname = comps[0], comps[-1]
+            for cls in tables:
+                if cls.tname() == tablename:
+                    converter = cls.converters.get(cname, None)
+                    break
+        else:
+            # Look in the table list for the first appropriate found
+            # converter.
+            for cls in tables:
+                converter = cls.converters.get(cname, None)
+                if converter is not None:
+                    break
+        attrs.append(cname)
+        converters.append(converter)
+
+    # Look in the list of tables, one-by-one until we find an object class to
+    # use, otherwise just use the default.
+    for table in tables:
+        if table.objcls is not None:
+            defcls = table.objcls
+            break
+    else:
+        defcls = MormObject
+
+    namespace = {'__builtins__': {}, 'new': object.__new__}
+    args, values = [], []
+    for i, converter in enumerate(converters):
+        args.append('c%d' % i)
+        if converter is None:
+            values.append('c%d' % i)
+        else:
+            namespace['v%d' % i] = converter.to_python
+            values.append('v%d(c%d)' % (i, i))
+    unpack = '%s, = row' % ', '.join(args)
+
+    if all(_identifier.match(a) and not keyword.iskeyword(a) for a in attrs):
+        sets = ''.join('    obj.%s = %s\n' % av for av in zip(attrs, values))
+        source = 'def fill(obj, row):\n    %s\n%s    return obj\n' % (unpack,
+                                                                     sets)
+        if defcls is MormObject:
+            slots = []
+            for attr in attrs:
+                if attr not in slots:
+                    slots.append(attr)
+            namespace['Row'] = type('%sRow' % tables[0].__name__, (MormRow,),
+                                    {'__slots__': tuple(slots)})
+            source += ('def make(row):\n    %s\n    obj = new(Row)\n'
+                       '%s    return obj\n' % (unpack, sets))
+        exec(source, namespace)
+        fill, make = namespace['fill'], namespace.get('make')
+    else:
+        # Column names such as expressions need setattr().
+        pairs = list(zip(attrs, converters))
+        def fill(obj, row):
+            if len(row) != len(pairs):
+                raise ValueError
+            for (attr, converter), value in zip(pairs, row):
+                if converter is not None:
+                    value = converter.to_python(value)
+                setattr(obj, attr, value)
+            return obj
+        make = None
+
+    if len(_decoders) >= _max_decoders:
+        _decoders.clear()
+    return _decoders.setdefault(key, (make, fill, defcls))
 
 
 
 class MormDecoderIterator(object):
     """
-    Iterator for a decoder.
+    Iterator for a decoder.  The rows are fetched 'batchsize' at a time, to
+    avoid a round-trip to the server per row with some drivers.
     """
-    def __init__(self, decoder, cursor, objcls=None):
+    def __init__(self, decoder, cursor, objcls=None, batchsize=None):
         self.decoder = decoder
         self.cursor = cursor
         self.objcls = objcls
+        if batchsize is None:
+            batchsize = _def_batchsize
+        self.batchsize = batchsize
+        self.rows = []
+        self.index = 0
 
     def __len__(self):
         return self.cursor.rowcount
@@ -621,11 +1368,16 @@ class MormDecoderIterator(object):
         if objcls is None:
             objcls = self.objcls
 
-        row = self.cursor.fetchone()
-        if row is None:
-            raise StopIteration
-        else:
-            return self.decoder.decode(row, obj, objcls)
+        if self.index >= len(self.rows):
+            self.rows = self.cursor.fetchmany(self.batchsize)
+            self.index = 0
+            if not self.rows:
+                raise StopIteration
+        row = self.rows[self.index]
+        self.index += 1
+        return self.decoder.decode(row, obj, objcls)
+
+    __next__ = next
 
 
 
@@ -660,6 +1412,38 @@ class MormEncoder(MormEndecBase):
     def cols(self):
         return ', '.join(self.colnames)
 
+    @staticmethod
+    def row_encoder(tables, colnames):
+        """
+        Return a function that converts a dict of column values into the tuple
+        of the encoded values of the given columns, for inserting many rows.
+        The converters are looked up once.
+        """
+        converters = []
+        for cname in colnames:
+            for cls in tables:
+                converter = cls.converters.get(cname, None)
+                if converter is not None:
+                    converters.append(converter.from_python)
+                    break
+            else:
+                converters.append(None)
+        columns = list(zip(colnames, converters))
+        ncols = len(columns)
+
+        def encode(fields):
+            if len(fields) != ncols:
+                raise MormError("Row has incorrect columns for encoder: %s" %
+                                sorted(fields))
+            try:
+                return tuple(fields[cname] if conv is None
+                             else conv(fields[cname])
+                             for cname, conv in columns)
+            except KeyError:
+                raise MormError("Row has incorrect columns for encoder: %s" %
+                                sorted(fields))
+        return encode
+
     def values(self):
         """
         Returns the list of converted values.
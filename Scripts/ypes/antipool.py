@@ -62,6 +62,16 @@ connection_ro() method::
     cursor = conn.cursor()
     ...
 
+By default a single connection is shared for reading.  Set the 'ro_conns'
+option to share more of them, and the 'ro_endpoints' option to spread the reads
+over replicas of the database; each read is routed to the shared connection with
+the fewest outstanding requests::
+
+    pool = ConnectionPool(dbapi,
+                          {'ro_conns': 2,
+                           'ro_endpoints': [{}, {'host': 'replica1'}]},
+                          database='test', host='primary')
+
 Since this will not work for operations that write to the database, you should
 NEVER perform inserts, deletes or updates using these special connections.  We
 do not check the SQL that gets executed, but we specifically do not provide a
@@ -116,11 +126,40 @@ connection parameter.  The calls automatically acquire and release a connection
 object, and commit if relevant.
 
 
-Forking
--------
+Units of Work
+-------------
 
+Each ConnOp call or decorated function acquires, commits and releases its own
+connection.  To group several of them in a single transaction, run them in a
+session, which pins one read-and-write connection to the current thread (or
+asyncio task) until it ends::
 
+    with antipool.session() as sess:
+        users.insert(...)
+        users.update(...)
+        cursor = sess.connection().cursor()
+        ...
+
+The ConnOp calls and the ``@connected`` and ``@connected_ro`` functions that run
+in the session use its connection and do not commit; the session commits once
+when it ends, or rolls back if an exception is raised.  The connection is only
+acquired the first time it is needed.  Sessions nest: a session entered while
+another one is active for the same pool joins it, and an exception leaving the
+inner one makes the whole unit roll back.  Do not release the pinned
+connection yourself, and do not share a session between threads.
+
+
+Forking
+-------
 
+Database connections cannot be shared between processes: a child process that
+inherits the pool would otherwise talk to the server over the sockets of its
+parent.  The pools notice that they are used in a new process (with
+os.register_at_fork() where available, or by checking the process id otherwise)
+and start over with no connections in the child.  The inherited sockets are
+detached in the child without closing the database session, which still
+belongs to the parent; connections acquired before the fork are simply dropped
+when they are released in the child.
 
 
 Convenience Decorators
@@ -163,11 +202,12 @@ __copyright__ = 'Copyright (C) 2006 Martin Blais. All Rights Reserved.'
 
 
 # stdlib imports
-import os, types, threading, gc, warnings
-from datetime import datetime, timedelta
+import os, types, threading, gc, warnings, weakref, bisect
+from collections import deque, OrderedDict
 
 
-__all__ = ('ConnectionPool', 'Error', 'dbpool', 'ConnOp')
+__all__ = ('ConnectionPool', 'Error', 'PoolTimeout', 'dbpool', 'ConnOp',
+           'StatementCache', 'PoolMetrics', 'Session', 'session')
 
 
 # Create an alias for Python 3.x compatibility
@@ -176,6 +216,38 @@ try:
 except NameError:
     xrange = range
 
+# Connection ages are measured on a monotonic clock when there is one (3.3+),
+# so that adjusting the system time does not reap or pin connections.
+try:
+    from time import monotonic as _clock
+except ImportError:
+    from time import time as _clock
+
+# The active session is tracked per asyncio task where context variables exist
+# (3.7+), and per thread otherwise.
+try:
+    from contextvars import ContextVar
+except ImportError:
+    class ContextVar(object):
+        """
+        A minimal thread-local stand-in for contextvars.ContextVar.
+        """
+        def __init__(self, name, default=None):
+            self.name = name
+            self._default = default
+            self._local = threading.local()
+
+        def get(self):
+            return getattr(self._local, 'value', self._default)
+
+        def set(self, value):
+            token = self.get()
+            self._local.value = value
+            return token
+
+        def reset(self, token):
+            self._local.value = token
+
 
 def dbpool():
     """
@@ -260,9 +332,14 @@ class ConnOp(object):
         """
         fun = getattr(self.table, funname)
 
+        pool = dbpool()
+        conn = _pinned_connection(pool)
+        if conn is not None:
+            return fun(conn, *args, **kwds)
+
         rv = None
 
-        conn = dbpool().connection_ro()
+        conn = pool.connection_ro()
         try:
             try:
                 newargs = (conn,) + args
@@ -281,21 +358,30 @@ class ConnOp(object):
         """
         fun = getattr(self.table, funname)
 
+        pool = dbpool()
+        conn = _pinned_connection(pool)
+        if conn is not None:
+            # The session commits when it ends.
+            return fun(conn, *args, **kwds)
+
         rv = None
 
-        conn = dbpool().connection()
+        conn = pool.connection()
+        clean = False
         try:
             try:
                 newargs = (conn,) + args
                 rv = fun(*newargs, **kwds)
             except Exception:
                 conn.rollback()
+                clean = True
                 raise
             else:
                 # Automatically commit.
                 conn.commit()
+                clean = True
         finally:
-            conn.release()
+            conn.release(clean)
         return rv
 
 
@@ -307,6 +393,9 @@ class ConnOp(object):
     def count(self, *args, **kwds):
         return self._run_with_conn_ro('count', *args, **kwds)
 
+    def exists(self, *args, **kwds):
+        return self._run_with_conn_ro('exists', *args, **kwds)
+
     def select_all(self, *args, **kwds):
         return self._run_with_conn_ro('select_all', *args, **kwds)
 
@@ -343,9 +432,15 @@ def connected_ro(fun):
     under the name 'conn'.
     """
     def wfun(*args, **kwds):
-        conn = dbpool().connection_ro()
+        assert 'conn' not in kwds
+        pool = dbpool()
+        conn = _pinned_connection(pool)
+        if conn is not None:
+            kwds['conn'] = conn
+            return fun(*args, **kwds)
+
+        conn = pool.connection_ro()
         try:
-            assert 'conn' not in kwds
             kwds['conn'] = conn
             return fun(*args, **kwds)
         finally:
@@ -357,23 +452,121 @@ def connected(fun):
     Decorator, similar to connected_ro() but that passes a RW connection and
     that commits automatically.
 
-    FIXME: we want to make the automatic commit optional.
+    In a session, the function gets the session's connection and the commit is
+    left to the session.
+
     FIXME: we would like to also ask for some cursors to be automatically passed
            ain.
     """
     def wfun(*args, **kwds):
-        conn = dbpool().connection()
+        assert 'conn' not in kwds
+        pool = dbpool()
+        conn = _pinned_connection(pool)
+        if conn is not None:
+            kwds['conn'] = conn
+            return fun(*args, **kwds)
+
+        conn = pool.connection()
+        clean = False
         try:
-            assert 'conn' not in kwds
             kwds['conn'] = conn
             r = fun(*args, **kwds)
             conn.commit()
+            clean = True
             return r
         finally:
-            conn.release()
+            conn.release(clean)
     return wfun
 
 
+# Sessions
+
+_current_session = ContextVar('antipool_session', default=None)
+"""The session active in the current context, if any."""
+
+def _pinned_connection(pool):
+    """
+    Return the connection of the session active for 'pool', acquiring it if
+    needed, or None if there is no such session.
+    """
+    sess = _current_session.get()
+    if sess is None or sess.pool is not pool:
+        return None
+    return sess.connection()
+
+def session(pool=None):
+    """
+    Return a unit of work on 'pool' (None means the global pool), to use with
+    the 'with' statement.  This is the active session if there is one for the
+    same pool, which the block then joins, or else a new Session.
+    """
+    if pool is None:
+        pool = dbpool()
+    sess = _current_session.get()
+    if sess is not None and sess.pool is pool:
+        return sess
+    return Session(pool)
+
+class Session(object):
+    """
+    A unit of work that pins a single read-and-write connection for the
+    ConnOp calls and the decorated functions that run while it is active, and
+    that commits once when it ends.  See session().
+    """
+    def __init__(self, pool=None):
+        if pool is None:
+            pool = dbpool()
+        self.pool = pool
+        """The connection pool that the connection is acquired from."""
+
+        self.rollback_only = False
+        """Whether the session rolls back instead of committing when it ends.
+        This is set when an exception leaves one of its blocks."""
+
+        self._conn = None
+        self._depth = 0
+        self._token = None
+
+    def connection(self):
+        """
+        Return the pinned connection, acquiring it on first use.
+        """
+        if self._depth == 0:
+            raise Error("Error: Session is not active.")
+        if self._conn is None:
+            self._conn = self.pool.connection()
+        return self._conn
+
+    def __enter__(self):
+        if self._depth == 0:
+            self.rollback_only = False
+            self._token = _current_session.set(self)
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.rollback_only = True
+        self._depth -= 1
+        if self._depth > 0:
+            return
+        _current_session.reset(self._token)
+        self._token = None
+
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        clean = False
+        try:
+            if self.rollback_only:
+                conn.rollback()
+            else:
+                conn.commit()
+            clean = True
+        finally:
+            conn.release(clean)
+
+
 
 
 class ConnectionPoolInterface(object):
@@ -387,7 +580,7 @@ class ConnectionPoolInterface(object):
         standard objects it provides, e.g. Binary().
         """
 
-    def connection(self, nbcursors=0, readonly=False):
+    def connection(self, nbcursors=0, readonly=False, timeout=None):
         """
         Acquire a connection for read an write operations.
 
@@ -398,9 +591,13 @@ class ConnectionPoolInterface(object):
 
         Invoke with readonly=True if you need a read-only connection
         (alternatively, you can use the connection_ro() method below).
+
+        If the pool is exhausted, wait at most 'timeout' seconds for a
+        connection to be released (None means the pool's default) and raise
+        PoolTimeout otherwise.
         """
 
-    def connection_ro(self, nbcursors=0):
+    def connection_ro(self, nbcursors=0, timeout=None):
         """
         Acquire a connection for read-only operations.
         See connection() for details.
@@ -433,11 +630,82 @@ class ConnectionPool(ConnectionPoolInterface):
     _def_disable_rollback = False
     """Should we disable the rollback on released connections?"""
 
+    _def_pool_order = 'lifo'
+    """Order in which idle connections are handed out: 'lifo' reuses the most
+    recently released connection, which lets the others age and get reaped;
+    'fifo' rotates through all the idle connections."""
+
+    _def_reapsecs = None
+    """Interval in seconds between two runs of the background janitor that
+    closes the idle connections in excess of 'minconn' (None means every
+    'minkeepsecs' seconds, 0 disables the janitor)."""
+
+    _def_acquire_timeout = None
+    """The maximum amount of seconds to wait for a connection when the maximum
+    number of connections has been reached (None means wait forever)."""
+
+    _def_ping_query = 'SELECT 1'
+    """The cheap statement used to check that a connection is still alive, when
+    'pre_ping' is enabled or for the idle connections keepalive."""
+
+    _def_max_lifetime = None
+    """The maximum age in seconds of a connection, after which it is closed and
+    replaced by a new one (None means no limit)."""
+
+    _def_max_uses = None
+    """The maximum number of times a connection is handed out, after which it is
+    closed and replaced by a new one (None means no limit)."""
+
+    _def_prewarm = False
+    """Should the pool open 'minconn' connections in the background when it is
+    created, and open new ones when it falls below that number?  In a child
+    process this waits for the first acquire, so that the workers of a
+    pre-forking server do not all connect at once."""
+
+    _def_stmt_cache_size = 0
+    """The number of cursors kept per read-write connection for reuse with the
+    same query text (0 disables the statement cache).  Only drivers whose
+    cursors have a prepare() method save parsing the queries again, see
+    StatementCache."""
+
+    _def_ro_conns = 1
+    """The number of shared read-only connections to open to each read
+    endpoint."""
+
+    _def_keepalive_secs = None
+    """Idle connections that have not been used or checked for that many seconds
+    get pinged by the janitor thread, and closed if they are dead (None
+    disables the keepalive)."""
+
     def __init__(self, dbapi, options=None, **params):
         """
         'dbapi': the DBAPI-2.0 module interface for creating connections.
         'minconn': the minimum number of connections to keep around.
         'maxconn': the maximum allowed number of connections to the DB.
+        'minkeepsecs': how long an idle connection is kept before it may be
+          reaped.
+        'pool_order': 'lifo' or 'fifo', see _def_pool_order.
+        'reapsecs': interval of the idle connections janitor, see
+          _def_reapsecs.
+        'acquire_timeout': default timeout for acquiring a connection, see
+          _def_acquire_timeout.
+        'pre_ping': check that idle connections are alive before handing them
+          out, with the given statement or _def_ping_query if simply true.
+        'max_lifetime': recycle connections after that many seconds, see
+          _def_max_lifetime.
+        'max_uses': recycle connections after that many uses, see
+          _def_max_uses.
+        'keepalive_secs': ping idle connections in the background, see
+          _def_keepalive_secs.
+        'prewarm': keep 'minconn' connections open, see _def_prewarm.
+        'stmt_cache_size': the size of the statement cache of each connection,
+          see _def_stmt_cache_size.
+        'ro_conns': the number of shared read-only connections per endpoint,
+          see _def_ro_conns.
+        'ro_endpoints': a list of read endpoints, each given as a dict of
+          connection parameters that override those of the pool, e.g.
+          [{}, {'host': 'replica1'}] to read from the primary and a replica.
+          The default is to read from the primary only.
         'debug': flag to enable printing debugging output.
         '**params': connection parameters for creating a new connection.
         """
@@ -450,29 +718,55 @@ class ConnectionPool(ConnectionPoolInterface):
                         "order to creat4e a connection pool.")
         """The parameters for creating a connection."""
 
-        self._pool = []
-        self._pool_lock = threading.Condition(threading.RLock())
-        """A pool of database connections and an associated lock for access."""
+        self._pool = deque()
+        self._pool_lock = threading.RLock()
+        """A pool of idle database connections and an associated lock for
+        access.  The pool holds (connection, last released time) pairs and is
+        always sorted by release time, oldest first, since connections are
+        only ever appended when they are released."""
+
+        self._waiters = deque()
+        """The threads waiting for a connection, in arrival order.  Released
+        connections are handed directly to the first waiter, so that a thread
+        that just arrived cannot take them over threads that were waiting."""
+
+        self._conninfo = {}
+        """Bookkeeping for each read-write connection (see _ConnInfo), by
+        connection id."""
+
+        self.metrics = PoolMetrics()
+        """The counters and histograms of the pool (see PoolMetrics)."""
+
+        self._stmt_dropped = StatementCache.Stats()
 
         self._nbconn = 0
         """The total number read-write database connections that were handed
         out.  This does not include the RO connection, if it is created."""
 
-        self._roconn = None
-        self._roconn_lock = threading.Lock()
-        self._roconn_refs = 0
-        """A connection for read-only access and an associated lock for
-        creation.  We also store the number of references to it that were
-        handled to clients."""
+        self._pending = 0
+        """The number of read-write connections being created.  They are
+        already counted in _nbconn, which reserves their slots, but they are
+        created without holding the pool lock."""
 
         if options is None:
             options = {}
 
+        ro_conns = options.pop('ro_conns', self._def_ro_conns)
+        self._roendpoints = [
+            _Endpoint(overrides, ro_conns)
+            for overrides in options.pop('ro_endpoints', None) or [{}]]
+        self._roslots = [slot for endpoint in self._roendpoints
+                         for slot in endpoint.slots]
+        self._roconns = {}
+        self._roconn_lock = threading.Lock()
+        """The shared connections for read-only access, in slots that hold the
+        number of references to them that were handed to clients, and an
+        associated lock.  The open connections are also mapped to their slot by
+        connection id."""
+
         self._debug = options.pop('debug', False)
         if self._debug:
             assert hasattr(self._debug, 'write')
-            self._log_lock = threading.Lock()
-            """Lock used to serialize debug output between threads."""
 
         disable_ro = options.pop('disable_ro', False)
         if not disable_ro and dbapi.threadsafety < 2:
@@ -501,6 +795,32 @@ class ConnectionPool(ConnectionPoolInterface):
 
         self._minkeepsecs = options.pop('minkeepsecs', self._def_minkeepsecs)
 
+        pool_order = options.pop('pool_order', self._def_pool_order)
+        if pool_order not in ('lifo', 'fifo'):
+            raise Error("Invalid pool order: %s" % pool_order)
+        self._fifo = (pool_order == 'fifo')
+
+        self._reapsecs = options.pop('reapsecs', self._def_reapsecs)
+        if self._reapsecs is None:
+            self._reapsecs = self._minkeepsecs
+
+        self._acquire_timeout = options.pop('acquire_timeout',
+                                            self._def_acquire_timeout)
+
+        pre_ping = options.pop('pre_ping', False)
+        if pre_ping is True:
+            pre_ping = self._def_ping_query
+        self._pre_ping = pre_ping
+        self._max_lifetime = options.pop('max_lifetime', self._def_max_lifetime)
+        self._max_uses = options.pop('max_uses', self._def_max_uses)
+        self._keepalive_secs = options.pop('keepalive_secs',
+                                           self._def_keepalive_secs)
+        self._stmt_cache_size = options.pop('stmt_cache_size',
+                                            self._def_stmt_cache_size)
+        self._prewarm = options.pop('prewarm', self._def_prewarm)
+        self._prewarm_deferred = False
+        """Should the next acquire start prewarming?  Set after forking."""
+
         self._disable_rollback = options.pop('disable_rollback',
                                              self._def_disable_rollback)
 
@@ -518,6 +838,23 @@ class ConnectionPool(ConnectionPoolInterface):
 
         self._isolation_level = options.pop('isolation_level', None)
 
+        self._janitor_stop = None
+        self._start_janitor()
+
+        self._pid = os.getpid()
+        """The process that owns the connections."""
+        _pools.add(self)
+
+        self._start_prewarm()
+
+    def _check_pid(self):
+        """
+        Forget the inherited connections if we are running in a child process.
+        This is only needed when os.register_at_fork() is not available.
+        """
+        if self._pid != os.getpid():
+            self.forget_connections()
+
     def ro_shared(self):
         """
         Returns true if the read-only connections are shared between the
@@ -531,23 +868,28 @@ class ConnectionPool(ConnectionPoolInterface):
         """
         return self.dbapi
 
-    def _log(self, msg):
+    def _log(self, msg, *args):
         """
-        Debugging information logging.
+        Debugging information logging.  The message is only formatted with its
+        arguments if debugging is enabled, and written in a single call, so
+        that lines from different threads do not get mixed up.
         """
         if self._debug:
-            self._log_lock.acquire()
-            curthread = threading.currentThread()
+            if args:
+                msg = msg % args
+            curthread = threading.current_thread()
             self._debug.write('   [%s %s] %s\n' %
-                              (curthread.getName(), os.getpid(), msg))
-            self._log_lock.release()
+                              (curthread.name, os.getpid(), msg))
 
-    def _create_connection(self, read_only):
+    def _create_connection(self, read_only, endpoint=None):
         """
-        Create a new connection to the database.
+        Create a new connection to the database, or to the given read endpoint.
         """
-        self._log('Connection Create%s' % (read_only and ' (READ ONLY)' or ''))
+        self._log('Connection Create%s', read_only and ' (READ ONLY)' or '')
         params = self._params
+        if endpoint is not None and endpoint.overrides:
+            params = params.copy()
+            params.update(endpoint.overrides)
         if read_only and self._user_ro:
             params = params.copy()
             params['user'] = self._user_ro
@@ -564,6 +906,7 @@ class ConnectionPool(ConnectionPoolInterface):
         Close the given connection for the database.
         """
         self._log('Connection Close')
+        self.metrics.closed.inc()
         return conn.close()
 
     @staticmethod
@@ -582,95 +925,388 @@ class ConnectionPool(ConnectionPoolInterface):
 
     def _get_connection_ro(self):
         """
-        Acquire a read-only connection.
+        Acquire a read-only connection.  We pick the shared connection with the
+        fewest outstanding requests, opening a new one if all the open ones are
+        in use and there are slots left, on the least busy endpoint.
+
+        The connection is opened without holding the lock, so that a slow
+        endpoint does not hold up the other read-only acquisitions: the slot is
+        reserved meanwhile, and the threads that pick it wait for it.
         """
+        if _check_fork:
+            self._check_pid()
         self._roconn_lock.acquire()
         self._log('Acquire RO')
         try:
-            if not self._roconn:
-                self._roconn = self._create_connection(True)
-            self._roconn_refs += 1
+            slot = min(self._roslots,
+                       key=lambda slot: (slot.refs, slot.conn is None,
+                                         slot.endpoint.outstanding()))
+            endpoint = slot.endpoint
+            slot.refs += 1
+            conn, opening = slot.conn, slot.opening
+            create = conn is None and opening is None
+            if create:
+                opening = slot.opening = threading.Event()
+            elif conn is not None:
+                endpoint.acquired += 1
+                self.metrics.acquired.inc()
+                return conn
+        finally:
+            self._roconn_lock.release()
+
+        if not create:
+            # Another thread is opening the connection of this slot.
+            opening.wait()
+            self._roconn_lock.acquire()
+            try:
+                conn = slot.conn
+                if conn is not None:
+                    endpoint.acquired += 1
+                    self.metrics.acquired.inc()
+                    return conn
+                # It could not be opened, or was ditched since.
+                slot.refs = max(slot.refs - 1, 0)
+            finally:
+                self._roconn_lock.release()
+            return self._get_connection_ro()
+
+        try:
+            conn = self._create_connection(True, endpoint)
+        except:
+            self._roconn_lock.acquire()
+            try:
+                slot.refs -= 1
+                slot.opening = None
+                endpoint.errors += 1
+            finally:
+                self._roconn_lock.release()
+            opening.set()
+            raise
+
+        self.metrics.created.inc()
+        self._roconn_lock.acquire()
+        try:
+            slot.conn = conn
+            slot.opening = None
+            self._roconns[id(conn)] = slot
+            endpoint.acquired += 1
+            self.metrics.acquired.inc()
         finally:
             self._roconn_lock.release()
-        return self._roconn
+        opening.set()
+        return conn
 
-    def connection_ro(self, nbcursors=0):
+    def connection_ro(self, nbcursors=0, timeout=None):
         """
-        (See base class.)
+        (See base class.)  The shared RO connection never blocks, so 'timeout'
+        is ignored.
         """
         return self._add_cursors(
             ConnectionWrapperRO(self._get_connection_ro(), self), nbcursors)
 
-    def _acquire(self):
+    def _acquire(self, timeout=None):
         """
         Acquire a connection from the pool, for read an write operations.
 
         Note that if the maximum number of connections has been reached, this
-        becomes a blocking operation.
+        becomes a blocking operation: the callers wait in a queue and are served
+        in order, for at most 'timeout' seconds each.
         """
+        if _check_fork:
+            self._check_pid()
+        if self._prewarm_deferred:
+            self._prewarm_deferred = False
+            self._start_prewarm()
+        if timeout is None:
+            timeout = self._acquire_timeout
+        start = _clock()
+
+        conn, waiter, created = None, None, False
         self._pool_lock.acquire()
-        self._log('Acquire (begin)  Pool: %d  / Created: %s' %
-                  (len(self._pool), self._nbconn))
+        self._log('Acquire (begin)  Pool: %d  / Created: %s',
+                  len(self._pool), self._nbconn)
         try:
-            # Apply maximum number of connections constraint.
-            if self._maxconn is not None:
+            if self._pool:
+                if self._fifo:
+                    conn, last_released = self._pool.popleft()
+                else:
+                    conn, last_released = self._pool.pop()
+            elif self._maxconn is None or self._nbconn < self._maxconn:
+                # Reserve a slot, the connection gets created unlocked below.
+                self._nbconn += 1
+                self._pending += 1
+                created = True
+            else:
                 # Sanity check.
-                assert self._nbconn <= self._maxconn
+                assert self._nbconn == self._maxconn
 
-                while not self._pool and self._nbconn == self._maxconn:
-                    # Block until a connection is released.
-                    self._log('Acquire (wait)  Pool: %d  / Created: %s' %
-                              (len(self._pool), self._nbconn))
-                    self._pool_lock.wait()
-                    self._log('Acquire (signaled)  Pool: %d  / Created: %s' %
-                              (len(self._pool), self._nbconn))
+                # Queue up and wait for a connection to be handed to us.
+                waiter = _Waiter()
+                self._waiters.append(waiter)
+                self._log('Acquire (wait)  Pool: %d  / Created: %s',
+                          len(self._pool), self._nbconn)
+        finally:
+            self._pool_lock.release()
 
-                # Assert that we have a connection in the pool or that we can
-                # create a new one if needed, i.e. what we waited for just
-                # before.  (This is now a useless sanity check.)
-                assert self._pool or self._nbconn < self._maxconn
+        if waiter is not None:
+            waiter.event.wait(timeout)
 
-            if self._pool:
-                conn, last_released = self._pool.pop()
-            else:
-                # Make sure that we never create a new connection if we have
-                # reached the maximum.
-                if self._maxconn is not None:
-                    assert self._nbconn < self._maxconn
+            self._pool_lock.acquire()
+            try:
+                self._log('Acquire (signaled)  Pool: %d  / Created: %s',
+                          len(self._pool), self._nbconn)
+                if waiter.conn is not None:
+                    conn = waiter.conn
+                elif waiter.create:
+                    self._pending += 1
+                    created = True
+                else:
+                    # Nothing was handed to us in time.
+                    self._waiters.remove(waiter)
+                    self.metrics.timeouts.inc()
+                    raise PoolTimeout(
+                        "Timed out after %s seconds waiting for one of the %s "
+                        "connections of the pool." % (timeout, self._maxconn))
+            finally:
+                self._pool_lock.release()
+
+        if created:
+            conn = self._create_reserved()
+
+        # Validate the connections that were created earlier, they may have died
+        # in the meantime, e.g. if the database server was restarted.
+        elif not self._usable(conn):
+            conn = self._replace(conn)
 
-                conn = self._create_connection(False)
-                self._nbconn += 1
+        self._pool_lock.acquire()
+        try:
+            now = _clock()
+            self.metrics.acquire_time.observe(now - start)
+            self.metrics.acquired.inc()
+            info = self._conninfo[id(conn)]
+            info.uses += 1
+            info.acquired = now
+            self._log('Acquire (end  )  Pool: %d  / Created: %s',
+                      len(self._pool), self._nbconn)
+        finally:
+            self._pool_lock.release()
+        return conn
 
-            self._log('Acquire (end  )  Pool: %d  / Created: %s' %
-                      (len(self._pool), self._nbconn))
+    def _create_reserved(self):
+        """
+        Create a new connection for the pool, in a slot that the caller reserved
+        and counted in _pending.  This must be called without the pool lock, so
+        that a slow connection setup does not hold up the other threads.
+        """
+        try:
+            conn = self._create_connection(False)
+        except:
+            self._pool_lock.acquire()
+            try:
+                self._pending -= 1
+                self._free_slot_locked()
+            finally:
+                self._pool_lock.release()
+            raise
+        self.metrics.created.inc()
+        self._pool_lock.acquire()
+        try:
+            self._pending -= 1
+            self._conninfo[id(conn)] = _ConnInfo(_clock())
         finally:
             self._pool_lock.release()
         return conn
 
-    def _connection_ro_crippled(self, nbcursors=0):
+    def _start_prewarm(self):
+        """
+        Start a daemon thread that opens 'minconn' connections, if enabled.  Like
+        the janitor, it only holds a weak reference to the pool.
+        """
+        if not self._prewarm or not self._minconn:
+            return
+        prewarmer = threading.Thread(target=_prewarmer,
+                                     args=(weakref.ref(self),),
+                                     name='antipool-prewarm')
+        prewarmer.daemon = True
+        prewarmer.start()
+
+    def _fill(self):
+        """
+        Open new connections until there are at least 'minconn' of them (the
+        ones being opened count), and put them in the pool.  Returns the number
+        of connections that were opened.
+        """
+        nbcreated = 0
+        while 1:
+            self._pool_lock.acquire()
+            try:
+                if (self._nbconn >= self._minconn or
+                    (self._maxconn is not None and
+                     self._nbconn >= self._maxconn)):
+                    break
+                self._nbconn += 1
+                self._pending += 1
+            finally:
+                self._pool_lock.release()
+
+            try:
+                conn = self._create_reserved()
+            except Exception as e:
+                # We will try again at the next janitor run.
+                self._log('Prewarm error: %s', e)
+                break
+
+            self._pool_lock.acquire()
+            try:
+                self._handoff_locked(conn)
+            finally:
+                self._pool_lock.release()
+            nbcreated += 1
+        return nbcreated
+
+    def _drop_info_locked(self, conn):
+        """
+        Forget the bookkeeping of a connection that is going away, along with
+        its statement cache.  The cached cursors need not be closed, they go
+        with the connection.  The pool lock must be held.
+        """
+        info = self._conninfo.pop(id(conn), None)
+        if info is not None and info.stmts is not None:
+            self._stmt_dropped.add(info.stmts.stats)
+
+    def _statement_cache(self, conn):
+        """
+        Return the statement cache of a read-write connection, or None if the
+        cache is disabled.  Only the thread that acquired the connection may
+        use it.
+        """
+        if not self._stmt_cache_size:
+            return None
+        info = self._conninfo.get(id(conn))
+        if info is None:
+            return None
+        if info.stmts is None:
+            info.stmts = StatementCache(conn, self._stmt_cache_size)
+        return info.stmts
+
+    def _ping(self, conn):
+        """
+        Run the ping statement on the given connection and return true if it
+        succeeded.
+        """
+        try:
+            curs = conn.cursor()
+            try:
+                curs.execute(self._pre_ping or self._def_ping_query)
+                curs.fetchall()
+            finally:
+                curs.close()
+            # Do not leave a transaction open on an idle connection.
+            if not self._disable_rollback:
+                conn.rollback()
+        except self.dbapi.Error:
+            return False
+        return True
+
+    def _expired(self, info, now):
+        """
+        Return true if a connection has reached its maximum lifetime or number
+        of uses.
+        """
+        return ((self._max_lifetime is not None and
+                 now - info.created >= self._max_lifetime) or
+                (self._max_uses is not None and info.uses >= self._max_uses))
+
+    def _usable(self, conn):
+        """
+        Check a connection taken from the pool before handing it out.
+        """
+        info = self._conninfo[id(conn)]
+        now = _clock()
+        if self._expired(info, now):
+            return False
+        if self._pre_ping:
+            if not self._ping(conn):
+                self._log('Ditching dead connection: %s', conn)
+                self.metrics.ditched.inc()
+                return False
+            info.checked = now
+        return True
+
+    def _replace(self, conn):
+        """
+        Close a connection that cannot be handed out and create a new one in its
+        slot.
+        """
+        self._discard(conn)
+        self._pool_lock.acquire()
+        try:
+            self._drop_info_locked(conn)
+            self.metrics.recycled.inc()
+            self._pending += 1
+        finally:
+            self._pool_lock.release()
+        return self._create_reserved()
+
+    def _discard(self, conn):
+        """
+        Close a connection that we are getting rid of, ignoring errors since it
+        may well be dead already.
+        """
+        try:
+            self._close(conn)
+        except Exception:
+            pass
+
+    def _handoff_locked(self, conn):
+        """
+        Hand a released connection to the first waiting thread, or put it back
+        in the pool if nobody is waiting.  The pool lock must be held.
+        """
+        if self._waiters:
+            waiter = self._waiters.popleft()
+            waiter.conn = conn
+            waiter.event.set()
+        else:
+            self._pool.append( (conn, _clock()) )
+
+    def _free_slot_locked(self):
+        """
+        Account for a connection that went away.  If a thread is waiting, its
+        slot is handed over to it so that it creates a new connection.  The pool
+        lock must be held.
+        """
+        if self._waiters:
+            waiter = self._waiters.popleft()
+            waiter.create = True
+            waiter.event.set()
+        else:
+            self._nbconn -= 1
+
+    def _connection_ro_crippled(self, nbcursors=0, timeout=None):
         """
         Replacement for connection_ro() that actually uses the pool to get its
         connections.  This is used when the dbapi does not allow threads to
         share a connection.
         """
-        conn = self._acquire()
+        conn = self._acquire(timeout)
         return self._add_cursors(ConnectionWrapperCrippled(conn, self),
                                  nbcursors)
 
-    def _get_connection(self):
+    def _get_connection(self, timeout=None):
         """
         Acquire a read-write connection.
         """
-        return self._acquire()
+        return self._acquire(timeout)
 
-    def connection(self, nbcursors=0, readonly=False):
+    def connection(self, nbcursors=0, readonly=False, timeout=None):
         """
         (See base class.)
         """
         if readonly:
-            return self.connection_ro(nbcursors)
+            return self.connection_ro(nbcursors, timeout)
         return self._add_cursors(
-            ConnectionWrapper(self._get_connection(), self), nbcursors)
+            ConnectionWrapper(self._get_connection(timeout), self), nbcursors)
 
     def _release_ro(self, conn):
         """
@@ -681,11 +1317,13 @@ class ConnectionPool(ConnectionPoolInterface):
         self._roconn_lock.acquire()
 
         try:
-            if conn is self._roconn:
-                assert self._roconn
+            slot = self._roconns.get(id(conn))
+            if slot is not None:
+                assert slot.conn is conn
 
-                self._roconn_refs -= 1
+                slot.refs -= 1
                 self._log('Release RO')
+                self.metrics.released.inc()
 
                 # Make sure a released connection is not blocking anything else, so
                 # rollback.  Technically this should not block anything, since the
@@ -697,85 +1335,204 @@ class ConnectionPool(ConnectionPoolInterface):
                         conn.rollback()
                 except self.dbapi.Error:
                     # This connection is hosed somehow, we should ditch it.
-                    self._log('Ditching hosed RO connection: %s' % conn)
-                    self._roconn = None
-                    self._roconn_refs = 0
+                    self._log('Ditching hosed RO connection: %s', conn)
+                    del self._roconns[id(conn)]
+                    slot.conn = None
+                    slot.refs = 0
+                    slot.endpoint.errors += 1
+                    self.metrics.ditched.inc()
             else:
                 # Ignored the release of other hosed connections.
-                self._log('Hosed connection %s released after ditched.' % conn)
+                self._log('Hosed connection %s released after ditched.', conn)
         finally:
             self._roconn_lock.release()
 
-    def _release(self, conn):
+    def _release(self, conn, clean=False):
         """
-        Release a reference to a read-and-write connection.
+        Release a reference to a read-and-write connection.  If 'clean' is
+        true, the caller has just committed or rolled back, so the rollback
+        that ends any pending transaction is skipped.
         """
-        self._pool_lock.acquire()
+        assert id(conn) not in self._roconns # Sanity check.
+
+        if id(conn) not in self._conninfo:
+            # A connection acquired before forking, which belongs to the parent.
+            self._log('Dropping inherited connection: %s', conn)
+            _detach(conn)
+            return
+
+        # Make sure a released connection is not blocking anything else.  This
+        # is done before taking the lock, so that the time it is held does not
+        # depend on a round-trip to the server.
+        hosed = False
         try:
-            self._log('Release (begin)  Pool: %d  / Created: %s' %
-                      (len(self._pool), self._nbconn))
+            if not (self._disable_rollback or clean):
+                conn.rollback()
+        except self.dbapi.Error:
+            hosed = True
 
-            # Make sure a released connection is not blocking anything else.
-            try:
-                if not self._disable_rollback:
-                    conn.rollback()
-            except self.dbapi.Error:
+        retired = None
+        self._pool_lock.acquire()
+        try:
+            self._log('Release (begin)  Pool: %d  / Created: %s',
+                      len(self._pool), self._nbconn)
+
+            now = _clock()
+            self.metrics.released.inc()
+            info = self._conninfo.get(id(conn))
+            if info is not None and info.acquired is not None:
+                self.metrics.hold_time.observe(now - info.acquired)
+                info.acquired = None
+                info.checked = now
+
+            if hosed:
                 # Oopsy, this connection is hosed somehow.  We need to ditch it.
-                self._log('Ditching hosed connection: %s' % conn)
+                self._log('Ditching hosed connection: %s', conn)
+                self.metrics.ditched.inc()
+                self._drop_info_locked(conn)
                 conn = None
-                self._nbconn -= 1
-                return
-
-            assert conn is not self._roconn # Sanity check.
-
-            self._pool.append( (conn, datetime.now()) )
-            self._scaledown()
-            assert self._pool or self._nbconn < self._maxconn
-            self._log('Release (notify)  Pool: %d  / Created: %s' %
-                      (len(self._pool), self._nbconn))
-            self._pool_lock.notify()
-            self._log('Release (notified)  Pool: %d  / Created: %s' %
-                      (len(self._pool), self._nbconn))
+                self._free_slot_locked()
+            elif info is not None and self._expired(info, now):
+                # Recycle the connection, a waiter gets to create a new one.
+                self._log('Recycling connection: %s', conn)
+                self._drop_info_locked(conn)
+                self.metrics.recycled.inc()
+                retired = conn
+                self._free_slot_locked()
+            else:
+                # Note: reaping the idle connections is left to the janitor
+                # thread, to keep the lock hold time short on this path.
+                self._handoff_locked(conn)
 
-            self._log('Release (end  )  Pool: %d  / Created: %s' %
-                      (len(self._pool), self._nbconn))
+            self._log('Release (end  )  Pool: %d  / Created: %s',
+                      len(self._pool), self._nbconn)
         finally:
             self._pool_lock.release()
 
+        if retired is not None:
+            self._discard(retired)
+
     def _scaledown(self):
         """
         Scale down the number of connection according to the following
         heuristic: we want keep a minimum number of extra connections in the
         pool ready for usage.  We delete all connections above that number if
         they have last been used beyond a fixed timeout.
+
+        The pool is sorted by release time, so the connections that can be
+        deleted are always at its head and we never need to scan it whole.
+        This is run periodically by the janitor thread.
         """
+        toclose = []
         self._pool_lock.acquire()
         try:
             self._log('Scaledown')
 
             # Calculate a recent time limit beyond which we always keep the
             # connections.
-            minkeepsecs = datetime.now() - timedelta(seconds=self._minkeepsecs)
-
-            # Calculate the number of connections that we can get rid of.
-            n = len(self._pool) - self._minconn
-            if n > 0:
-                filtered_pool = []
-                for poolitem in self._pool:
-                    conn, last_released = poolitem
-                    if n > 0 and last_released < minkeepsecs:
-                        self._close(conn)
-                        self._nbconn -= 1
-                        n -= 1
-                    else:
-                        filtered_pool.append(poolitem)
-                self._pool = filtered_pool
+            limit = _clock() - self._minkeepsecs
+
+            pool = self._pool
+            while len(pool) > self._minconn and pool[0][1] < limit:
+                conn, last_released = pool.popleft()
+                self._drop_info_locked(conn)
+                toclose.append(conn)
+                self._nbconn -= 1
+        finally:
+            self._pool_lock.release()
+
+        # Closing may involve a round-trip to the server, do it unlocked.
+        for conn in toclose:
+            self._close(conn)
+        return len(toclose)
+
+    def _check_idle(self):
+        """
+        Recycle the idle connections that reached their maximum lifetime, and
+        ping those that have not been used or checked for 'keepalive_secs',
+        closing the dead ones.  This is run periodically by the janitor thread.
+        Returns the number of connections that were closed.
+        """
+        if self._max_lifetime is None and not self._keepalive_secs:
+            return 0
+
+        # Take the connections to check out of the pool, so that nobody else
+        # can get them while we are pinging them without the lock.
+        expired, tocheck = [], []
+        self._pool_lock.acquire()
+        try:
+            now = _clock()
+            keep = deque()
+            for item in self._pool:
+                info = self._conninfo[id(item[0])]
+                if self._expired(info, now):
+                    expired.append(item)
+                elif (self._keepalive_secs and
+                      now - info.checked >= self._keepalive_secs):
+                    tocheck.append(item)
+                else:
+                    keep.append(item)
+            self._pool = keep
         finally:
             self._pool_lock.release()
 
-        # Note: we could keep the pool sorted by last_released to minimize the
-        # scaledown time, so that the first items in the pool are always the
-        # oldest, the most likely to be deletable.
+        alive, dead = [], []
+        for item in tocheck:
+            if self._ping(item[0]):
+                alive.append(item)
+            else:
+                dead.append(item)
+
+        self._pool_lock.acquire()
+        try:
+            now = _clock()
+            for conn, last_released in alive:
+                self._conninfo[id(conn)].checked = now
+            if self._waiters:
+                for conn, last_released in alive:
+                    self._handoff_locked(conn)
+            else:
+                # Put them back in their place, the pool stays sorted.
+                self._pool = deque(sorted(list(self._pool) + alive,
+                                          key=lambda item: item[1]))
+            self.metrics.recycled.inc(len(expired))
+            self.metrics.ditched.inc(len(dead))
+            for conn, last_released in expired + dead:
+                self._drop_info_locked(conn)
+                self._free_slot_locked()
+        finally:
+            self._pool_lock.release()
+
+        for conn, last_released in expired + dead:
+            self._discard(conn)
+        return len(expired) + len(dead)
+
+    def _housekeep(self):
+        """
+        The periodic work of the janitor thread.
+        """
+        self._scaledown()
+        self._check_idle()
+        if self._prewarm and not self._prewarm_deferred:
+            self._fill()
+
+    def _start_janitor(self):
+        """
+        Start the daemon thread that periodically reaps the idle connections.
+        The thread only holds a weak reference to the pool, so that it does not
+        keep it alive, and exits once the pool is gone.
+        """
+        intervals = [secs for secs in (self._reapsecs, self._keepalive_secs)
+                     if secs]
+        if not intervals:
+            return
+        self._janitor_stop = threading.Event()
+        janitor = threading.Thread(target=_janitor,
+                                   args=(weakref.ref(self), min(intervals),
+                                         self._janitor_stop),
+                                   name='antipool-janitor')
+        janitor.daemon = True
+        janitor.start()
 
     def finalize(self):
         """
@@ -794,27 +1551,31 @@ class ConnectionPool(ConnectionPoolInterface):
         self._roconn_lock.acquire()
         self._pool_lock.acquire()
         try:
-            if not self._pool and not self._roconn:
+            if not self._pool and not self._roconns:
                 assert self._nbconn == 0
                 return # Already finalized.
 
             # Check that all the connections have been returned to us.
             assert len(self._pool) == self._nbconn
 
-            assert self._roconn_refs == 0
-            if self._roconn is not None:
-                self._close(self._roconn)
-                self._roconn = None
+            for slot in self._roslots:
+                assert slot.refs == 0
+                if slot.conn is not None:
+                    self._close(slot.conn)
+                    slot.conn = None
+            self._roconns = {}
 
             # Release all the read-write pool's connections.
             for conn, last_released in self._pool:
                 self._close(conn)
 
             poolsize = len(self._pool)
-            self._pool = []
+            for conn, last_released in self._pool:
+                self._drop_info_locked(conn)
+            self._pool = deque()
 
-            self._log('Finalize  Pool: %d  / Created: %s' %
-                      (poolsize, self._nbconn))
+            self._log('Finalize  Pool: %d  / Created: %s',
+                      poolsize, self._nbconn)
 
             # Reset statistics.
             self._nbconn = 0
@@ -826,49 +1587,598 @@ class ConnectionPool(ConnectionPoolInterface):
         """
         Destructor.
         """
+        # (The constructor may have failed before starting the janitor.)
+        janitor_stop = getattr(self, '_janitor_stop', None)
+        if janitor_stop is not None:
+            janitor_stop.set()
         self.finalize()
 
-    def getstats(self):
+    def getstats(self, extended=False):
         """
         Return internal statistics.  This is used for producing graphs depicting
         resource requirements over time.  Returns the total number of
-        connections open (including the RO connection) and the current number of
-        connections held in the internal pool.
+        connections open (including the RO connections) and the current number
+        of connections held in the internal pool.
+
+        With 'extended', return a dict with these two counts ('total' and
+        'pool_size'), the number of connections being opened and of threads
+        waiting for a connection, the number of acquisitions that timed out, of
+        connections recycled and ditched, snapshots of the wait time and hold
+        time histograms (see Histogram.snapshot()), the statistics of each read
+        endpoint ('read_endpoints', see _Endpoint.stats()) and of the statement
+        caches.
+
+        This does not take the pool locks, so the numbers are only consistent
+        with each other up to the acquisitions and releases that happen while
+        they are read.
         """
-        total_conn = 0
-        self._roconn_lock.acquire()
-        try:
-            if self._roconn:
-                total_conn += 1
-        finally:
-            self._roconn_lock.release()
-
-        self._pool_lock.acquire()
-        total_conn += self._nbconn
-        try:
-            pool_size = len(self._pool)
-        finally:
-            self._pool_lock.release()
+        total_conn = len(self._roconns) + self._nbconn
+        pool_size = len(self._pool)
+        if not extended:
+            return total_conn, pool_size
+
+        metrics = self.metrics
+        return {'total': total_conn,
+                'pool_size': pool_size,
+                'pending': self._pending,
+                'waiting': len(self._waiters),
+                'timeouts': metrics.timeouts.value,
+                'recycled': metrics.recycled.value,
+                'ditched': metrics.ditched.value,
+                'wait_time': metrics.acquire_time.snapshot(),
+                'hold_time': metrics.hold_time.snapshot(),
+                'read_endpoints': [endpoint.stats()
+                                   for endpoint in self._roendpoints],
+                'stmt_cache': self._stmt_cache_stats()}
+
+    def gauges(self):
+        """
+        Return the current number of read-write connections in use, of idle
+        ones, of ones being opened, of threads waiting for a connection and of
+        open read-only connections, as a dict.  This does not take the pool locks.
+        """
+        nbconn, idle, pending = self._nbconn, len(self._pool), self._pending
+        return {'in_use': max(nbconn - idle - pending, 0),
+                'idle': idle,
+                'pending': pending,
+                'waiting': len(self._waiters),
+                'read_connections': len(self._roconns)}
+
+    def exposition(self, prefix='antipool', labels=None):
+        """
+        Return the metrics of the pool in the Prometheus text exposition format,
+        with the metric names starting with 'prefix' and the given labels (a
+        dict) on every sample, e.g. to tell several pools apart.
+        """
+        return self.metrics.exposition(self.gauges(), prefix, labels)
 
-        return total_conn, pool_size
+    def _stmt_cache_stats(self):
+        """
+        Return the statistics of the statement caches of all the connections,
+        including those that are gone.
+        """
+        stats = StatementCache.Stats()
+        stats.add(self._stmt_dropped)
+        # (Copying the values is atomic, iterating over the dict is not.)
+        for info in list(self._conninfo.values()):
+            if info.stmts is not None:
+                stats.add(info.stmts.stats)
+        return stats.asdict()
 
     def forget_connections(self):
         """
         Forget all the existing connections and close the sockets.  This MUST be
-        called from a child process right after forking.
+        called from a child process right after forking, which is done
+        automatically (see the section on forking at the top).
+
+        The connections themselves are not closed, because that would terminate
+        the database sessions of the parent process.  The locks are not taken
+        either, they may have been held by threads that do not exist in the
+        child.
         """
+        for slot in self._roslots:
+            if slot.conn is not None:
+                _detach(slot.conn)
+            slot.conn = None
+            slot.refs = 0
+            slot.opening = None
+        for endpoint in self._roendpoints:
+            endpoint.acquired = endpoint.errors = 0
+        for conn, last_released in self._pool:
+            _detach(conn)
+
         self._roconn_lock = threading.Lock()
-        self._pool_lock = threading.Condition(threading.RLock())
+        self._pool_lock = threading.RLock()
 
-        self._roconn = None
-        self._pool = []
+        self._roconns = {}
+        self._pool = deque()
+        self._waiters = deque()
+        self._conninfo = {}
         self._nbconn = 0
+        self._pending = 0
+
+        self.metrics = PoolMetrics()
+        self._stmt_dropped = StatementCache.Stats()
+
+        # Start a new janitor thread, the one of the parent did not survive the
+        # fork (stop it if we are called in the same process).
+        if self._janitor_stop is not None and self._pid == os.getpid():
+            self._janitor_stop.set()
+        self._start_janitor()
+        self._pid = os.getpid()
+        self._prewarm_deferred = self._prewarm
+
+
+_pools = weakref.WeakSet()
+"""All the connection pools of the process, to reset after forking."""
+
+_orphans = []
+"""Inherited connections whose socket could not be detached.  They are kept
+alive for the life of the process, so that collecting them does not close the
+database sessions of the parent."""
+
+def _detach(conn):
+    """
+    Detach a connection inherited from the parent process.  Its socket is
+    replaced with /dev/null, so that this process no longer holds a reference to
+    the parent's socket and whatever the driver writes to it when the connection
+    gets closed or collected goes nowhere.  This beats closing the descriptor,
+    whose number could then be reused by a new connection of this process.
+    """
+    fileno = getattr(conn, 'fileno', None)
+    try:
+        fd = fileno()
+    except Exception:
+        # Not a file-based driver, or we cannot tell.
+        _orphans.append(conn)
+        return
+    devnull = os.open(os.devnull, os.O_RDWR)
+    try:
+        os.dup2(devnull, fd)
+    finally:
+        os.close(devnull)
+
+def _after_fork():
+    """
+    Reset all the connection pools in a new child process.
+    """
+    for pool in list(_pools):
+        pool.forget_connections()
+
+_check_fork = not hasattr(os, 'register_at_fork')
+"""True if the pools must check the process id themselves."""
+if not _check_fork:
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+
+
+class _Endpoint(object):
+    """
+    A read endpoint: the connection parameters that override those of the pool,
+    the slots of its shared read-only connections, and statistics on its use.
+    """
+    def __init__(self, overrides, nbslots):
+        assert nbslots > 0
+        self.overrides = dict(overrides)
+        self.name = self.overrides.get('host') or 'primary'
+        self.slots = [_ROSlot(self) for i in xrange(nbslots)]
+        self.acquired = 0
+        self.errors = 0
+
+    def outstanding(self):
+        """
+        Return the number of requests currently using this endpoint.
+        """
+        return sum(slot.refs for slot in self.slots)
+
+    def stats(self):
+        """
+        Return the statistics of this endpoint as a dict: its 'name', the
+        number of open 'connections', of 'outstanding' requests, of requests
+        that 'acquired' one of its connections, and of 'errors' (connections
+        that could not be opened or got ditched).
+        """
+        return {'name': self.name,
+                'connections': sum(1 for slot in self.slots
+                                   if slot.conn is not None),
+                'outstanding': self.outstanding(),
+                'acquired': self.acquired,
+                'errors': self.errors}
+
+
+class _ROSlot(object):
+    """
+    A shared read-only connection, opened on demand, and the number of
+    references to it that were handed to clients.  While the connection is
+    being opened, 'opening' is an event set once it is done.
+    """
+    __slots__ = ('endpoint', 'conn', 'refs', 'opening')
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.conn = None
+        self.refs = 0
+        self.opening = None
+
+
+class _ConnInfo(object):
+    """
+    Bookkeeping for a read-write connection of the pool: when it was created,
+    how many times it was handed out, when it was last acquired (None while it
+    is idle), when it was last known to be alive, and its statement cache.
+    """
+    __slots__ = ('created', 'uses', 'acquired', 'checked', 'stmts')
+
+    def __init__(self, now):
+        self.created = now
+        self.uses = 0
+        self.acquired = None
+        self.checked = now
+        self.stmts = None
+
+
+class StatementCache(object):
+    """
+    A bounded LRU of the cursors of a connection, keyed by query text.  Each
+    cursor is prepared when it is created if the driver supports it, i.e. if
+    the cursor has a prepare() method (as in the Oracle drivers), in which case
+    it is executed with a None statement and the server does not parse the
+    query again.  Other drivers, psycopg2 among them, only save creating a
+    cursor: every execute is still parsed and planned by the server.  A cached
+    cursor is lent to one CachingCursor at a time.
+    """
+    class Stats(object):
+        """
+        Counters of cache hits, misses and evictions.
+        """
+        __slots__ = ('hits', 'misses', 'evictions')
+
+        def __init__(self):
+            self.hits = self.misses = self.evictions = 0
+
+        def add(self, other):
+            self.hits += other.hits
+            self.misses += other.misses
+            self.evictions += other.evictions
+
+        def asdict(self):
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def __init__(self, conn, size):
+        assert size > 0
+        self._conn = conn
+        self._size = size
+        self._entries = OrderedDict()
+        """Cache entries by query text, least recently used first.  Each entry
+        is a [cursor, prepared, lease] list, where the lease is the token of
+        the borrower while the cursor is lent, and None otherwise."""
+        self.stats = StatementCache.Stats()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def checkout(self, query, lease):
+        """
+        Lend the cursor of a query under the given lease token, creating it if
+        needed.  Returns the cache entry, or None if the cursor is already lent.
+        """
+        entry = self._entries.pop(query, None)
+        if entry is not None:
+            self._entries[query] = entry
+            if entry[2] is not None:
+                self.stats.misses += 1
+                return None
+            self.stats.hits += 1
+        else:
+            self.stats.misses += 1
+            curs = self._conn.cursor()
+            prepare = getattr(curs, 'prepare', None)
+            if prepare is not None:
+                prepare(query)
+            entry = [curs, prepare is not None, None]
+            self._entries[query] = entry
+            self._evict()
+        entry[2] = lease
+        return entry
+
+    def checkin(self, entry, lease):
+        """
+        Return a lent cursor, unless it was since lent to someone else.
+        """
+        if entry[2] is lease:
+            entry[2] = None
 
-## FIXME: todo, close the file descriptors (unix ::close()
-## FIXME: continue this, you need to fix the test: test_fork.py
+    def checkin_all(self):
+        """
+        Return all the lent cursors, when the connection is released.
+        """
+        for entry in self._entries.values():
+            entry[2] = None
 
+    def _evict(self):
+        """
+        Close the least recently used cursors that are not lent, beyond the
+        size of the cache.
+        """
+        excess = len(self._entries) - self._size
+        if excess <= 0:
+            return
+        for query, entry in list(self._entries.items()):
+            if entry[2] is None:
+                del self._entries[query]
+                self.stats.evictions += 1
+                try:
+                    entry[0].close()
+                except Exception:
+                    pass
+                excess -= 1
+                if excess == 0:
+                    break
 
 
+class CachingCursor(object):
+    """
+    A cursor of a pooled connection that runs each query on the cursor cached
+    for it in the connection's StatementCache, or on a cursor of its own if that
+    one is in use.  The other attributes are those of the cursor that ran the
+    last query.
+    """
+    def __init__(self, conn, cache):
+        self._conn = conn
+        self._cache = cache
+        self._lease = object()
+        self._entry = None
+        self._curs = None
+
+    def _cursor(self):
+        if self._curs is None:
+            self._curs = self._conn.cursor()
+        return self._curs
+
+    def _checkin(self):
+        if self._entry is not None:
+            self._cache.checkin(self._entry, self._lease)
+            self._entry = None
+        self._curs = None
+
+    def _use(self, query):
+        """
+        Switch to the cursor for 'query' and return the statement to run on it.
+        """
+        self._checkin()
+        entry = self._cache.checkout(query, self._lease)
+        if entry is None:
+            self._curs = self._conn.cursor()
+            return query
+        self._entry = entry
+        self._curs = entry[0]
+        if entry[1]:
+            return None
+        return query
+
+    def execute(self, query, *args):
+        statement = self._use(query)
+        return self._curs.execute(statement, *args)
+
+    def executemany(self, query, seq_of_args):
+        statement = self._use(query)
+        return self._curs.executemany(statement, seq_of_args)
+
+    def close(self):
+        self._checkin()
+
+    def __del__(self):
+        # Cursors are commonly dropped without being closed.
+        if self._entry is not None:
+            self._cache.checkin(self._entry, self._lease)
+
+    def __iter__(self):
+        return iter(self._cursor())
+
+    def __getattr__(self, name):
+        return getattr(self._cursor(), name)
+
+
+class _Waiter(object):
+    """
+    A thread waiting in line for a connection.  The thread that releases a
+    connection either hands it over in 'conn', or sets 'create' to hand over the
+    slot of a connection it ditched.
+    """
+    __slots__ = ('event', 'conn', 'create')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.conn = None
+        self.create = False
+
+
+class Counter(object):
+    """
+    A counter that threads can increment concurrently.  It has a lock of its
+    own, so that the pool need not hold its lock to count, nor to read it.
+    """
+    __slots__ = ('_value', '_lock')
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        self._lock.acquire()
+        try:
+            self._value += n
+        finally:
+            self._lock.release()
+
+    @property
+    def value(self):
+        return self._value
+
+
+class Histogram(object):
+    """
+    A histogram of durations in seconds, with fixed bucket upper bounds.  The
+    pool records its observations with its lock held, but they can be read at
+    any time.
+    """
+    _def_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self._def_buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        Record a duration.
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        """
+        Return a dict with the number of observations ('count'), their total
+        ('sum') and the cumulative count of observations less or equal to each
+        bucket bound ('buckets', a list of (bound, count) pairs ending with the
+        infinite bound).
+        """
+        counts = list(self.counts)
+        buckets, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {'count': cumulative, 'sum': self.sum, 'buckets': buckets}
+
+
+class PoolMetrics(object):
+    """
+    The metrics of a connection pool: counters of connection events and
+    histograms of the time spent acquiring and holding connections.  All of
+    them can be read without taking the pool locks.
+    """
+    counters = (
+        ('created', 'connections_created', "Connections opened to the database."),
+        ('closed', 'connections_closed', "Connections closed by the pool."),
+        ('ditched', 'connections_ditched',
+         "Connections dropped because they were found hosed or dead."),
+        ('recycled', 'connections_recycled',
+         "Connections replaced after reaching their maximum lifetime or uses."),
+        ('acquired', 'connections_acquired', "Connections handed out."),
+        ('released', 'connections_released',
+         "Connections released to the pool."),
+        ('timeouts', 'acquire_timeouts',
+         "Acquisitions that timed out waiting for a connection."),
+        )
+    """The counters, as (attribute, metric name, help) triples."""
+
+    gauges = (
+        ('in_use', 'connections_in_use',
+         "Read-write connections currently handed out."),
+        ('idle', 'connections_idle', "Read-write connections in the pool."),
+        ('pending', 'connections_pending',
+         "Read-write connections being opened."),
+        ('waiting', 'waiting_threads', "Threads waiting for a connection."),
+        ('read_connections', 'read_connections',
+         "Open shared read-only connections."),
+        )
+    """The gauges, see ConnectionPool.gauges()."""
+
+    histograms = (
+        ('acquire_time', 'acquire_seconds',
+         "Time spent acquiring a read-write connection."),
+        ('hold_time', 'hold_seconds',
+         "Time read-write connections are held for."),
+        )
+
+    def __init__(self):
+        for attr, name, help in self.counters:
+            setattr(self, attr, Counter())
+        for attr, name, help in self.histograms:
+            setattr(self, attr, Histogram())
+
+    def exposition(self, gauges, prefix='antipool', labels=None):
+        """
+        Return the metrics, and the given gauge values, in the Prometheus text
+        exposition format.
+        """
+        labels = sorted((labels or {}).items())
+
+        def sample(name, value, extra=()):
+            pairs = ['%s="%s"' % (key, _escape_label(val))
+                     for key, val in labels + list(extra)]
+            return '%s%s %s' % (name, pairs and '{%s}' % ','.join(pairs) or '',
+                                _format_value(value))
+
+        lines = []
+        for attr, name, help in self.counters:
+            name = '%s_%s_total' % (prefix, name)
+            lines.extend(('# HELP %s %s' % (name, help),
+                          '# TYPE %s counter' % name,
+                          sample(name, getattr(self, attr).value)))
+        for attr, name, help in self.gauges:
+            name = '%s_%s' % (prefix, name)
+            lines.extend(('# HELP %s %s' % (name, help),
+                          '# TYPE %s gauge' % name,
+                          sample(name, gauges[attr])))
+        for attr, name, help in self.histograms:
+            name = '%s_%s' % (prefix, name)
+            snapshot = getattr(self, attr).snapshot()
+            lines.extend(('# HELP %s %s' % (name, help),
+                          '# TYPE %s histogram' % name))
+            for bound, count in snapshot['buckets']:
+                lines.append(sample(name + '_bucket', count,
+                                    [('le', _format_value(bound))]))
+            lines.append(sample(name + '_sum', snapshot['sum']))
+            lines.append(sample(name + '_count', snapshot['count']))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    """
+    Escape a label value for the exposition format.
+    """
+    return (str(value).replace('\\', '\\\\')
+            .replace('"', '\\"').replace('\n', '\\n'))
+
+def _format_value(value):
+    """
+    Format a sample value or bucket bound for the exposition format.
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+def _prewarmer(poolref):
+    """
+    Body of the thread that opens the first connections of a pool.
+    """
+    pool = poolref()
+    if pool is not None:
+        pool._fill()
+
+
+def _janitor(poolref, interval, stop):
+    """
+    Body of the janitor thread of a connection pool.
+    """
+    while not stop.wait(interval):
+        pool = poolref()
+        if pool is None:
+            return
+        try:
+            pool._housekeep()
+        except Exception as e:
+            pool._log('Janitor error: %s', e)
+        del pool
+
 
 class ConnectionWrapperRO(object):
     """
@@ -894,6 +2204,7 @@ class ConnectionWrapperRO(object):
         assert conn
         self._conn = conn
         self._connpool = pool
+        self._end_callbacks = []
 
     def __del__(self):
         if self._conn:
@@ -908,13 +2219,33 @@ class ConnectionWrapperRO(object):
         else:
             return self._conn
 
-    def release(self):
-        self._release_impl(self._getconn())
-        self._connpool = self._conn = None
+    def release(self, clean=False):
+        """
+        Release the connection to the pool.  Set 'clean' if you have just
+        committed or rolled back, to save the pool a rollback.
+        """
+        conn = self._getconn()
+        try:
+            self._transaction_ended()
+        finally:
+            self._release_impl(conn, clean)
+            self._connpool = self._conn = None
 
-    def _release_impl(self, conn):
+    def _release_impl(self, conn, clean):
         self._connpool._release_ro(conn)
 
+    def on_transaction_end(self, callback):
+        """
+        Call 'callback' without arguments whenever the transaction of this
+        connection ends, i.e. on commit(), rollback() and release().  This lets
+        the caches of what was read in a transaction (e.g. antiorm's) forget it.
+        """
+        self._end_callbacks.append(callback)
+
+    def _transaction_ended(self):
+        for callback in self._end_callbacks:
+            callback()
+
     def cursor(self, *args, **kw):
         return self._getconn().cursor(*args, **kw)
 
@@ -922,7 +2253,10 @@ class ConnectionWrapperRO(object):
         raise Error("Error: You cannot commit on a read-only connection.")
 
     def rollback(self):
-        return self._getconn().rollback()
+        try:
+            return self._getconn().rollback()
+        finally:
+            self._transaction_ended()
 
     # Support for the context object.
 
@@ -935,10 +2269,21 @@ class ConnectionWrapperRO(object):
 class ConnectionWrapperCrippled(ConnectionWrapperRO):
     """
     A wrapper object that releases to the pool.  It still does not provide a
-    commit() method however.
+    commit() method however.  If the pool has a statement cache, its cursors
+    are CachingCursor objects.
     """
-    def _release_impl(self, conn):
-        self._connpool._release(conn)
+    def _release_impl(self, conn, clean):
+        cache = self._connpool._statement_cache(conn)
+        if cache is not None:
+            cache.checkin_all()
+        self._connpool._release(conn, clean)
+
+    def cursor(self, *args, **kw):
+        conn = self._getconn()
+        cache = self._connpool._statement_cache(conn)
+        if cache is None or args or kw:
+            return conn.cursor(*args, **kw)
+        return CachingCursor(conn, cache)
 
 class ConnectionWrapper(ConnectionWrapperCrippled):
     """
@@ -946,16 +2291,23 @@ class ConnectionWrapper(ConnectionWrapperCrippled):
     method.  See ConnectionWrapperRO for more details.
     """
     def commit(self):
-        return self._getconn().commit()
+        try:
+            return self._getconn().commit()
+        finally:
+            self._transaction_ended()
 
     # Support for the context object.
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type is None:
-            self.commit()
-        else:
-            self.rollback()
-        self.release()
+        clean = False
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+            clean = True
+        finally:
+            self.release(clean)
 
 
 class Error(Exception):
@@ -963,4 +2315,9 @@ class Error(Exception):
     Error for connection wrappers.
     """
 
+class PoolTimeout(Error):
+    """
+    Error raised when no connection could be acquired within the timeout.
+    """
+
 
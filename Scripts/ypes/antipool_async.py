@@ -0,0 +1,415 @@
+"""
+An asyncio counterpart of antipool.ConnectionPool.
+
+The threaded pool blocks the calling thread while it waits for a connection and
+while the driver talks to the database, which ties up one thread per request in
+an asyncio application.  This pool hands out connections to the tasks of a
+single event loop instead::
+
+    pool = AsyncConnectionPool(dbapi, {'maxconn': 10}, database='test')
+
+    async with pool.connection() as conn:
+        cursor = await conn.cursor()
+        await cursor.execute('SELECT ...')
+        rows = await cursor.fetchall()
+
+As with antipool.ConnectionWrapper, leaving the 'async with' block commits,
+or rolls back if an exception was raised, and releases the connection.  You
+can also 'await pool.connection()' and call 'await conn.release()' yourself.
+
+Drivers
+-------
+
+Blocking DBAPI-2.0 drivers are supported by running each of their calls in an
+executor: the 'executor' option, or else a thread pool with one thread per
+connection when 'maxconn' is set, or else the event loop's default executor.
+Calls for a given connection are always awaited one at a time, but may run on
+different threads of the executor, so the driver must allow that (e.g. sqlite3
+needs check_same_thread=False).
+
+Native async drivers, whose connect() and connection and cursor methods
+return awaitables, are awaited directly.  They are detected when connect() is
+a coroutine function; drivers whose connect() is a plain function returning an
+awaitable connection (e.g. aiosqlite) need the 'native' option set to True.
+
+The pool is not thread-safe; use it from the event loop that created its
+connections.
+"""
+
+import asyncio, functools, inspect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic as _clock
+
+from antipool import ConnectionPool, Error, PoolTimeout
+
+
+__all__ = ('AsyncConnectionPool', 'AsyncConnectionWrapper',
+           'AsyncCursorWrapper')
+
+
+_CREATE = object()
+"""Handed to a waiter instead of a connection, to hand over the slot of a
+connection that was ditched."""
+
+
+class AsyncConnectionPool(object):
+    """
+    A pool of database connections that can be shared by the tasks of an
+    asyncio event loop.
+    """
+    _def_minconn = ConnectionPool._def_minconn
+    _def_maxconn = ConnectionPool._def_maxconn
+    _def_minkeepsecs = ConnectionPool._def_minkeepsecs
+    _def_disable_rollback = ConnectionPool._def_disable_rollback
+    _def_acquire_timeout = ConnectionPool._def_acquire_timeout
+
+    def __init__(self, dbapi, options=None, **params):
+        """
+        'dbapi': the DBAPI-2.0 module interface for creating connections, or an
+          async driver module.
+        'minconn', 'maxconn', 'minkeepsecs', 'disable_rollback',
+        'isolation_level', 'acquire_timeout': see antipool.ConnectionPool.
+        'executor': the executor that runs the calls of a blocking driver
+          (None means a thread per connection if 'maxconn' is set, the event
+          loop's default executor otherwise).
+        'native': whether the driver is natively asynchronous (None means
+          detect it from dbapi.connect).
+        '**params': connection parameters for creating a new connection.
+        """
+        self.dbapi = dbapi
+        """The DBAPI-2.0 module interface."""
+
+        self._params = params
+        if not params:
+            raise Error("You need to specify valid connection parameters in "
+                        "order to create a connection pool.")
+        """The parameters for creating a connection."""
+
+        self._pool = deque()
+        """A pool of idle connections, as (connection, last released time)
+        pairs sorted by release time, oldest first."""
+
+        self._waiters = deque()
+        """Futures of the tasks waiting for a connection, in arrival order."""
+
+        self._nbconn = 0
+        """The total number of database connections that were handed out."""
+
+        if options is None:
+            options = {}
+
+        self._minconn = options.pop('minconn', self._def_minconn)
+        self._maxconn = options.pop('maxconn', self._def_maxconn)
+        assert self._maxconn is None or self._maxconn > 0
+        self._minkeepsecs = options.pop('minkeepsecs', self._def_minkeepsecs)
+        self._disable_rollback = options.pop('disable_rollback',
+                                             self._def_disable_rollback)
+        self._isolation_level = options.pop('isolation_level', None)
+        self._acquire_timeout = options.pop('acquire_timeout',
+                                            self._def_acquire_timeout)
+        self._native = options.pop('native', None)
+        if self._native is None:
+            self._native = inspect.iscoroutinefunction(dbapi.connect)
+
+        self._executor = options.pop('executor', None)
+        self._own_executor = False
+        """Did we create the executor, and have to shut it down?"""
+        if (self._executor is None and not self._native and
+            self._maxconn is not None):
+            # The default executor is usually smaller than the pool, which would
+            # then be throttled by it.
+            self._executor = ThreadPoolExecutor(
+                self._maxconn, thread_name_prefix='antipool')
+            self._own_executor = True
+
+        self._error = getattr(dbapi, 'Error', Exception)
+
+    async def _call(self, fun, *args, **kwds):
+        """
+        Call a function of the driver, in the executor if it is blocking.
+        """
+        if self._native:
+            result = fun(*args, **kwds)
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fun, *args, **kwds))
+
+    async def _create_connection(self):
+        """
+        Create a new connection to the database.
+        """
+        newconn = await self._call(self.dbapi.connect, **self._params)
+        if not self._native and inspect.isawaitable(newconn):
+            if inspect.iscoroutine(newconn):
+                newconn.close()
+            raise Error("The driver returned an awaitable connection, set the "
+                        "'native' option to True.")
+
+        # Set the isolation level if specified in the options.
+        if self._isolation_level is not None:
+            await self._call(newconn.set_isolation_level, self._isolation_level)
+        return newconn
+
+    async def _discard(self, conn):
+        """
+        Close a connection that we are getting rid of, ignoring errors.
+        """
+        try:
+            await self._call(conn.close)
+        except Exception:
+            pass
+
+    def connection(self, timeout=None):
+        """
+        Acquire a connection, for use with 'async with' or 'await'.  If the
+        pool is exhausted, wait at most 'timeout' seconds for a connection to be
+        released (None means the pool's default) and raise PoolTimeout
+        otherwise.
+        """
+        return _AcquireContext(self, timeout)
+
+    async def _acquire(self, timeout=None):
+        """
+        Acquire a raw connection from the pool.  Tasks that have to wait are
+        served in order.
+        """
+        if timeout is None:
+            timeout = self._acquire_timeout
+
+        if self._pool:
+            conn, last_released = self._pool.pop()
+            return conn
+
+        if self._maxconn is None or self._nbconn < self._maxconn:
+            self._nbconn += 1
+            return await self._create_reserved()
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait((waiter,), timeout=timeout)
+        except BaseException:
+            # We were cancelled, give back anything that was handed to us.
+            if waiter.done():
+                self._giveback(waiter.result())
+            else:
+                self._waiters.remove(waiter)
+                waiter.cancel()
+            raise
+
+        if not waiter.done():
+            self._waiters.remove(waiter)
+            waiter.cancel()
+            raise PoolTimeout(
+                "Timed out after %s seconds waiting for one of the %s "
+                "connections of the pool." % (timeout, self._maxconn))
+
+        conn = waiter.result()
+        if conn is _CREATE:
+            conn = await self._create_reserved()
+        return conn
+
+    async def _create_reserved(self):
+        """
+        Create a connection in a slot that was already accounted for.
+        """
+        try:
+            return await self._create_connection()
+        except BaseException:
+            self._free_slot()
+            raise
+
+    def _handoff(self, conn):
+        """
+        Hand a connection to the first waiting task, or put it back in the pool
+        if nobody is waiting.
+        """
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(conn)
+                return
+        self._pool.append( (conn, _clock()) )
+
+    def _free_slot(self):
+        """
+        Account for a connection that went away, handing its slot over to the
+        first waiting task if there is one.
+        """
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(_CREATE)
+                return
+        self._nbconn -= 1
+
+    def _giveback(self, conn):
+        """
+        Return something that was handed to a task that did not get to use it.
+        """
+        if conn is _CREATE:
+            self._free_slot()
+        else:
+            self._handoff(conn)
+
+    async def _release(self, conn):
+        """
+        Release a raw connection to the pool.
+        """
+        hosed = False
+        try:
+            if not self._disable_rollback:
+                await self._call(conn.rollback)
+        except self._error:
+            hosed = True
+
+        if hosed:
+            # This connection is hosed somehow, ditch it.
+            self._free_slot()
+            await self._discard(conn)
+        else:
+            self._handoff(conn)
+            await self._scaledown()
+
+    async def _scaledown(self):
+        """
+        Close the idle connections in excess of 'minconn' that have not been
+        used for 'minkeepsecs'.  The pool is sorted by release time so they are
+        always at its head.
+        """
+        limit = _clock() - self._minkeepsecs
+        toclose = []
+        while len(self._pool) > self._minconn and self._pool[0][1] < limit:
+            conn, last_released = self._pool.popleft()
+            toclose.append(conn)
+            self._nbconn -= 1
+        for conn in toclose:
+            await self._discard(conn)
+
+    async def finalize(self):
+        """
+        Finalize the pool, which closes the remaining open connections, and
+        shuts down the executor if the pool created it.
+        """
+        assert len(self._pool) == self._nbconn
+        while self._pool:
+            conn, last_released = self._pool.popleft()
+            self._nbconn -= 1
+            await self._discard(conn)
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+    def getstats(self):
+        """
+        Return the total number of connections open and the current number of
+        connections held in the pool.
+        """
+        return self._nbconn, len(self._pool)
+
+
+class _AcquireContext(object):
+    """
+    The result of AsyncConnectionPool.connection(), which can be awaited or
+    used with 'async with'.
+    """
+    def __init__(self, pool, timeout):
+        self._pool = pool
+        self._timeout = timeout
+        self._conn = None
+
+    async def _get(self):
+        conn = await self._pool._acquire(self._timeout)
+        return AsyncConnectionWrapper(conn, self._pool)
+
+    def __await__(self):
+        return self._get().__await__()
+
+    async def __aenter__(self):
+        self._conn = await self._get()
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._conn.__aexit__(exc_type, exc_value, traceback)
+
+
+class AsyncConnectionWrapper(object):
+    """
+    A wrapper object that behaves like a database connection, with coroutine
+    methods.  You cannot close() this explicitly, you should call release().
+    """
+    def __init__(self, conn, pool):
+        assert conn
+        self._conn = conn
+        self._connpool = pool
+
+    def _getconn(self):
+        if self._conn is None:
+            raise Error("Error: Connection already closed.")
+        else:
+            return self._conn
+
+    async def release(self):
+        conn, pool = self._getconn(), self._connpool
+        self._connpool = self._conn = None
+        await pool._release(conn)
+
+    async def cursor(self, *args, **kw):
+        conn = self._getconn()
+        curs = await self._connpool._call(conn.cursor, *args, **kw)
+        return AsyncCursorWrapper(curs, self._connpool)
+
+    async def commit(self):
+        return await self._connpool._call(self._getconn().commit)
+
+    async def rollback(self):
+        return await self._connpool._call(self._getconn().rollback)
+
+    # Support for the context object.
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                await self.commit()
+            else:
+                await self.rollback()
+        finally:
+            await self.release()
+
+
+class AsyncCursorWrapper(object):
+    """
+    A wrapper object that behaves like a database cursor, with coroutine
+    methods.  The other attributes (e.g. description, rowcount) are those of
+    the wrapped cursor.
+    """
+    def __init__(self, curs, pool):
+        self._curs = curs
+        self._connpool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._curs, name)
+
+    async def execute(self, *args):
+        return await self._connpool._call(self._curs.execute, *args)
+
+    async def executemany(self, *args):
+        return await self._connpool._call(self._curs.executemany, *args)
+
+    async def fetchone(self):
+        return await self._connpool._call(self._curs.fetchone)
+
+    async def fetchmany(self, *args):
+        return await self._connpool._call(self._curs.fetchmany, *args)
+
+    async def fetchall(self):
+        return await self._connpool._call(self._curs.fetchall)
+
+    async def close(self):
+        return await self._connpool._call(self._curs.close)
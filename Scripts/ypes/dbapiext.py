@@ -15,6 +15,9 @@ INSERT statement.
 
 For performance, the results of analysing and preparing the query is kept in a
 cache and reused on subsequence calls, similarly to the re or struct library.
+The cache is bounded (see set_cache_size()) and discards the least recently
+used queries first; queries that are known to be hot can be compiled ahead of
+time with precompile().
 
 (This is intended to become a reference implementation for a proposal for an
 extension to tbe DBAPI-2.0.)
@@ -45,6 +48,12 @@ http://furius.ca/pubcode/pub/conf/lib/python/dbapiext.html
     ...
     analq.execute(cursor, cols, id, t=table)
 
+  To run a query for many sets of arguments, use executemany_f(), optionally
+  with a 'batchsize' to send the rows of an INSERT as multi-row VALUES lists::
+
+    executemany_f(cursor, ' INSERT INTO %(t)s VALUES (%S, %S) ', rows,
+                  t=table, batchsize=500)
+
 **Note to developers: this module contains tests, if you make any changes,
 please make sure to run and fix the tests.**
 
@@ -72,11 +81,13 @@ Future Work
 """
 
 # stdlib imports
-import re
+import numbers, re, threading
 from datetime import date, datetime
 from itertools import starmap
-from itertools import count
+from itertools import count, islice
+from functools import partial
 from pprint import pprint
+from collections import OrderedDict
 
 # These imports only work in Python 2.x, but the built-ins are fine in 3.x.
 try:
@@ -93,7 +104,10 @@ except ImportError:
     from io import StringIO
 
 
-__all__ = ('execute_f', 'qcompile', 'set_paramstyle', 'execute_obj')
+__all__ = ('execute_f', 'executemany_f', 'qcompile', 'set_paramstyle',
+           'execute_obj', 'fetch_rows', 'row_converter', 'Record',
+           'fetch_columns',
+           'QueryCache', 'precompile', 'set_cache_size', 'cache_stats')
 
 
 # Create aliases for Python 3.x compatibility
@@ -105,6 +119,10 @@ try:
     unicode
 except NameError:
     unicode = str
+try:
+    long
+except NameError:
+    long = int
 
 
 # Convenince function since Python 3.x has new syntax for next
@@ -160,6 +178,7 @@ class QueryAnalyzer(object):
         "The parameter style supported by the underlying DBAPI."
 
         self.analyze() # Initialize.
+        self.compile()
 
     def init_style(self, paramstyle):
         "Pre-calculate style-specific constants."
@@ -216,6 +235,32 @@ class QueryAnalyzer(object):
                     escaped = False
                 comps.append( (keyname, escaped, sep, fmt) )
 
+    def compile(self):
+        """
+        Prepare the fast path of apply(), used when all the arguments are
+        scalars: the query with the escaped placeholders already rendered in
+        the parameter style, which only needs formatting with the unescaped
+        arguments, and the names of the escaped arguments in order.
+        """
+        self.template = str(self)
+        "The query to format with the arguments if they are all scalars."
+
+        keys, escaped = [], []
+        for x in self.components:
+            if not isinstance(x, (str, unicode)):
+                keyname, isescaped = x[:2]
+                if keyname not in keys:
+                    keys.append(keyname)
+                if isescaped and (self.style_argstype is list or
+                                  keyname not in escaped):
+                    escaped.append(keyname)
+        self.keys = tuple(keys)
+        "The names of all the arguments used in the query."
+
+        self.escaped = tuple(escaped)
+        """The names of the arguments passed to the DBAPI, in order, once per
+        placeholder for the positional styles."""
+
     def __str__(self):
         """
         Return the string that would be used before application of the
@@ -245,6 +290,23 @@ class QueryAnalyzer(object):
             assert name not in kwds
             kwds[name] = value
 
+        # Sequences and dicts expand into several placeholders, which only the
+        # general path below handles.
+        for keyname in self.keys:
+            if isinstance(kwds[keyname], _expanded_types):
+                return self.apply_expanded(kwds)
+
+        if self.style_argstype is dict:
+            delay_kwds = {name: kwds[name] for name in self.escaped}
+        else:
+            delay_kwds = [kwds[name] for name in self.escaped]
+        return self.template % kwds, delay_kwds
+
+    def apply_expanded(self, kwds):
+        """
+        Apply the arguments, all merged in 'kwds', expanding the sequences and
+        dicts among them.  See apply().
+        """
         # Patch up the components into a string.
         listexpans = {} # cached list expansions.
         apply_kwds, delay_kwds = {}, self.style_argstype()
@@ -333,6 +395,37 @@ class QueryAnalyzer(object):
         # Execute the transformed query.
         return cursor_.execute(cquery, ckwds)
 
+    def executemany(self, cursor_, seq_of_args, **kwds):
+        """
+        Execute the analyzed query on the given cursor for each of the
+        positional argument sequences, or keyword dicts, in 'seq_of_args'.  The
+        given keywords are shared by all of them.  Consecutive arguments that
+        render to the same query are sent in a single executemany() call.
+        """
+        rv = None
+        cquery, batch = None, []
+        for args in seq_of_args:
+            if isinstance(args, dict):
+                akwds = dict(kwds)
+                akwds.update(args)
+                query, cargs = self.apply(**akwds)
+            else:
+                query, cargs = self.apply(*args, **kwds)
+
+            if query != cquery:
+                if batch:
+                    rv = cursor_.executemany(cquery, batch)
+                cquery, batch = query, []
+            batch.append(cargs)
+
+        if batch:
+            rv = cursor_.executemany(cquery, batch)
+        return rv
+
+
+_expanded_types = (tuple, list, set, dict)
+"The types of the arguments that expand into several placeholders."
+
 
 def gensplit(regexp, s):
     """
@@ -371,9 +464,124 @@ Compile a query in a compatible query analyzer.
 
 
 
+class QueryCache(object):
+    """
+    A bounded cache of query analyzers, hashed on the query string and the
+    parameter style, that discards the least recently used entries first.  It
+    can be shared between threads.
+    """
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        "The maximum number of analyzers kept, None for no limit."
+
+        self.hits = self.misses = 0
+        "The number of lookups that found an analyzer or had to create one."
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, query, paramstyle=None):
+        """
+        Return the analyzer for the given query, compiling it if necessary.
+        """
+        if paramstyle is None:
+            paramstyle = _def_paramstyle
+        key = (query, paramstyle)
+
+        self._lock.acquire()
+        try:
+            q = self._cache.pop(key, None)
+            if q is not None:
+                self._cache[key] = q # Move to the most recent end.
+                self.hits += 1
+                return q
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+        # Compile outside the lock, the analysis does not need it.  If another
+        # thread beats us to it we keep its analyzer.
+        q = qcompile(query, paramstyle=paramstyle)
+
+        self._lock.acquire()
+        try:
+            q = self._cache.setdefault(key, q)
+            self._trim()
+        finally:
+            self._lock.release()
+        return q
+
+    def _trim(self):
+        "Discard the oldest entries beyond the maximum size."
+        if self.maxsize is not None:
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def resize(self, maxsize):
+        """
+        Change the maximum number of analyzers kept.
+        """
+        self._lock.acquire()
+        try:
+            self.maxsize = maxsize
+            self._trim()
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """
+        Discard all the analyzers and reset the statistics.
+        """
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Return a dict of the 'hits' and 'misses' counts, and of the current and
+        maximum number of analyzers ('size' and 'maxsize').
+        """
+        self._lock.acquire()
+        try:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._cache),
+                    'maxsize': self.maxsize}
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._cache)
+
+
 # Query cache used to avoid having to analyze the same queries multiple times.
-# Hashed on the query string.
-_query_cache = {}
+# Hashed on the query string and the parameter style.
+_query_cache = QueryCache()
+
+def precompile(queries, paramstyle=None):
+    """
+    Analyze the given queries and add them to the query cache, e.g. at startup
+    for the queries that are known to be hot.  Returns the list of analyzers.
+    """
+    if isinstance(queries, (str, unicode)):
+        queries = (queries,)
+    return [_query_cache.lookup(query, paramstyle) for query in queries]
+
+def set_cache_size(maxsize):
+    """
+    Set the maximum number of queries kept in the query cache (None for no
+    limit).
+    """
+    _query_cache.resize(maxsize)
+
+def cache_stats():
+    """
+    Return the statistics of the query cache, see QueryCache.stats().
+    """
+    return _query_cache.stats()
 
 # Note: we use cursor_ and query_ because we often call this function with
 # vars() which include those names on the caller side.
@@ -404,7 +612,7 @@ def execute_f(cursor_, query_, *args, **kwds):
 
     See qcompile() for details.
 
-    Note that this function accepts a '_paramstyle' optional argument, to set
+    Note that this function accepts a 'paramstyle' optional argument, to set
     which parameter style to use.
     """
     debug = debug_convert or kwds.pop('__debug__', None)
@@ -418,12 +626,7 @@ def execute_f(cursor_, query_, *args, **kwds):
         pprint(kwds)
 
     # Get the cached query analyzer or create one.
-    try:
-        q = _query_cache[query_]
-    except KeyError:
-        _query_cache[query_] = q = qcompile(
-            query_,
-            paramstyle=kwds.pop('paramstyle', None))
+    q = _query_cache.lookup(query_, kwds.pop('paramstyle', None))
 
     if debug:
         print('\nquery analyzer =', str(q))
@@ -441,68 +644,466 @@ def execute_f(cursor_, query_, *args, **kwds):
     return cursor_.execute(cquery, ckwds)
 
 
+def executemany_f(cursor_, query_, seq_of_args, **kwds):
+    """
+    Fancy executemany method for a cursor: run the query once for each of the
+    positional argument sequences (or keyword dicts) in 'seq_of_args', the given
+    keyword arguments being shared by all of them.  See execute_f() for the
+    syntax.  The query is analyzed only once.
+
+    If the 'batchsize' keyword is given, the query must be an INSERT whose last
+    VALUES (...) list contains only positional placeholders (and whose other
+    placeholders are keywords).  Up to 'batchsize' rows are then rendered in a
+    single multi-row VALUES list, e.g. VALUES (?, ?), (?, ?), ... and executed
+    in one round trip.  Mind the limit that your database puts on the number
+    of parameters of a statement when choosing the batch size.
+
+    Like execute_f(), this accepts a 'paramstyle' optional argument.
+    """
+    paramstyle = kwds.pop('paramstyle', None)
+    batchsize = kwds.pop('batchsize', None)
+    if not batchsize:
+        q = _query_cache.lookup(query_, paramstyle)
+        return q.executemany(cursor_, seq_of_args, **kwds)
+
+    prefix, row, suffix = _split_values(query_)
+    nbargs = len(_query_cache.lookup(row, paramstyle).positional)
+
+    rv = None
+    seq_of_args = iter(seq_of_args)
+    while True:
+        rows = list(islice(seq_of_args, batchsize))
+        if not rows:
+            break
+        args = []
+        for rowargs in rows:
+            if isinstance(rowargs, dict) or len(rowargs) != nbargs:
+                raise TypeError("Each row must be a sequence of %d positional "
+                                "arguments when batching." % nbargs)
+            args.extend(rowargs)
+
+        q = _query_cache.lookup(prefix + ', '.join([row] * len(rows)) + suffix,
+                                paramstyle)
+        rv = q.execute(cursor_, *args, **kwds)
+    return rv
+
+# The parenthesized row of a VALUES clause, allowing one level of nested
+# parentheses (e.g. for function calls).
+_values_regexp = re.compile(r'\bVALUES\s*(\((?:[^()]|\([^()]*\))*\))', re.I)
+
+def _split_values(query):
+    """
+    Split an INSERT query around the row of its last VALUES clause, to repeat
+    it for batching.  Returns the prefix, row and suffix strings.
+    """
+    mo = None
+    for mo in _values_regexp.finditer(query):
+        pass
+    if mo is None:
+        raise ValueError("Batching requires a query with a VALUES (...) list.")
+
+    prefix, row, suffix = (query[:mo.start(1)], mo.group(1),
+                           query[mo.end(1):])
+    for part, positional in ((prefix, False), (row, True), (suffix, False)):
+        for pmo in QueryAnalyzer.regexp.finditer(part):
+            if (pmo.group(2) is None) != positional:
+                raise ValueError(
+                    "Batching requires positional placeholders inside the "
+                    "VALUES list and keyword placeholders elsewhere.")
+    return prefix, row, suffix
+
+
 # Add support for ntuple wrapping (std in 2.6).
-try:
-    from collections import namedtuple
-
-    # Patch from Catherine Devlin <catherine dot devlin at gmail dot com>:
-    #
-    #   "Column names with ``$`` and ``#`` are legal in SQL, but not in
-    #   namedtuple field names. This throws exceptions when you try to
-    #   execute_obj on queries with such column names. For the apps I write
-    #   (rooting around in Oracle data dictionary views), there's no avoiding
-    #   the ``$`` and ``#`` characters. Therefore, I added code to munge column
-    #   names until they are namedtuple-legal. Another alternative would be to
-    #   simply change the error message raised into something that would suggest
-    #   that the user use column aliases in the SQL statement to change column
-    #   names into something namedtuple-legal."  (2010-05-25)
-    from collections import _iskeyword
-    not_alphanumeric = re.compile('[^a-zA-Z0-9]')
-    def rename_duplicates(lst, append_char = '_'):
-        newlist = []
-        for itm in lst:
-            while itm in newlist:
-                itm += append_char
-            newlist.append(itm)
-        return newlist
-    def _fix_fieldname(fieldname):
-        "Ensure that a field name will pass collection.namedtuple's criteria."
-        fieldname = not_alphanumeric.sub('_', fieldname)
-        while _iskeyword(fieldname):
-            fieldname = fieldname + '_'
-        return fieldname
-    def ntuple(typename, field_names, verbose=False):
-        field_names = [_fix_fieldname(fn) for fn in field_names.split()]
-        field_names = rename_duplicates(field_names)
-        return namedtuple(typename, ' '.join(field_names), verbose)
+from collections import namedtuple
+from keyword import iskeyword as _iskeyword
+
+# Patch from Catherine Devlin <catherine dot devlin at gmail dot com>:
+#
+#   "Column names with ``$`` and ``#`` are legal in SQL, but not in
+#   namedtuple field names. This throws exceptions when you try to
+#   execute_obj on queries with such column names. For the apps I write
+#   (rooting around in Oracle data dictionary views), there's no avoiding
+#   the ``$`` and ``#`` characters. Therefore, I added code to munge column
+#   names until they are namedtuple-legal. Another alternative would be to
+#   simply change the error message raised into something that would suggest
+#   that the user use column aliases in the SQL statement to change column
+#   names into something namedtuple-legal."  (2010-05-25)
+not_alphanumeric = re.compile('[^a-zA-Z0-9]')
+def rename_duplicates(lst, append_char = '_'):
+    newlist = []
+    for itm in lst:
+        while itm in newlist:
+            itm += append_char
+        newlist.append(itm)
+    return newlist
+def _fix_fieldname(fieldname):
+    "Ensure that a field name will pass collection.namedtuple's criteria."
+    fieldname = not_alphanumeric.sub('_', fieldname)
+    if not fieldname[:1].isalpha():
+        fieldname = 'f' + fieldname
+    while _iskeyword(fieldname):
+        fieldname = fieldname + '_'
+    return fieldname
+def fieldnames(names):
+    "Convert column names into distinct valid attribute names."
+    return rename_duplicates([_fix_fieldname(fn) for fn in names])
+def ntuple(typename, field_names, verbose=False):
+    """
+    Create a namedtuple class for the space-separated column names.  'verbose'
+    is ignored, namedtuple() does not accept it anymore.
+    """
+    return namedtuple(typename, fieldnames(field_names.split()))
 
-except ImportError:
-    ntuple = None
 
-if ntuple:
-    from operator import itemgetter
+class Record(object):
+    """
+    Base class of the lightweight row objects created by row_converter() for
+    the 'slots' row type: one attribute per column and no per-instance dict.
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def __iter__(self):
+        for name in self._fields:
+            yield getattr(self, name)
 
-    def execute_obj(conn, *args, **kwds):
-        """
-        Run a query on the given connection or cursor and yield ntuples of the
-        results.  'curs' can be either a Connection or a Cursor object.
-        """
-        # Convert to a cursor if necessary.
-        if re.search('Cursor', conn.__class__.__name__, re.I):
-            curs = conn
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                tuple(self) == tuple(other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self._fields))
+
+    def _asdict(self):
+        return dict(izip(self._fields, self))
+
+def _record_class(typename, names):
+    """
+    Create a Record subclass with a slot for each of the given column names.
+    """
+    fields = tuple(fieldnames(names))
+    args = ', '.join(fields)
+    source = 'def __init__(self, %s):\n    %s\n' % (
+        args, '; '.join('self.%s = %s' % (f, f) for f in fields) or 'pass')
+    namespace = {}
+    exec(source, namespace)
+    return type(typename, (Record,), {'__slots__': fields,
+                                      '_fields': fields,
+                                      '__init__': namespace['__init__']})
+
+
+_def_arraysize = 1000
+"""The default number of rows fetched at a time by fetch_rows(), unless the
+cursor's arraysize is larger."""
+
+_row_classes = {}
+"The row classes created for the 'ntuple' and 'slots' row types."
+
+_max_row_classes = 256
+"The number of row classes beyond which the cache above starts over."
+
+def _row_class(rowtype, names):
+    """
+    Return the cached row class of the given type for the column names.
+    """
+    key = (rowtype, names)
+    try:
+        return _row_classes[key]
+    except KeyError:
+        if rowtype == 'ntuple':
+            cls = namedtuple('Row', fieldnames(names))
         else:
-            curs = conn.cursor()
+            cls = _record_class('Row', names)
+        if len(_row_classes) >= _max_row_classes:
+            _row_classes.clear()
+        return _row_classes.setdefault(key, cls)
+
+def row_converter(description, rowtype='ntuple'):
+    """
+    Return a function that converts a list of rows fetched from a cursor with
+    the given 'description' into an iterable of output objects, depending on
+    'rowtype':
+
+    - 'ntuple': namedtuples with an attribute per column;
+    - 'slots': Record objects with an attribute per column;
+    - 'tuple': plain tuples;
+    - 'dict': dicts keyed on the column names;
+    - 'numpy': a single dict of NumPy arrays, one per column, for the whole
+      list (requires numpy);
+    - 'arrow': a single pyarrow.RecordBatch for the whole list (requires
+      pyarrow).
+
+    The row classes are cached on the column names, so that the same query does
+    not create a new class every time.
+    """
+    if description is None:
+        raise ValueError("The query did not produce a result set.")
+    names = tuple(d[0] for d in description)
+
+    if rowtype == 'ntuple':
+        make = _row_class('ntuple', names)._make
+        return lambda rows: imap(make, rows)
+    elif rowtype == 'slots':
+        return partial(starmap, _row_class('slots', names))
+    elif rowtype == 'tuple':
+        return partial(imap, tuple)
+    elif rowtype == 'dict':
+        return lambda rows: [dict(izip(names, row)) for row in rows]
+    elif rowtype == 'numpy':
+        import numpy
+        return lambda rows: [dict(izip(names, [numpy.array(column)
+                                               for column in izip(*rows)]))]
+    elif rowtype == 'arrow':
+        import pyarrow
+        return lambda rows: [pyarrow.RecordBatch.from_arrays(
+            [pyarrow.array(column) for column in izip(*rows)], list(names))]
+    else:
+        raise ValueError("Row type '%s' is not supported." % rowtype)
+
+def fetch_rows(curs, rowtype='ntuple', arraysize=None):
+    """
+    Return an iterator over the results of the query executed on 'curs', as
+    objects of the given 'rowtype' (see row_converter()).  The rows are fetched
+    'arraysize' at a time with fetchmany(), so that large result sets stream
+    through without being loaded in memory at once.  The 'numpy' and 'arrow'
+    row types yield one columnar batch per fetch.
+    """
+    convert = row_converter(curs.description, rowtype)
+    if arraysize is None:
+        arraysize = max(getattr(curs, 'arraysize', 1), _def_arraysize)
+    return _fetch_batches(curs, convert, arraysize)
+
+def _fetch_batches(curs, convert, arraysize):
+    fetchmany = curs.fetchmany
+    while True:
+        rows = fetchmany(arraysize)
+        if not rows:
+            break
+        for obj in convert(rows):
+            yield obj
+
+def execute_obj(conn, *args, **kwds):
+    """
+    Run a query on the given connection or cursor and yield ntuples of the
+    results.  'curs' can be either a Connection or a Cursor object.  The
+    optional 'rowtype' and 'arraysize' keyword arguments are passed on to
+    fetch_rows().
+    """
+    rowtype = kwds.pop('rowtype', 'ntuple')
+    arraysize = kwds.pop('arraysize', None)
+
+    # Convert to a cursor if necessary.
+    if re.search('Cursor', conn.__class__.__name__, re.I):
+        curs = conn
+    else:
+        curs = conn.cursor()
+
+    # Execute the query.
+    execute_f(curs, *args, **kwds)
+
+    # Yield all the results wrapped up in the requested objects.
+    return fetch_rows(curs, rowtype, arraysize)
+
+
+
+# The NumPy dtypes of the type codes that some drivers report in
+# cursor.description: type names (e.g. BigQuery) and PostgreSQL type OIDs
+# (e.g. psycopg2).  The other type codes are inferred from the values.
+_type_code_dtypes = {
+    'INTEGER': 'int64', 'INT64': 'int64', 'INT': 'int64', 'BIGINT': 'int64',
+    'SMALLINT': 'int64',
+    'FLOAT': 'float64', 'FLOAT64': 'float64', 'REAL': 'float64',
+    'DOUBLE': 'float64',
+    'BOOLEAN': 'bool', 'BOOL': 'bool',
+    'TIMESTAMP': 'datetime64[us]', 'DATETIME': 'datetime64[us]',
+    'DATE': 'datetime64[D]',
+    'STRING': 'O', 'TEXT': 'O', 'VARCHAR': 'O', 'BYTES': 'O',
+    16: 'bool', 20: 'int64', 21: 'int16', 23: 'int32', 700: 'float32',
+    701: 'float64', 1082: 'datetime64[D]', 1114: 'datetime64[us]',
+    1184: 'datetime64[us]', 25: 'O', 1043: 'O',
+    }
+
+def _column_dtype(desc, column, dbapi):
+    """
+    Return the dtype of a column from its description, or else from the first
+    non-null value in the given list of its values.
+    """
+    code = desc[1]
+    if isinstance(code, (str, unicode)):
+        code = code.upper()
+    try:
+        return _type_code_dtypes[code]
+    except (KeyError, TypeError):
+        pass
+    if dbapi is not None:
+        if code == dbapi.DATETIME:
+            return 'datetime64[us]'
+        elif code == dbapi.STRING:
+            return 'O'
+
+    for value in column:
+        if value is not None:
+            break
+    else:
+        return 'O'
+    if isinstance(value, bool):
+        return 'bool'
+    elif isinstance(value, (int, long)):
+        return 'int64'
+    elif isinstance(value, float):
+        return 'float64'
+    elif isinstance(value, datetime):
+        return 'datetime64[us]'
+    elif isinstance(value, date):
+        return 'datetime64[D]'
+    return 'O'
+
+_max_exact_int = 2 ** 53
+"""The largest magnitude up to which all ints are exactly representable as
+float64 values."""
+
+def _exact_floats(column):
+    "Return true if the values of a column are nulls, floats or exact ints."
+    return all(value is None or isinstance(value, float) or
+               (isinstance(value, (int, long)) and
+                -_max_exact_int <= value <= _max_exact_int)
+               for value in column)
+
+def _inexact(column):
+    """
+    Return true if a column has numbers that an int or bool array would
+    truncate, e.g. floats or decimals.
+    """
+    return any(isinstance(value, numbers.Number) and
+               not isinstance(value, numbers.Integral)
+               for value in column)
+
+def _naive_utc(column):
+    "Convert timezone-aware datetimes to naive UTC ones."
+    return [value if value is None else
+            (value - value.utcoffset()).replace(tzinfo=None)
+            for value in column]
+
+def fetch_columns(curs, frame=True, dtypes=None, arraysize=None, dbapi=None):
+    """
+    Fetch the results of the query executed on 'curs' directly into a NumPy
+    array per column, without creating an object per row.  Returns a pandas
+    DataFrame if 'frame' is true, or else a dict of the arrays by column name.
+
+    The rows are fetched 'arraysize' at a time (see fetch_rows()) and copied
+    into preallocated typed arrays, which grow as needed.  The dtype of each
+    column is taken from 'dtypes', a dict by column name, or else from the type
+    code in the cursor's description (type names and PostgreSQL type OIDs, or
+    the type objects of the 'dbapi' module if given), or else from its first
+    values.  Columns with nulls are promoted, ints to float64 with NaN if they
+    all fit exactly in a float (within +/-2**53), and the others to object;
+    null dates become NaT.  Int columns with other numbers are promoted the
+    same way, rather than truncated, and ints beyond int64 go to object.
+    Timezone-aware datetimes are stored as UTC, and localized to UTC in the
+    DataFrame.
+    """
+    import numpy
+
+    description = curs.description
+    if description is None:
+        raise ValueError("The query did not produce a result set.")
+    names = [d[0] for d in description]
+    if arraysize is None:
+        arraysize = max(getattr(curs, 'arraysize', 1), _def_arraysize)
+    fetchmany = curs.fetchmany
+
+    rows = fetchmany(arraysize)
+    columns = list(izip(*rows)) if rows else [()] * len(names)
+    if dtypes is None:
+        dtypes = {}
+    capacity = max(getattr(curs, 'rowcount', -1), len(rows), 1)
+    arrays = [numpy.empty(capacity,
+                          dtypes.get(name) or _column_dtype(desc, column, dbapi))
+              for name, desc, column in izip(names, description, columns)]
+    utc = set()
+    nullable_ints = set()
+
+    n = 0
+    while rows:
+        k = len(rows)
+        if n + k > capacity:
+            capacity = max(2 * capacity, n + k)
+            for i, arr in enumerate(arrays):
+                grown = numpy.empty(capacity, arr.dtype)
+                grown[:n] = arr[:n]
+                arrays[i] = grown
+
+        for i, column in enumerate(columns):
+            arr = arrays[i]
+            kind = arr.dtype.kind
+            if kind == 'M':
+                for value in column:
+                    if value is not None:
+                        if getattr(value, 'tzinfo', None) is not None:
+                            column = _naive_utc(column)
+                            utc.add(i)
+                        break
+            try:
+                # NumPy would store nulls as False in a bool array.
+                if kind == 'b' and None in column:
+                    raise TypeError
+                # Nor should floats be truncated in an int or bool array.
+                if kind in 'iub' and _inexact(column):
+                    raise TypeError
+                # Nor should the float64 of an int column round large ints.
+                if i in nullable_ints and not _exact_floats(column):
+                    raise TypeError
+                arr[n:n + k] = column
+            except (TypeError, ValueError, OverflowError):
+                # Promote the column and try again.
+                candidates = ('O',)
+                if (kind in 'iu' and _exact_floats(column) and
+                    (n == 0 or (arr[:n].min() >= -_max_exact_int and
+                                arr[:n].max() <= _max_exact_int))):
+                    candidates = ('float64', 'O')
+                for dtype in candidates:
+                    promoted = numpy.empty(capacity, dtype)
+                    if i in nullable_ints and dtype == 'O':
+                        # Restore the ints and nulls stored as floats.
+                        promoted[:n] = [None if value != value else int(value)
+                                        for value in arr[:n].tolist()]
+                    else:
+                        promoted[:n] = arr[:n]
+                    try:
+                        promoted[n:n + k] = column
+                    except (TypeError, ValueError, OverflowError):
+                        continue
+                    arrays[i] = promoted
+                    if dtype == 'float64':
+                        nullable_ints.add(i)
+                    else:
+                        nullable_ints.discard(i)
+                    break
+                else:
+                    raise
+        n += k
+
+        rows = fetchmany(arraysize)
+        if rows:
+            columns = list(izip(*rows))
 
-        # Execute the query.
-        execute_f(curs, *args, **kwds)
+    arrays = [arr[:n] if n == capacity else arr[:n].copy() for arr in arrays]
 
-        # Yield all the results wrapped up in an ntuple.
-        names = list(map(itemgetter(0), curs.description))
-        TupleCls = ntuple('Row', ' '.join(names))
-        return starmap(TupleCls, imap(tuple, curs))
-else:
-    execute_obj = None
+    if not frame:
+        return dict(izip(names, arrays))
 
+    import pandas
+    df = pandas.DataFrame(dict(enumerate(arrays)), copy=False)
+    df.columns = names
+    for i in utc:
+        df.isetitem(i, df.iloc[:, i].dt.tz_localize('UTC'))
+    return df
 
 
 #-------------------------------------------------------------------------------
@@ -0,0 +1,51 @@
+"""
+Microbenchmark of dbapiext.QueryAnalyzer.apply().
+
+Times apply() on typical scalar-only queries, which take the precompiled fast
+path, against apply_expanded(), the general path that walks the components and
+expands sequence and dict arguments.
+
+Run from the project root:
+
+    python benchmarks/bench_dbapiext_apply.py --number 100000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'Scripts', 'ypes'))
+import dbapiext
+
+QUERIES = {
+    'point lookup': ("SELECT * FROM patients WHERE patient_id = %S", (42,), {}),
+    'filtered': ("SELECT %s FROM %(table)s WHERE region = %S AND age >= %S AND admitted < %(day)S",
+                 ('name, age', 'North', 30), {'table': 'patients', 'day': '2024-01-01'}),
+    'wide insert': ("INSERT INTO visits VALUES (%S, %S, %S, %S, %S, %S, %S, %S)",
+                    tuple(range(8)), {}),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=100000, help="Calls per measurement")
+    parser.add_argument('--paramstyle', default='pyformat', help="DBAPI parameter style")
+    args = parser.parse_args()
+
+    print(f"paramstyle {args.paramstyle}, {args.number} calls")
+    print(f"{'query':<14} {'general':>12} {'fast':>12} {'speedup':>8}")
+    for label, (query, qargs, qkwds) in QUERIES.items():
+        q = dbapiext.qcompile(query, paramstyle=args.paramstyle)
+        merged = dict(zip(q.positional, qargs), **qkwds)
+        assert q.apply(*qargs, **qkwds) == q.apply_expanded(dict(merged))
+
+        general = min(timeit.repeat(lambda: q.apply_expanded(dict(merged)),
+                                    number=args.number, repeat=3))
+        fast = min(timeit.repeat(lambda: q.apply(*qargs, **qkwds),
+                                 number=args.number, repeat=3))
+        print(f"{label:<14} {general / args.number * 1e6:>9.2f} us "
+              f"{fast / args.number * 1e6:>9.2f} us {general / fast:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+Concurrency benchmark of the threaded and asyncio connection pools.
+
+Each request acquires a connection, runs one query that takes --latency
+seconds on the simulated server and releases the connection. The threaded
+pool serves every request from its own thread. The asyncio pool serves them
+from tasks, either running a blocking driver in the default executor or
+awaiting a native async driver.
+
+Run from the project root:
+
+    python benchmarks/bench_pool_async.py --concurrency 100 250 500 1000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'Scripts', 'ypes'))
+from antipool import ConnectionPool
+from antipool_async import AsyncConnectionPool
+
+
+class BlockingDriver:
+    """DBAPI-like driver whose queries block the calling thread."""
+    Error = Exception
+    threadsafety = 2
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def connect(self, **params):
+        return BlockingConnection(self.latency)
+
+
+class BlockingConnection:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args=None):
+        time.sleep(self.latency)
+
+    def fetchall(self):
+        return [(1,)]
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class NativeDriver:
+    """Async driver whose queries yield to the event loop."""
+    Error = Exception
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def connect(self, **params):
+        return NativeConnection(self.latency)
+
+
+class NativeConnection:
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def cursor(self):
+        return self
+
+    async def execute(self, query, args=None):
+        await asyncio.sleep(self.latency)
+
+    async def fetchall(self):
+        return [(1,)]
+
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+def run_threaded(concurrency, maxconn, latency):
+    pool = ConnectionPool(BlockingDriver(latency), {'maxconn': maxconn, 'disable_ro': True},
+                          database='bench')
+
+    def request():
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=request) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    pool.finalize()
+    return elapsed
+
+
+def run_async(driver, concurrency, maxconn):
+    async def main():
+        pool = AsyncConnectionPool(driver, {'maxconn': maxconn}, database='bench')
+
+        async def request():
+            async with pool.connection() as conn:
+                cursor = await conn.cursor()
+                await cursor.execute("SELECT 1")
+                await cursor.fetchall()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(request() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        await pool.finalize()
+        return elapsed
+
+    return asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[100, 250, 500, 1000],
+                        help="Numbers of concurrent requests")
+    parser.add_argument('--maxconn', type=int, default=20, help="Pool size")
+    parser.add_argument('--latency', type=float, default=0.005, help="Query latency in seconds")
+    args = parser.parse_args()
+
+    print(f"maxconn {args.maxconn}, query latency {args.latency * 1000:.1f} ms")
+    print(f"{'requests':>8} {'threaded':>12} {'async/executor':>16} {'async/native':>14}")
+    for concurrency in args.concurrency:
+        threaded = run_threaded(concurrency, args.maxconn, args.latency)
+        executor = run_async(BlockingDriver(args.latency), concurrency, args.maxconn)
+        native = run_async(NativeDriver(args.latency), concurrency, args.maxconn)
+        print(f"{concurrency:>8} {threaded * 1000:>9.1f} ms {executor * 1000:>13.1f} ms "
+              f"{native * 1000:>11.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Import-time benchmark for the dashboard module.
+
+Each run imports Scripts.streamlit_app in a fresh interpreter, which is what
+a cold start pays before the login page can render, and reports the timings
+together with the heavy libraries that ended up loaded.
+
+Run from the project root:
+
+    python benchmarks/bench_startup.py --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+HEAVY_MODULES = ('google.cloud.bigquery', 'plotly.express', 'matplotlib', 'seaborn')
+
+IMPORT_SNIPPET = """
+import json, sys, time
+sys.path.insert(0, 'Scripts')
+start = time.perf_counter()
+import Scripts.streamlit_app
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed,
+                  'loaded': [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def time_import():
+    result = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET], cwd=PROJECT_ROOT,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help="Number of cold imports")
+    args = parser.parse_args()
+
+    samples = [time_import() for _ in range(args.runs)]
+    seconds = [sample['seconds'] for sample in samples]
+    print(f"cold imports: {args.runs}")
+    print(f"min    {min(seconds) * 1000:8.1f} ms")
+    print(f"median {statistics.median(seconds) * 1000:8.1f} ms")
+    print(f"max    {max(seconds) * 1000:8.1f} ms")
+    print(f"heavy modules loaded at import: {samples[-1]['loaded'] or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
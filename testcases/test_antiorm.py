@@ -0,0 +1,502 @@
+import os
+import pickle
+import re
+import sqlite3
+import sys
+import tempfile
+import types
+import unittest
+import unittest.mock
+
+# The vendored DB libraries import each other as top-level modules
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'Scripts', 'ypes')))
+import antiorm
+import antipool
+from antiorm import MormCache, MormConv, MormDecoder, MormError, MormObject, MormTable
+
+
+class FormatCursor(object):
+    """sqlite3 cursor that takes the 'format' paramstyle, like psycopg2."""
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.name = name
+        self.curs = conn.db.cursor()
+        self.fetches = []
+        self.closed = False
+
+    def __getattr__(self, name):
+        return getattr(self.curs, name)
+
+    def execute(self, query, args=None):
+        self.conn.begin(query)
+        self.curs.execute(query.replace('%s', '?'), args or ())
+
+    def executemany(self, query, seq_of_args):
+        self.conn.begin(query)
+        self.curs.executemany(query.replace('%s', '?'), seq_of_args)
+
+    def fetchone(self):
+        self.fetches.append(1)
+        return self.curs.fetchone()
+
+    def fetchmany(self, size):
+        self.fetches.append(size)
+        return self.curs.fetchmany(size)
+
+    def close(self):
+        self.closed = True
+        self.curs.close()
+
+
+class NamedCursor(FormatCursor):
+    """Server-side cursor, only described once rows are fetched, like psycopg2's."""
+    @property
+    def description(self):
+        return self.curs.description if self.fetches else None
+
+
+class CopyCursor(FormatCursor):
+    """Cursor that also loads data with COPY, psycopg2 style."""
+    def copy_expert(self, sql, file):
+        self.conn.queries.append(sql)
+        match = re.match(r'COPY (\w+) \((.*)\) FROM STDIN$', sql)
+        table, cols = match.group(1), match.group(2)
+        unescape = {'t': '\t', 'n': '\n', 'r': '\r', '\\': '\\'}
+        rows = []
+        for line in file.read().splitlines():
+            rows.append([None if field == '\\N' else
+                         re.sub(r'\\(.)', lambda m: unescape[m.group(1)], field)
+                         for field in line.split('\t')])
+        self.curs.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+            table, cols, ', '.join('?' * len(rows[0]))), rows)
+
+
+class FormatConnection(object):
+    """
+    sqlite3 connection that records the cursors and queries it runs, and
+    reports its transaction status like psycopg2.
+    """
+    def __init__(self, named=False, copy=False, db=None):
+        self.db = db or sqlite3.connect(':memory:')
+        self.named = named
+        self.copy = copy
+        self.cursors = []
+        self.queries = []
+        self.info = types.SimpleNamespace(transaction_status=0)
+
+    def begin(self, query):
+        self.queries.append(query)
+        self.info.transaction_status = 2
+
+    def cursor(self, *args):
+        if args and not self.named:
+            raise TypeError("cursor() takes no name")
+        if args:
+            curs = NamedCursor(self, *args)
+        else:
+            curs = (CopyCursor if self.copy else FormatCursor)(self)
+        self.cursors.append(curs)
+        return curs
+
+    def commit(self):
+        self.db.commit()
+        self.info.transaction_status = 0
+
+    def rollback(self):
+        self.db.rollback()
+        self.info.transaction_status = 0
+
+    def close(self):
+        self.db.close()
+
+
+class Encounters(MormTable):
+    table = 'encounters'
+
+
+class Cents(MormConv):
+    def to_python(self, value):
+        return None if value is None else int(round(value * 100))
+
+
+class Billing(MormTable):
+    table = 'encounters'
+    converters = {'cost': Cents()}
+
+
+class Visit(object):
+    pass
+
+
+class Visits(MormTable):
+    table = 'encounters'
+    objcls = Visit
+
+
+class TestAntiOrm(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FormatConnection(named=True)
+        self.addCleanup(self.conn.close)
+        self.conn.db.execute("CREATE TABLE encounters (id INTEGER PRIMARY KEY, "
+                             "patient TEXT, cost REAL)")
+        self.conn.db.executemany("INSERT INTO encounters VALUES (?, ?, ?)",
+                                 [(i, 'p%d' % (i % 4), i * 10.0) for i in range(1, 26)])
+
+    def test_select_stream_uses_named_cursor_and_batches(self):
+        objs = list(Encounters.select_stream(self.conn, 'ORDER BY id', batchsize=10,
+                                             named=True))
+        self.assertEqual([o.id for o in objs], list(range(1, 26)))
+        curs, = self.conn.cursors
+        self.assertTrue(curs.name.startswith('morm_encounters_'))
+        self.assertEqual(curs.fetches, [10, 10, 10, 10])
+        self.assertTrue(curs.closed)
+
+    def test_select_stream_batches_without_named_cursors(self):
+        conn = FormatConnection()
+        self.addCleanup(conn.close)
+        conn.db.execute("CREATE TABLE encounters (id INTEGER, patient TEXT, cost REAL)")
+        conn.db.executemany("INSERT INTO encounters VALUES (?, 'p', 0)", [(i,) for i in range(5)])
+        batches = list(Encounters.select_stream(conn, 'WHERE id > %s ORDER BY id', (0,),
+                                                cols=('id',), batchsize=3, batches=True))
+        self.assertEqual([[o.id for o in batch] for batch in batches], [[1, 2, 3], [4]])
+        self.assertIsNone(conn.cursors[0].name)
+
+        # Drivers without named cursors fail loudly rather than fall back.
+        with self.assertRaises(TypeError):
+            next(Encounters.select_stream(conn, named=True))
+
+    def test_select_stream_closes_cursor_when_abandoned(self):
+        stream = Encounters.select_stream(self.conn, batchsize=5)
+        next(stream)
+        stream.close()
+        self.assertTrue(self.conn.cursors[0].closed)
+
+    def test_count_is_computed_by_the_server(self):
+        self.assertEqual(Encounters.count(self.conn), 25)
+        self.assertEqual(Encounters.count(self.conn, 'WHERE patient = %s', ('p1',)), 7)
+        self.assertEqual(Encounters.count(self.conn, 'ORDER BY id LIMIT 3'), 3)
+        self.assertEqual(Encounters.count(self.conn, distinct=True), 25)
+        self.assertIn('SELECT COUNT(*) FROM (', self.conn.queries[0])
+        # sqlite reports no row count for selects, which count() used to return.
+        self.assertEqual(self.conn.cursors[0].rowcount, -1)
+
+    def test_exists(self):
+        self.assertTrue(Encounters.exists(self.conn, 'WHERE cost > %s', (240,)))
+        self.assertFalse(Encounters.exists(self.conn, 'WHERE cost > %s', (250,)))
+
+    def test_select_one_and_get_limit_rows(self):
+        obj = Encounters.select_one(self.conn, 'WHERE id = %s', (3,))
+        self.assertEqual(obj.patient, 'p3')
+        self.assertIsNone(Encounters.select_one(self.conn, 'WHERE id = %s', (99,)))
+        self.assertRaises(MormError, Encounters.select_one, self.conn,
+                          'WHERE patient = %s', ('p1',))
+        self.assertTrue(all(q.rstrip().endswith('LIMIT 2') for q in self.conn.queries))
+
+        self.assertEqual(Encounters.get(self.conn, id=4).cost, 40.0)
+        self.assertTrue(self.conn.queries[-1].rstrip().endswith('LIMIT 1'))
+        self.assertRaises(MormError, Encounters.get, self.conn, id=99)
+        self.assertEqual(Encounters.get(self.conn, default='none', id=99), 'none')
+
+    def test_select_first_keeps_existing_limit(self):
+        objs = Encounters.select_first(self.conn, 2, 'ORDER BY id DESC LIMIT 5')
+        self.assertEqual([o.id for o in objs], [25, 24])
+
+    def test_limit_is_added_before_locking_clauses(self):
+        limit = antiorm._limit_cond
+        self.assertEqual(limit('ORDER BY id LIMIT %s OFFSET 10', 2), 'ORDER BY id LIMIT %s OFFSET 10')
+        self.assertEqual(limit('FETCH FIRST 3 ROWS ONLY', 2), 'FETCH FIRST 3 ROWS ONLY')
+        self.assertEqual(limit('OFFSET 10', 2), 'OFFSET 10 LIMIT 2')
+        self.assertEqual(limit("WHERE note = 'no limit' AND fetch_id = 1", 2),
+                         "WHERE note = 'no limit' AND fetch_id = 1 LIMIT 2")
+        self.assertEqual(limit('WHERE id = %s FOR UPDATE OF encounters SKIP LOCKED', 1),
+                         'WHERE id = %s LIMIT 1 FOR UPDATE OF encounters SKIP LOCKED')
+        self.assertEqual(limit('ORDER BY id LIMIT 5 FOR SHARE', 1), 'ORDER BY id LIMIT 5 FOR SHARE')
+
+        objs = Encounters.select_first(self.conn, 2, "WHERE patient <> 'no limit' ORDER BY id")
+        self.assertEqual([o.id for o in objs], [1, 2])
+        self.assertTrue(self.conn.queries[-1].endswith('LIMIT 2'))
+
+    def test_select_iterator_fetches_in_batches(self):
+        it = Encounters.select(self.conn, 'WHERE patient = %s', ('p1',))
+        it.batchsize = 4
+        self.assertEqual([o.id for o in it], [1, 5, 9, 13, 17, 21, 25])
+        self.assertEqual(self.conn.cursors[0].fetches, [4, 4, 4])
+
+
+
+class Patients(MormTable):
+    table = 'patients'
+    converters = {'cost': Cents()}
+
+
+class Dollars(MormConv):
+    def from_python(self, value):
+        return value / 100.0
+
+
+class PatientsIn(MormTable):
+    table = 'patients'
+    converters = {'cost': Dollars()}
+
+
+class TestBulkInsert(unittest.TestCase):
+
+    def make_conn(self, **kwds):
+        conn = FormatConnection(**kwds)
+        self.addCleanup(conn.close)
+        conn.db.execute("CREATE TABLE patients (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "name TEXT UNIQUE, city TEXT, cost REAL)")
+        return conn
+
+    def rows(self, n, start=0):
+        return [{'name': 'n%d' % i, 'city': None if i % 2 else 'c\t%d' % i, 'cost': i * 100}
+                for i in range(start, start + n)]
+
+    def fetch(self, conn):
+        return conn.db.execute("SELECT id, name, city, cost FROM patients ORDER BY id").fetchall()
+
+    def test_insert_many_values_with_returning(self):
+        conn = self.make_conn()
+        objs = PatientsIn.insert_many(conn, self.rows(5), returning=('id', 'name'), batchsize=2)
+        self.assertEqual([(o.id, o.name) for o in objs], [(i + 1, 'n%d' % i) for i in range(5)])
+        self.assertEqual(len(conn.queries), 3)
+        self.assertIn('), (', conn.queries[0])
+        self.assertEqual(self.fetch(conn)[3], (4, 'n3', None, 3.0))
+
+    def test_insert_many_executemany_and_copy(self):
+        expected = [(i + 1, 'n%d' % i, None if i % 2 else 'c\t%d' % i, float(i))
+                    for i in range(7)]
+        for method, kwds in (('executemany', {}), (None, {'copy': True})):
+            conn = self.make_conn(**kwds)
+            self.assertEqual(PatientsIn.insert_many(conn, iter(self.rows(7)), method=method,
+                                                    batchsize=3), 7)
+            self.assertEqual(self.fetch(conn), expected)
+        self.assertEqual(sum(q.startswith('COPY') for q in conn.queries), 3)
+
+    def test_copy_sends_bytes_as_bytea_hex(self):
+        self.assertEqual(antiorm._copy_text(b'\x00a\\'), '\\\\x00615c')
+        self.assertEqual(antiorm._copy_text(memoryview(b'hi')), '\\\\x6869')
+        conn = self.make_conn(copy=True)
+        PatientsIn.insert_many(conn, [{'name': b'\x00\t', 'city': 'c', 'cost': 1}])
+        # COPY unescapes the backslash, leaving the bytea input.
+        self.assertEqual(self.fetch(conn)[0][1], '\\x0009')
+
+    def test_insert_many_checks_columns_and_options(self):
+        conn = self.make_conn()
+        self.assertEqual(Patients.insert_many(conn, []), 0)
+        self.assertRaises(MormError, Patients.insert_many, conn,
+                          [{'name': 'a'}, {'city': 'b'}])
+        self.assertRaises(MormError, Patients.insert_many, conn,
+                          [{'name': 'a'}, {'name': 'b', 'city': 'c'}])
+        self.assertRaises(MormError, Patients.insert_many, conn, [{'name': 'a'}],
+                          method='executemany', returning=('id',))
+
+    def test_upsert_many(self):
+        conn = self.make_conn()
+        PatientsIn.insert_many(conn, self.rows(3))
+        objs = PatientsIn.upsert_many(conn, self.rows(4, start=1) + [{'name': 'n0', 'city': 'x',
+                                                                      'cost': 5000}],
+                                      key='name', returning=('id', 'name', 'cost'))
+        self.assertEqual(len(objs), 5)
+        self.assertEqual(self.fetch(conn)[0], (1, 'n0', 'x', 50.0))
+        self.assertEqual(conn.db.execute("SELECT COUNT(*) FROM patients").fetchone(), (5,))
+
+        PatientsIn.upsert_many(conn, [{'name': 'n0', 'city': 'y'}], key=('name',), update=(),
+                               method='executemany')
+        self.assertEqual(self.fetch(conn)[0][2], 'x')
+        self.assertIn('ON CONFLICT (name) DO NOTHING', conn.queries[-1])
+
+
+class Payers(MormTable):
+    table = 'payers'
+    cacheable = True
+    cache_size = 2
+
+
+class PayersAdmin(MormTable):
+    table = 'payers'
+
+
+class TestGetCache(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(antiorm._caches.clear)
+        self.db = sqlite3.connect(':memory:')
+        self.addCleanup(self.db.close)
+        self.db.execute("CREATE TABLE payers (id INTEGER PRIMARY KEY, name TEXT)")
+        self.db.executemany("INSERT INTO payers VALUES (?, ?)",
+                            [(1, 'Medicare'), (2, 'Medicaid'), (3, 'Aetna')])
+        self.db.commit()
+
+    def connect(self):
+        return FormatConnection(db=self.db)
+
+    def test_identity_map_and_shared_cache(self):
+        conn, other = self.connect(), self.connect()
+        payer = Payers.get(conn, id=1)
+        self.assertIs(Payers.get(conn, id=1), payer)
+        self.assertEqual(len(conn.queries), 1)
+
+        copy = Payers.get(other, id=1)
+        self.assertIsNot(copy, payer)
+        self.assertEqual(copy.name, 'Medicare')
+        self.assertEqual(other.queries, [])
+        self.assertEqual(Payers.cache_stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+        self.assertIsNone(Payers.get(conn, default=None, id=99))
+        self.assertRaises(MormError, Payers.get, conn, id=99)
+
+    def test_writes_invalidate(self):
+        conn, other = self.connect(), self.connect()
+        Payers.get(conn, id=1)
+        Payers.count(other)
+        Payers.get(other, id=1)
+
+        PayersAdmin.update(conn, 'WHERE id = %s', (1,), name='CMS')
+        self.assertEqual(Payers.cache_stats()['size'], 0)
+        self.assertEqual(Payers.get(conn, id=1).name, 'CMS')
+        # The writer does not share its uncommitted rows.
+        self.assertEqual(Payers.cache_stats()['size'], 0)
+        conn.commit()
+        self.assertEqual(Payers.get(conn, id=1).name, 'CMS')
+        self.assertEqual(Payers.cache_stats()['size'], 1)
+
+        # The identity map lasts as long as the transaction.
+        self.assertEqual(Payers.get(other, id=1).name, 'Medicare')
+        other.commit()
+        self.assertEqual(Payers.get(other, id=1).name, 'CMS')
+
+        Payers.delete(other, 'WHERE id = %s', (2,))
+        self.assertIsNone(Payers.get(other, default=None, id=2))
+        Payers.insert_many(other, [{'id': 2, 'name': 'Cigna'}])
+        self.assertEqual(Payers.get(other, id=2).name, 'Cigna')
+
+    def test_identity_map_expires(self):
+        conn = self.connect()
+        payer = Payers.get(conn, id=1)
+        later = antiorm._clock() + Payers.cache_ttl + 1
+        with unittest.mock.patch.object(antiorm, '_clock', return_value=later):
+            self.assertIsNot(Payers.get(conn, id=1), payer)
+        self.assertEqual(len(conn.queries), 2)
+
+    @unittest.mock.patch.object(antiorm, '_idle', return_value=False)
+    def test_end_transaction_of_unwatched_connections(self, idle):
+        conn = self.connect()
+        payer = Payers.get(conn, id=1)
+        self.assertIs(Payers.get(conn, id=1), payer)
+        PayersAdmin.delete(conn, 'WHERE id = %s', (3,))
+        Payers.get(conn, id=2)
+        self.assertEqual(Payers.cache_stats()['size'], 0)
+        conn.commit()
+        Payers.end_transaction(conn)
+        self.assertIsNot(Payers.get(conn, id=1), payer)
+        self.assertEqual(Payers.cache_stats()['size'], 1)
+
+    def test_pooled_connections_end_transactions(self):
+        dbapi = types.SimpleNamespace(connect=lambda **params: FormatConnection(db=self.db),
+                                      Error=sqlite3.Error, threadsafety=2)
+        pool = antipool.ConnectionPool(dbapi, {'reapsecs': 0}, database='payers')
+        self.addCleanup(pool.finalize)
+        conn = pool.connection()
+        payer = Payers.get(conn, id=1)
+        self.assertIs(Payers.get(conn, id=1), payer)
+        PayersAdmin.update(conn, 'WHERE id = %s', (1,), name='CMS')
+        Payers.get(conn, id=1)
+        self.assertEqual(Payers.cache_stats()['size'], 0)
+        conn.commit()
+        self.assertEqual(Payers.get(conn, id=1).name, 'CMS')
+        self.assertEqual(Payers.cache_stats()['size'], 1)
+        payer = Payers.get(conn, id=1)
+        conn.rollback()
+        self.assertIsNot(Payers.get(conn, id=1), payer)
+        conn.release()
+
+    def test_entries_expire_and_are_bounded(self):
+        cache = MormCache(maxsize=2, ttl=10)
+        with unittest.mock.patch.object(antiorm, '_clock', return_value=100):
+            cache.put('a', 1)
+            cache.put('b', 2)
+            self.assertEqual(cache.get('a'), 1)
+            cache.put('c', 3)
+            self.assertIsNone(cache.get('b'))
+        with unittest.mock.patch.object(antiorm, '_clock', return_value=111):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2, 'size': 1})
+
+    def test_commits_clear_rows_cached_by_other_connections(self):
+        path = os.path.join(tempfile.mkdtemp(), 'payers.db')
+        self.addCleanup(os.remove, path)
+        self.db.backup(sqlite3.connect(path))
+        writer, reader, later = [FormatConnection(db=sqlite3.connect(path)) for _ in range(3)]
+        for conn in writer, reader, later:
+            self.addCleanup(conn.close)
+
+        PayersAdmin.update(writer, 'WHERE id = %s', (1,), name='CMS')
+        self.assertEqual(Payers.get(reader, id=1).name, 'Medicare')
+        self.assertEqual(Payers.cache_stats()['size'], 1)
+        writer.commit()
+        self.assertEqual(Payers.get(later, id=1).name, 'CMS')
+        reader.commit()
+        self.assertEqual(Payers.get(reader, id=1).name, 'CMS')
+
+    def test_values_computed_before_a_clear_are_dropped(self):
+        cache = MormCache(maxsize=2, ttl=10)
+        generation = cache.generation
+        cache.clear()
+        cache.put('a', 1, generation)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 1, cache.generation)
+        self.assertEqual(cache.get('a'), 1)
+
+    def test_unhashable_constraints_are_not_cached(self):
+        conn = self.connect()
+        self.assertIsNone(Payers.get(conn, default=None, id=bytearray(b'1')))
+        self.assertEqual(Payers.cache_stats()['size'], 0)
+
+
+class TestDecoder(unittest.TestCase):
+
+    def test_rows_have_slots_and_converted_values(self):
+        dec = MormDecoder(Billing, ['id', 'patient', 'cost'])
+        obj = dec.decode((1, 'p1', 12.5))
+        self.assertIsInstance(obj, MormObject)
+        self.assertEqual((obj.id, obj.patient, obj.cost), (1, 'p1', 1250))
+        self.assertEqual(type(obj).__slots__, ('id', 'patient', 'cost'))
+        obj.extra = True
+        self.assertIs(type(MormDecoder(Billing, ['id', 'patient', 'cost']).decode((2, 'p', 0))),
+                      type(obj))
+
+    def test_rows_pickle_as_plain_objects(self):
+        obj = MormDecoder(Billing, ['id', 'cost']).decode((1, 0.5))
+        copy = pickle.loads(pickle.dumps(obj))
+        self.assertIs(type(copy), MormObject)
+        self.assertEqual(vars(copy), {'id': 1, 'cost': 50})
+
+    def test_dotted_names_use_the_named_table(self):
+        dec = MormDecoder((Encounters, Billing), ['encounters.cost', 'cost'])
+        obj = dec.decode((1.0, 2.0))
+        self.assertEqual(obj.cost, 200)
+        self.assertEqual(dec.decode((1.0, None)).cost, None)
+
+    def test_declared_object_class_and_explicit_objects(self):
+        dec = MormDecoder(Visits, ['id', 'patient'])
+        self.assertIsInstance(dec.decode((1, 'p')), Visit)
+        target = Visit()
+        self.assertIs(dec.decode((2, 'q'), obj=target), target)
+        self.assertEqual(target.patient, 'q')
+        self.assertIsInstance(MormDecoder(Billing, ['id']).decode((1,), objcls=Visit), Visit)
+
+    def test_expression_columns(self):
+        obj = MormDecoder(Encounters, ['count(*)', 'id']).decode((3, 1))
+        self.assertEqual((getattr(obj, 'count(*)'), obj.id), (3, 1))
+
+    def test_wrong_row_length(self):
+        for cols in (['id', 'cost'], ['count(*)', 'id']):
+            dec = MormDecoder(Billing, cols)
+            self.assertRaises(MormError, dec.decode, (1,))
+            self.assertRaises(MormError, dec.decode, (1, 2, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
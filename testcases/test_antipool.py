@@ -0,0 +1,884 @@
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+import unittest.mock
+
+# The vendored DB libraries import each other as top-level modules
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'Scripts', 'ypes')))
+import antipool
+from antipool import ConnectionPool, Counter, PoolTimeout
+
+
+class FakeError(Exception):
+    pass
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.executed = []
+
+    def execute(self, query, args=None):
+        if self.conn.broken:
+            raise FakeError("connection is broken")
+        self.executed.append((query, args))
+
+    def fetchone(self):
+        return (1,)
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, dbapi, params):
+        self.dbapi = dbapi
+        self.params = params
+        self.closed = False
+        self.broken = False
+        self.rollbacks = 0
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        if self.broken:
+            raise FakeError("connection is broken")
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDBAPI(object):
+    """Minimal DBAPI-2.0 module that records the connections it hands out."""
+    Error = FakeError
+    threadsafety = 2
+    paramstyle = 'pyformat'
+
+    def __init__(self):
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connect(self, **params):
+        conn = FakeConnection(self, params)
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+
+class PreparingCursor(FakeCursor):
+    """Cursor of a driver with server-side prepare, Oracle style."""
+    def __init__(self, conn):
+        FakeCursor.__init__(self, conn)
+        self.prepared = None
+        self.closed = False
+
+    def prepare(self, query):
+        self.prepared = query
+
+    def close(self):
+        self.closed = True
+
+
+class GatedDBAPI(FakeDBAPI):
+    """Driver whose connect() blocks while the gate is closed."""
+    def __init__(self):
+        FakeDBAPI.__init__(self)
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def connect(self, **params):
+        self.gate.wait(5)
+        return FakeDBAPI.connect(self, **params)
+
+
+class SocketConnection(FakeConnection):
+    """Connection over a socket, which sends a terminate message on close."""
+    def __init__(self, dbapi, params):
+        FakeConnection.__init__(self, dbapi, params)
+        self.sock, self.server = socket.socketpair()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        os.write(self.sock.fileno(), b'X')
+        self.closed = True
+
+
+class SocketDBAPI(FakeDBAPI):
+    def connect(self, **params):
+        conn = SocketConnection(self, params)
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def make_pool(self, **options):
+        options.setdefault('reapsecs', 0)
+        options.setdefault('prewarm', False)
+        self.dbapi = FakeDBAPI()
+        pool = ConnectionPool(self.dbapi, options, database='test')
+        self.addCleanup(pool.finalize)
+        return pool
+
+    def test_lifo_reuses_most_recently_released(self):
+        pool = self.make_pool()
+        first, second = pool._acquire(), pool._acquire()
+        pool._release(first)
+        pool._release(second)
+        conn = pool._acquire()
+        pool._release(conn)
+        self.assertIs(conn, second)
+
+    def test_fifo_reuses_least_recently_released(self):
+        pool = self.make_pool(pool_order='fifo')
+        first, second = pool._acquire(), pool._acquire()
+        pool._release(first)
+        pool._release(second)
+        conn = pool._acquire()
+        pool._release(conn)
+        self.assertIs(conn, first)
+
+    def test_invalid_pool_order(self):
+        with self.assertRaises(antipool.Error):
+            self.make_pool(pool_order='random')
+
+    def test_scaledown_reaps_oldest_beyond_minconn(self):
+        pool = self.make_pool(minconn=1, minkeepsecs=0)
+        conns = [pool._acquire() for _ in range(3)]
+        for conn in conns:
+            pool._release(conn)
+        time.sleep(0.01)
+
+        self.assertEqual(pool._scaledown(), 2)
+        self.assertEqual(pool.getstats(), (1, 1))
+        self.assertEqual([conn.closed for conn in conns], [True, True, False])
+
+    def test_scaledown_keeps_recently_released(self):
+        pool = self.make_pool(minconn=0, minkeepsecs=60)
+        pool._release(pool._acquire())
+        self.assertEqual(pool._scaledown(), 0)
+        self.assertEqual(pool.getstats(), (1, 1))
+
+    def test_janitor_reaps_in_background(self):
+        pool = self.make_pool(minconn=0, minkeepsecs=0, reapsecs=0.01)
+        conn = pool._acquire()
+        pool._release(conn)
+        deadline = time.time() + 2
+        while not conn.closed and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.getstats(), (0, 0))
+
+    def test_hosed_connection_is_ditched_on_release(self):
+        pool = self.make_pool()
+        conn = pool._acquire()
+        conn.broken = True
+        pool._release(conn)
+        self.assertEqual(pool.getstats(), (0, 0))
+
+    def wait_for_waiters(self, pool, count):
+        deadline = time.time() + 2
+        while len(pool._waiters) < count and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(len(pool._waiters), count)
+
+    def test_acquire_timeout_raises_pool_timeout(self):
+        pool = self.make_pool(maxconn=1)
+        conn = pool._acquire()
+        start = time.time()
+        with self.assertRaises(PoolTimeout):
+            pool._acquire(timeout=0.05)
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        self.assertEqual(len(pool._waiters), 0)
+        pool._release(conn)
+        self.assertEqual(pool.getstats(extended=True)['timeouts'], 1)
+
+    def test_default_acquire_timeout_option(self):
+        pool = self.make_pool(maxconn=1, acquire_timeout=0.01)
+        conn = pool._acquire()
+        with self.assertRaises(PoolTimeout):
+            pool.connection()
+        pool._release(conn)
+
+    def test_waiters_are_served_in_arrival_order(self):
+        pool = self.make_pool(maxconn=1)
+        held = pool._acquire()
+        served = []
+
+        def worker(index):
+            conn = pool._acquire()
+            served.append(index)
+            pool._release(conn)
+
+        threads = []
+        for index in range(5):
+            thread = threading.Thread(target=worker, args=(index,))
+            thread.start()
+            threads.append(thread)
+            self.wait_for_waiters(pool, index + 1)
+
+        pool._release(held)
+        for thread in threads:
+            thread.join(2)
+        self.assertEqual(served, [0, 1, 2, 3, 4])
+
+    def test_released_connection_is_not_taken_over_by_newcomers(self):
+        pool = self.make_pool(maxconn=1)
+        held = pool._acquire()
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(pool._acquire()))
+        waiter.start()
+        self.wait_for_waiters(pool, 1)
+
+        pool._release(held)
+        with self.assertRaises(PoolTimeout):
+            pool._acquire(timeout=0.01)
+        waiter.join(2)
+        self.assertEqual(result, [held])
+        pool._release(held)
+
+    def test_ditched_connection_slot_goes_to_waiter(self):
+        pool = self.make_pool(maxconn=1)
+        held = pool._acquire()
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(pool._acquire()))
+        waiter.start()
+        self.wait_for_waiters(pool, 1)
+
+        held.broken = True
+        pool._release(held)
+        waiter.join(2)
+        self.assertEqual(len(result), 1)
+        self.assertIsNot(result[0], held)
+        self.assertEqual(pool.getstats(), (1, 0))
+        pool._release(result[0])
+
+    def test_extended_stats(self):
+        pool = self.make_pool()
+        conn = pool._acquire()
+        time.sleep(0.01)
+        pool._release(conn)
+
+        stats = pool.getstats(extended=True)
+        self.assertEqual((stats['total'], stats['pool_size']), pool.getstats())
+        self.assertEqual(stats['waiting'], 0)
+        self.assertEqual(stats['wait_time']['count'], 1)
+        self.assertEqual(stats['hold_time']['count'], 1)
+        self.assertGreaterEqual(stats['hold_time']['sum'], 0.01)
+        self.assertEqual(stats['hold_time']['buckets'][-1], (float('inf'), 1))
+
+    def test_pre_ping_replaces_dead_idle_connection(self):
+        pool = self.make_pool(pre_ping=True)
+        dead = pool._acquire()
+        pool._release(dead)
+        dead.broken = True
+
+        conn = pool._acquire()
+        self.assertIsNot(conn, dead)
+        self.assertTrue(dead.closed)
+        pool._release(conn)
+        stats = pool.getstats(extended=True)
+        self.assertEqual((stats['total'], stats['ditched']), (1, 1))
+
+    def test_pre_ping_uses_custom_statement(self):
+        pool = self.make_pool(pre_ping='SELECT 42')
+        conn = pool._acquire()
+        pool._release(conn)
+        pinged = []
+        conn.cursor = lambda: pinged.append(FakeCursor(conn)) or pinged[-1]
+        pool._release(pool._acquire())
+        self.assertEqual(pinged[0].executed, [('SELECT 42', None)])
+
+    def test_max_uses_recycles_connection(self):
+        pool = self.make_pool(max_uses=2)
+        first = pool._acquire()
+        pool._release(first)
+        self.assertIs(pool._acquire(), first)
+        pool._release(first)
+        self.assertTrue(first.closed)
+        self.assertEqual(pool.getstats(), (0, 0))
+
+        conn = pool._acquire()
+        self.assertIsNot(conn, first)
+        pool._release(conn)
+        self.assertEqual(pool.getstats(extended=True)['recycled'], 1)
+
+    def test_max_lifetime_recycles_connection_on_release(self):
+        pool = self.make_pool(max_lifetime=0.01)
+        conn = pool._acquire()
+        time.sleep(0.02)
+        pool._release(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.getstats(), (0, 0))
+
+    def test_keepalive_closes_dead_idle_connections(self):
+        pool = self.make_pool(keepalive_secs=0.01)
+        conns = [pool._acquire() for _ in range(3)]
+        for conn in conns:
+            pool._release(conn)
+        conns[1].broken = True
+
+        # The janitor runs every keepalive_secs
+        deadline = time.time() + 2
+        while not conns[1].closed and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(conns[1].closed)
+        self.assertEqual(pool.getstats(), (2, 2))
+        self.assertEqual([item[0] for item in pool._pool], [conns[0], conns[2]])
+        self.assertEqual(pool.getstats(extended=True)['ditched'], 1)
+
+    def test_read_connections_least_outstanding_routing(self):
+        pool = self.make_pool(ro_conns=2)
+        first = pool.connection_ro()
+        second = pool.connection_ro()
+        self.assertIsNot(first._conn, second._conn)
+
+        second.release()
+        third = pool.connection_ro()
+        self.assertIs(third._conn, self.dbapi.connections[1])
+        fourth = pool.connection_ro()
+        self.assertIn(fourth._conn, self.dbapi.connections)
+        self.assertEqual(len(self.dbapi.connections), 2)
+        self.assertEqual(pool.getstats(), (2, 0))
+        for conn in (first, third, fourth):
+            conn.release()
+
+    def test_read_endpoints_spread_reads_and_report_stats(self):
+        pool = self.make_pool(ro_endpoints=[{}, {'host': 'replica1'}], user_readonly='reader')
+        readers = [pool.connection_ro() for _ in range(4)]
+        hosts = sorted(reader._conn.params.get('host', 'primary') for reader in readers)
+        self.assertEqual(hosts, ['primary', 'primary', 'replica1', 'replica1'])
+        self.assertTrue(all(reader._conn.params['user'] == 'reader' for reader in readers))
+
+        readers.pop().release()
+        stats = pool.getstats(extended=True)['read_endpoints']
+        self.assertEqual([endpoint['name'] for endpoint in stats], ['primary', 'replica1'])
+        self.assertEqual([endpoint['connections'] for endpoint in stats], [1, 1])
+        self.assertEqual(sum(endpoint['outstanding'] for endpoint in stats), 3)
+        self.assertEqual(sum(endpoint['acquired'] for endpoint in stats), 4)
+        for reader in readers:
+            reader.release()
+
+    def test_hosed_read_connection_is_ditched(self):
+        pool = self.make_pool(ro_conns=2)
+        reader = pool.connection_ro()
+        conn = reader._conn
+        conn.broken = True
+        reader.release()
+        self.assertEqual(pool.getstats(), (0, 0))
+        self.assertEqual(pool.getstats(extended=True)['read_endpoints'][0]['errors'], 1)
+
+        reader = pool.connection_ro()
+        self.assertIsNot(reader._conn, conn)
+        reader.release()
+        pool.finalize()
+        self.assertTrue(self.dbapi.connections[1].closed)
+
+    def count_cursors(self, conn):
+        created = []
+        make_cursor = conn.cursor
+
+        def cursor():
+            created.append(make_cursor())
+            return created[-1]
+        conn.cursor = cursor
+        return created
+
+    def test_statement_cache_reuses_cursor_across_acquisitions(self):
+        pool = self.make_pool(stmt_cache_size=4)
+        created = None
+        for _ in range(3):
+            with pool.connection() as conn:
+                if created is None:
+                    created = self.count_cursors(conn._conn)
+                cursor = conn.cursor()
+                cursor.execute("SELECT name FROM users WHERE id = %s", (1,))
+                self.assertEqual(cursor.fetchone(), (1,))
+        self.assertEqual(len(created), 1)
+        self.assertEqual(len(created[0].executed), 3)
+        self.assertEqual(pool.getstats(extended=True)['stmt_cache'],
+                         {'hits': 2, 'misses': 1, 'evictions': 0})
+
+    def test_statement_cache_prepares_when_supported(self):
+        pool = self.make_pool(stmt_cache_size=4)
+        conn = pool.connection()
+        conn._conn.cursor = lambda: PreparingCursor(conn._conn)
+        for user_id in (1, 2):
+            conn.cursor().execute("SELECT name FROM users WHERE id = :id", {'id': user_id})
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM users WHERE id = :id", {'id': 3})
+        self.assertEqual(cursor.prepared, "SELECT name FROM users WHERE id = :id")
+        self.assertEqual(cursor.executed, [(None, {'id': 1}), (None, {'id': 2}), (None, {'id': 3})])
+        conn.release()
+
+    def test_statement_cache_is_bounded(self):
+        pool = self.make_pool(stmt_cache_size=2)
+        conn = pool.connection()
+        conn._conn.cursor = lambda: PreparingCursor(conn._conn)
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        first = cursor._curs
+        cursor.execute("SELECT 2")
+        cursor.execute("SELECT 3")
+        self.assertTrue(first.closed)
+        cache = pool._statement_cache(conn._conn)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats.evictions, 1)
+        conn.release()
+
+    def test_statement_cache_does_not_share_a_lent_cursor(self):
+        pool = self.make_pool(stmt_cache_size=4)
+        conn = pool.connection()
+        first, second = conn.cursor(), conn.cursor()
+        first.execute("SELECT 1")
+        second.execute("SELECT 1")
+        self.assertIsNot(first._curs, second._curs)
+        first.close()
+        third = conn.cursor()
+        third.execute("SELECT 1")
+        self.assertIs(third._curs, pool._statement_cache(conn._conn)._entries["SELECT 1"][0])
+        conn.release()
+
+    def test_statement_cache_dropped_with_ditched_connection(self):
+        pool = self.make_pool(stmt_cache_size=4)
+        conn = pool.connection()
+        conn.cursor().execute("SELECT 1")
+        raw = conn._conn
+        raw.broken = True
+        conn.release()
+
+        conn = pool.connection()
+        self.assertIsNot(conn._conn, raw)
+        self.assertEqual(len(pool._statement_cache(conn._conn)), 0)
+        conn.cursor().execute("SELECT 1")
+        conn.release()
+        self.assertEqual(pool.getstats(extended=True)['stmt_cache'],
+                         {'hits': 0, 'misses': 2, 'evictions': 0})
+
+    def test_statement_cache_disabled_by_default(self):
+        pool = self.make_pool()
+        conn = pool.connection()
+        self.assertIsInstance(conn.cursor(), FakeCursor)
+        conn.release()
+
+    def test_metrics_count_connection_events(self):
+        pool = self.make_pool(maxconn=1, minconn=0, minkeepsecs=0)
+        conn = pool.connection()
+        with self.assertRaises(PoolTimeout):
+            pool.connection(timeout=0.01)
+        self.assertEqual(pool.gauges(), {'in_use': 1, 'idle': 0, 'pending': 0, 'waiting': 0,
+                                         'read_connections': 0})
+        conn._conn.broken = True
+        conn.release()
+        pool.connection().release()
+        reader = pool.connection_ro()
+        reader.release()
+        time.sleep(0.01)
+        pool._scaledown()
+
+        metrics = pool.metrics
+        self.assertEqual(
+            {attr: getattr(metrics, attr).value for attr, name, help in metrics.counters},
+            {'created': 3, 'closed': 1, 'ditched': 1, 'recycled': 0,
+             'acquired': 3, 'released': 3, 'timeouts': 1})
+        self.assertEqual(metrics.acquire_time.count, 2)
+
+    def test_exposition_format(self):
+        pool = self.make_pool()
+        pool.connection().release()
+        text = pool.exposition(labels={'pool': 'cms'})
+        lines = text.splitlines()
+        self.assertTrue(text.endswith('\n'))
+        self.assertIn('# TYPE antipool_connections_created_total counter', lines)
+        self.assertIn('antipool_connections_created_total{pool="cms"} 1', lines)
+        self.assertIn('# TYPE antipool_connections_idle gauge', lines)
+        self.assertIn('antipool_connections_idle{pool="cms"} 1', lines)
+        self.assertIn('# TYPE antipool_acquire_seconds histogram', lines)
+        self.assertIn('antipool_acquire_seconds_bucket{pool="cms",le="+Inf"} 1', lines)
+        self.assertIn('antipool_acquire_seconds_count{pool="cms"} 1', lines)
+        for line in lines:
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                float(value)
+
+    def test_counter_increments_are_atomic(self):
+        counter = Counter()
+
+        def worker():
+            for _ in range(10000):
+                counter.inc()
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.value, 80000)
+        counter.inc(5)
+        self.assertEqual(counter.value, 80005)
+
+    def test_stats_are_read_without_pool_locks(self):
+        pool = self.make_pool()
+        pool.connection().release()
+        pool.connection_ro().release()
+        locked, done = threading.Event(), threading.Event()
+
+        def hold_locks():
+            with pool._pool_lock, pool._roconn_lock:
+                locked.set()
+                done.wait(2)
+
+        holder = threading.Thread(target=hold_locks)
+        holder.start()
+        locked.wait(2)
+        try:
+            self.assertEqual(pool.getstats(), (2, 1))
+            self.assertEqual(pool.getstats(extended=True)['total'], 2)
+            self.assertIn('antipool_connections_in_use 0', pool.exposition())
+        finally:
+            done.set()
+            holder.join()
+
+    def test_debug_log_is_only_formatted_when_enabled(self):
+        class Unprintable(object):
+            def __str__(self):
+                raise AssertionError("formatted")
+
+        pool = self.make_pool()
+        pool._log('Connection: %s', Unprintable())
+
+        lines = []
+
+        class Writer(object):
+            def write(self, line):
+                lines.append(line)
+
+        pool = self.make_pool(debug=Writer())
+        pool.connection().release()
+        self.assertTrue(any('Acquire (end  )  Pool: 0  / Created: 1' in line for line in lines))
+
+    def wait_until(self, predicate):
+        deadline = time.time() + 2
+        while not predicate() and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertTrue(predicate())
+
+    def test_prewarm_opens_minconn_in_background(self):
+        dbapi = GatedDBAPI()
+        dbapi.gate.clear()
+        pool = ConnectionPool(dbapi, {'minconn': 3, 'reapsecs': 0, 'prewarm': True},
+                              database='test')
+        self.addCleanup(pool.finalize)
+        self.wait_until(lambda: pool.getstats(extended=True)['pending'] == 1)
+        self.assertEqual(pool.getstats(), (1, 0))
+
+        dbapi.gate.set()
+        self.wait_until(lambda: pool.getstats() == (3, 3))
+        conn = pool._acquire()
+        pool._release(conn)
+        self.assertEqual(len(dbapi.connections), 3)
+
+    def test_prewarm_respects_maxconn(self):
+        dbapi = FakeDBAPI()
+        pool = ConnectionPool(dbapi, {'minconn': 5, 'maxconn': 2, 'reapsecs': 0,
+                                      'prewarm': True}, database='test')
+        self.addCleanup(pool.finalize)
+        self.wait_until(lambda: pool.getstats() == (2, 2))
+        self.assertEqual(pool._fill(), 0)
+
+    def test_prewarm_is_opt_in(self):
+        dbapi = FakeDBAPI()
+        pool = ConnectionPool(dbapi, {'minconn': 3, 'reapsecs': 0}, database='test')
+        self.addCleanup(pool.finalize)
+        pool._housekeep()
+        self.assertEqual(pool.getstats(), (0, 0))
+        self.assertEqual(dbapi.connections, [])
+
+    def test_prewarm_waits_for_first_acquire_after_fork(self):
+        pool = self.make_pool(minconn=2, prewarm=True)
+        self.wait_until(lambda: pool.getstats() == (2, 2))
+        pool._pid = -1
+        pool._check_pid()
+        self.assertEqual(pool.getstats(), (0, 0))
+        pool._housekeep()
+        self.assertEqual(pool.getstats(), (0, 0))
+
+        pool._release(pool._acquire())
+        self.wait_until(lambda: pool.getstats() == (2, 2))
+
+    def test_janitor_tops_up_to_minconn(self):
+        pool = self.make_pool(minconn=2, prewarm=True)
+        self.wait_until(lambda: pool.getstats() == (2, 2))
+        conn = pool._acquire()
+        conn.broken = True
+        pool._release(conn)
+        self.assertEqual(pool.getstats(), (1, 1))
+        pool._housekeep()
+        self.assertEqual(pool.getstats(), (2, 2))
+
+    def test_connection_creation_does_not_hold_the_pool_lock(self):
+        self.dbapi = dbapi = GatedDBAPI()
+        pool = ConnectionPool(dbapi, {'reapsecs': 0, 'prewarm': False}, database='test')
+        self.addCleanup(pool.finalize)
+        idle = pool._acquire()
+        dbapi.gate.clear()
+        slow = []
+        creator = threading.Thread(target=lambda: slow.append(pool._acquire()))
+        creator.start()
+        self.wait_until(lambda: pool._pending == 1)
+
+        # The idle connection can be released and acquired meanwhile
+        pool._release(idle)
+        start = time.time()
+        self.assertIs(pool._acquire(), idle)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(pool.gauges()['pending'], 1)
+
+        dbapi.gate.set()
+        creator.join(2)
+        self.assertEqual(pool.getstats(extended=True)['pending'], 0)
+        pool._release(idle)
+        pool._release(slow[0])
+        self.assertEqual(pool.getstats(), (2, 2))
+
+    def test_read_connection_creation_does_not_hold_the_lock(self):
+        self.dbapi = dbapi = GatedDBAPI()
+        pool = ConnectionPool(dbapi, {'reapsecs': 0, 'ro_endpoints': [{}, {'host': 'replica1'}]},
+                              database='test')
+        self.addCleanup(pool.finalize)
+        fast = pool.connection_ro()
+        dbapi.gate.clear()
+        slow, joined = [], []
+        creator = threading.Thread(target=lambda: slow.append(pool.connection_ro()))
+        creator.start()
+        self.wait_until(lambda: pool._roslots[1].opening is not None)
+
+        # The open connection is handed out meanwhile
+        start = time.time()
+        shared = pool.connection_ro()
+        self.assertIs(shared._conn, fast._conn)
+        self.assertLess(time.time() - start, 0.5)
+
+        # A third reader picks the slot being opened and waits for it
+        joiner = threading.Thread(target=lambda: joined.append(pool.connection_ro()))
+        joiner.start()
+        self.wait_until(lambda: pool._roslots[1].refs == 2)
+        dbapi.gate.set()
+        creator.join(2)
+        joiner.join(2)
+        self.assertIs(joined[0]._conn, slow[0]._conn)
+        self.assertEqual(slow[0]._conn.params.get('host'), 'replica1')
+        for reader in (fast, shared, slow[0], joined[0]):
+            reader.release()
+        self.assertEqual(pool.getstats(extended=True)['read_endpoints'][1]['acquired'], 2)
+
+    def test_failed_read_connection_frees_its_slot(self):
+        pool = self.make_pool()
+
+        def fail(**params):
+            raise FakeError("cannot connect")
+        connect, self.dbapi.connect = self.dbapi.connect, fail
+        with self.assertRaises(FakeError):
+            pool.connection_ro()
+        slot = pool._roslots[0]
+        self.assertEqual((slot.refs, slot.opening, slot.conn), (0, None, None))
+        self.dbapi.connect = connect
+        pool.connection_ro().release()
+
+    def test_failed_creation_frees_its_slot(self):
+        pool = self.make_pool(maxconn=1)
+
+        def fail(**params):
+            raise FakeError("cannot connect")
+        self.dbapi.connect = fail
+        with self.assertRaises(FakeError):
+            pool._acquire()
+        self.assertEqual(pool.getstats(extended=True)['pending'], 0)
+        self.assertEqual(pool.getstats(), (0, 0))
+
+    def test_pid_check_forgets_connections_of_another_process(self):
+        pool = self.make_pool()
+        inherited = pool._acquire()
+        pool._release(inherited)
+        pool._pid = -1
+        with unittest.mock.patch.object(antipool, '_check_fork', True):
+            conn = pool._acquire()
+        self.assertIsNot(conn, inherited)
+        self.assertEqual(pool._pid, os.getpid())
+        self.assertIn(inherited, antipool._orphans)
+        pool._release(conn)
+        self.assertEqual(pool.getstats(), (1, 1))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "requires fork()")
+    def test_concurrent_use_after_fork(self):
+        dbapi = SocketDBAPI()
+        pool = ConnectionPool(dbapi, {'maxconn': 3, 'reapsecs': 0, 'prewarm': False},
+                              database='test')
+        self.addCleanup(pool.finalize)
+        conns = [pool._acquire() for _ in range(3)]
+        idle, held = conns[:2], conns[2]
+        for conn in idle:
+            pool._release(conn)
+        inherited = set(dbapi.connections)
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                assert pool.getstats() == (0, 0)
+                # Closing the inherited connections must not reach the parent
+                for conn in idle:
+                    conn.close()
+                pool._release(held)
+                assert pool.getstats() == (0, 0)
+
+                errors = []
+
+                def worker():
+                    try:
+                        for _ in range(50):
+                            conn = pool._acquire(timeout=5)
+                            assert conn not in inherited
+                            pool._release(conn)
+                    except Exception as e:
+                        errors.append(e)
+
+                threads = [threading.Thread(target=worker) for _ in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                total, pool_size = pool.getstats()
+                status = 0 if not errors and 1 <= total <= 3 and pool_size == total else 2
+            finally:
+                os._exit(status)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+        # The parent's connections were left alone
+        for conn in idle + [held]:
+            self.assertFalse(conn.closed)
+            conn.server.setblocking(False)
+            with self.assertRaises(BlockingIOError):
+                conn.server.recv(1)
+            conn.server.sendall(b'ping')
+            self.assertEqual(conn.sock.recv(4), b'ping')
+        pool._release(held)
+        self.assertEqual(pool.getstats(), (3, 3))
+
+
+class FakeTable(object):
+    """Anti-ORM style table whose operations take the connection first."""
+    def __init__(self):
+        self.conns = []
+
+    def insert(self, conn, value):
+        self.conns.append(conn)
+        conn.cursor().execute("INSERT INTO t VALUES (%s)", (value,))
+
+    def select_all(self, conn):
+        self.conns.append(conn)
+        return [(1,)]
+
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        self.dbapi = FakeDBAPI()
+        self.pool = ConnectionPool(self.dbapi, {'reapsecs': 0, 'prewarm': False,
+                                                'disable_ro': True},
+                                   database='test')
+        self.addCleanup(self.pool.finalize)
+        previous = antipool.dbpool()
+        antipool.initpool(self.pool)
+        self.addCleanup(antipool.initpool, previous)
+        self.table = FakeTable()
+
+    def test_connop_outside_session_commits_without_extra_rollback(self):
+        antipool.ConnOp(self.table).insert(1)
+        conn = self.dbapi.connections[0]
+        self.assertEqual((conn.commits, conn.rollbacks), (1, 0))
+
+    def test_session_pins_one_connection_and_commits_once(self):
+        op = antipool.ConnOp(self.table)
+
+        @antipool.connected
+        def write(value, conn):
+            self.table.insert(conn, value)
+
+        @antipool.connected_ro
+        def read(conn):
+            return self.table.select_all(conn)
+
+        with antipool.session() as sess:
+            op.insert(1)
+            op.select_all()
+            write(2)
+            read()
+            self.assertIs(sess.connection(), self.table.conns[0])
+        self.assertEqual(len(set(map(id, self.table.conns))), 1)
+        self.assertEqual(len(self.dbapi.connections), 1)
+        conn = self.dbapi.connections[0]
+        self.assertEqual((conn.commits, conn.rollbacks), (1, 0))
+        self.assertEqual(self.pool.getstats(), (1, 1))
+        self.assertEqual(self.pool.metrics.acquired.value, 1)
+
+    def test_session_acquires_lazily(self):
+        with antipool.session():
+            pass
+        self.assertEqual(self.dbapi.connections, [])
+
+    def test_exception_rolls_back_session(self):
+        with self.assertRaises(ValueError):
+            with antipool.session():
+                antipool.ConnOp(self.table).insert(1)
+                raise ValueError
+        conn = self.dbapi.connections[0]
+        self.assertEqual((conn.commits, conn.rollbacks), (0, 1))
+        self.assertEqual(self.pool.getstats(), (1, 1))
+
+    def test_nested_session_joins_and_marks_rollback(self):
+        with antipool.session() as outer:
+            antipool.ConnOp(self.table).insert(1)
+            try:
+                with antipool.session() as inner:
+                    self.assertIs(inner, outer)
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertTrue(outer.rollback_only)
+        conn = self.dbapi.connections[0]
+        self.assertEqual((conn.commits, conn.rollbacks), (0, 1))
+
+    def test_sessions_are_per_thread(self):
+        seen = []
+
+        def worker():
+            seen.append(antipool._current_session.get())
+
+        with antipool.session():
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+        self.assertEqual(seen, [None])
+        self.assertIsNone(antipool._current_session.get())
+
+
+if __name__ == '__main__':
+    unittest.main()
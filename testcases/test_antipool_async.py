@@ -0,0 +1,174 @@
+import asyncio
+import os
+import sqlite3
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'Scripts', 'ypes')))
+from antipool import Error, PoolTimeout
+from antipool_async import AsyncConnectionPool
+from test_antipool import FakeDBAPI, FakeError
+
+
+class FakeAsyncCursor(object):
+    def __init__(self):
+        self.executed = []
+
+    async def execute(self, query, args=None):
+        await asyncio.sleep(0)
+        self.executed.append((query, args))
+
+    async def fetchall(self):
+        return [(1,)]
+
+
+class FakeAsyncConnection(object):
+    def __init__(self):
+        self.closed = False
+        self.commits = 0
+
+    async def cursor(self):
+        return FakeAsyncCursor()
+
+    async def commit(self):
+        self.commits += 1
+
+    async def rollback(self):
+        pass
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeAsyncDriver(object):
+    Error = FakeError
+
+    def __init__(self):
+        self.connections = []
+
+    async def connect(self, **params):
+        conn = FakeAsyncConnection()
+        self.connections.append(conn)
+        return conn
+
+
+class TestAsyncConnectionPool(unittest.IsolatedAsyncioTestCase):
+
+    async def test_blocking_driver_runs_in_executor(self):
+        pool = AsyncConnectionPool(sqlite3, database=':memory:', check_same_thread=False)
+        async with pool.connection() as conn:
+            cursor = await conn.cursor()
+            await cursor.execute("SELECT 1 + 1")
+            self.assertEqual(await cursor.fetchall(), [(2,)])
+            self.assertEqual(cursor.description[0][0], '1 + 1')
+        self.assertEqual(pool.getstats(), (1, 1))
+        await pool.finalize()
+        self.assertEqual(pool.getstats(), (0, 0))
+
+    async def test_native_driver_is_awaited_directly(self):
+        driver = FakeAsyncDriver()
+        pool = AsyncConnectionPool(driver, database='test')
+        self.assertTrue(pool._native)
+        async with pool.connection() as conn:
+            cursor = await conn.cursor()
+            await cursor.execute("SELECT 1")
+        self.assertEqual(driver.connections[0].commits, 1)
+
+        conn = await pool.connection()
+        self.assertIs(conn._conn, driver.connections[0])
+        await conn.release()
+        await pool.finalize()
+        self.assertTrue(driver.connections[0].closed)
+
+    async def test_awaitable_connect_needs_native_option(self):
+        driver = FakeAsyncDriver()
+        connect = driver.connect
+        driver.connect = lambda **params: connect(**params)
+
+        pool = AsyncConnectionPool(driver, database='test')
+        self.assertFalse(pool._native)
+        with self.assertRaises(Error):
+            await pool.connection()
+        self.assertEqual(pool.getstats(), (0, 0))
+
+        pool = AsyncConnectionPool(driver, {'native': True}, database='test')
+        async with pool.connection() as conn:
+            cursor = await conn.cursor()
+            await cursor.execute("SELECT 1")
+        self.assertEqual(driver.connections[0].commits, 1)
+        await pool.finalize()
+
+    async def test_finalize_shuts_down_own_executor_only(self):
+        pool = AsyncConnectionPool(FakeDBAPI(), {'maxconn': 2}, database='test')
+        await (await pool.connection()).release()
+        await pool.finalize()
+        self.assertTrue(pool._executor._shutdown)
+
+        executor = ThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        pool = AsyncConnectionPool(FakeDBAPI(), {'maxconn': 2, 'executor': executor},
+                                   database='test')
+        await (await pool.connection()).release()
+        await pool.finalize()
+        self.assertFalse(executor._shutdown)
+
+    async def test_exception_rolls_back_and_releases(self):
+        dbapi = FakeDBAPI()
+        pool = AsyncConnectionPool(dbapi, database='test')
+        with self.assertRaises(ValueError):
+            async with pool.connection():
+                raise ValueError
+        conn = dbapi.connections[0]
+        self.assertEqual((conn.commits, conn.rollbacks), (0, 2))
+        self.assertEqual(pool.getstats(), (1, 1))
+
+    async def test_waiters_are_served_in_order_and_time_out(self):
+        pool = AsyncConnectionPool(FakeDBAPI(), {'maxconn': 1}, database='test')
+        held = await pool.connection()
+        served = []
+
+        async def worker(index):
+            async with pool.connection():
+                served.append(index)
+
+        tasks = [asyncio.create_task(worker(index)) for index in range(5)]
+        await asyncio.sleep(0.01)
+        with self.assertRaises(PoolTimeout):
+            await pool.connection(timeout=0.01)
+        self.assertEqual(len(pool._waiters), 5)
+
+        await held.release()
+        await asyncio.gather(*tasks)
+        self.assertEqual(served, [0, 1, 2, 3, 4])
+        self.assertEqual(pool.getstats(), (1, 1))
+
+    async def test_cancelled_waiter_gives_back_its_connection(self):
+        pool = AsyncConnectionPool(FakeDBAPI(), {'maxconn': 1}, database='test')
+        held = await pool.connection()
+        task = asyncio.create_task(pool._acquire())
+        await asyncio.sleep(0)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        await held.release()
+        self.assertEqual(pool.getstats(), (1, 1))
+        self.assertFalse(pool._waiters)
+
+    async def test_hosed_connection_slot_goes_to_waiter(self):
+        dbapi = FakeDBAPI()
+        pool = AsyncConnectionPool(dbapi, {'maxconn': 1}, database='test')
+        held = await pool.connection()
+        waiter = asyncio.create_task(pool._acquire())
+        await asyncio.sleep(0)
+
+        dbapi.connections[0].broken = True
+        await held.release()
+        conn = await waiter
+        self.assertIs(conn, dbapi.connections[1])
+        self.assertTrue(dbapi.connections[0].closed)
+        self.assertEqual(pool.getstats(), (1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
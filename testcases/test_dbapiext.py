@@ -0,0 +1,354 @@
+import datetime
+import os
+import sqlite3
+import sys
+import threading
+import unittest
+
+try:
+    import numpy
+    import pandas
+except ImportError:
+    numpy = pandas = None
+
+# The vendored DB libraries import each other as top-level modules
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'Scripts', 'ypes')))
+import dbapiext
+from dbapiext import (QueryCache, execute_f, execute_obj, executemany_f, fetch_columns,
+                      fetch_rows)
+
+
+class RecordingCursor(object):
+    """Cursor that records what it is asked to execute."""
+    def __init__(self):
+        self.executed = []
+        self.executedmany = []
+
+    def execute(self, query, args):
+        self.executed.append((query, args))
+
+    def executemany(self, query, seq_of_args):
+        self.executedmany.append((query, list(seq_of_args)))
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dbapiext._query_cache
+        dbapiext._query_cache = QueryCache(maxsize=4)
+        self.addCleanup(setattr, dbapiext, '_query_cache', self.saved)
+
+    def test_cache_is_bounded_and_evicts_least_recently_used(self):
+        cache = QueryCache(maxsize=2)
+        first = cache.lookup('SELECT %S', 'pyformat')
+        cache.lookup('SELECT %S, %S', 'pyformat')
+        self.assertIs(cache.lookup('SELECT %S', 'pyformat'), first)
+        cache.lookup('SELECT %S, %S, %S', 'pyformat')
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.lookup('SELECT %S', 'pyformat'), first)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 3, 'size': 2, 'maxsize': 2})
+
+    def test_cache_is_keyed_on_paramstyle(self):
+        cursor = RecordingCursor()
+        execute_f(cursor, 'SELECT * FROM t WHERE id = %S', 1, paramstyle='qmark')
+        execute_f(cursor, 'SELECT * FROM t WHERE id = %S', 1, paramstyle='pyformat')
+        self.assertEqual(cursor.executed, [
+            ('SELECT * FROM t WHERE id = ?', [1]),
+            ('SELECT * FROM t WHERE id = %(__p1)s', {'__p1': 1}),
+        ])
+
+    def test_paramstyle_keyword_is_not_passed_on_hits(self):
+        cursor = RecordingCursor()
+        for _ in range(2):
+            execute_f(cursor, 'SELECT %S', 1, paramstyle='format')
+        self.assertEqual(cursor.executed, [('SELECT %s', [1])] * 2)
+        self.assertEqual(dbapiext.cache_stats()['hits'], 1)
+
+    def test_precompile_and_resize(self):
+        analyzers = dbapiext.precompile(['SELECT %S', 'SELECT %s FROM t'])
+        self.assertEqual(dbapiext.cache_stats()['size'], 2)
+        self.assertIs(dbapiext._query_cache.lookup('SELECT %S'), analyzers[0])
+        dbapiext.set_cache_size(1)
+        self.assertEqual(dbapiext.cache_stats()['size'], 1)
+
+    def test_concurrent_lookups(self):
+        cache = QueryCache(maxsize=8)
+        errors = []
+
+        def worker(offset):
+            try:
+                for i in range(200):
+                    query = 'SELECT %%S FROM t%d' % ((i + offset) % 12)
+                    self.assertEqual(cache.lookup(query, 'qmark').orig_query, query)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        stats = cache.stats()
+        self.assertEqual(stats['hits'] + stats['misses'], 1600)
+        self.assertLessEqual(stats['size'], 8)
+
+
+class TestApplyFastPath(unittest.TestCase):
+
+    QUERY = """
+      SELECT %s FROM %(table)s
+       WHERE a = %S AND b = %(b)S AND c = %(b)X AND d > %d AND e = 100%%
+    """
+
+    def test_scalar_arguments_match_general_path(self):
+        for style in ('pyformat', 'named', 'qmark', 'format', 'numeric', 'atnamed'):
+            q = dbapiext.qcompile(self.QUERY, paramstyle=style)
+            kwds = {'__p1': 'col', '__p2': 'x', '__p3': 7, 'table': 't', 'b': None}
+            self.assertEqual(q.apply('col', 'x', 7, table='t', b=None),
+                             q.apply_expanded(kwds), style)
+
+    def test_sequences_and_dicts_take_general_path(self):
+        q = dbapiext.qcompile('UPDATE t SET %S WHERE id IN (%S)', paramstyle='qmark')
+        self.assertEqual(q.apply({'a': 1}, [2, 3]),
+                         ('UPDATE t SET a = ? WHERE id IN (?, ?)', [1, 2, 3]))
+
+    def test_missing_keyword_raises(self):
+        q = dbapiext.qcompile('SELECT %(a)S')
+        self.assertRaises(KeyError, q.apply)
+        self.assertRaises(TypeError, q.apply, 1, a=1)
+
+
+class TestExecuteMany(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.addCleanup(self.conn.close)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute("CREATE TABLE visits (id INTEGER, ward TEXT, cost REAL)")
+        self.rows = [(i, 'ward%d' % (i % 3), i * 1.5) for i in range(10)]
+
+    def fetch(self):
+        self.cursor.execute("SELECT id, ward, cost FROM visits ORDER BY id")
+        return self.cursor.fetchall()
+
+    def test_executemany_compiles_once_and_groups_rows(self):
+        cursor = RecordingCursor()
+        executemany_f(cursor, "INSERT INTO %(t)s VALUES (%(id)S, %(ward)S)",
+                      [{'id': 1}, {'id': 2, 'ward': 'b'}, {'id': 3, 't': 'old'}],
+                      t='visits', ward='a', paramstyle='qmark')
+        self.assertEqual(cursor.executedmany, [
+            ("INSERT INTO visits VALUES (?, ?)", [[1, 'a'], [2, 'b']]),
+            ("INSERT INTO old VALUES (?, ?)", [[3, 'a']]),
+        ])
+
+    def test_executemany_against_sqlite(self):
+        executemany_f(self.cursor, "INSERT INTO %(t)s VALUES (%S, %S, %S)", self.rows,
+                      t='visits', paramstyle='qmark')
+        self.assertEqual(self.fetch(), self.rows)
+
+    def test_batched_values(self):
+        cursor = RecordingCursor()
+        executemany_f(cursor, "INSERT INTO %(t)s (id, ward) VALUES (%S, lower(%S)) ;",
+                      [(1, 'A'), (2, 'B'), (3, 'C')], t='visits', batchsize=2,
+                      paramstyle='qmark')
+        self.assertEqual(cursor.executed, [
+            ("INSERT INTO visits (id, ward) VALUES (?, lower(?)), (?, lower(?)) ;",
+             [1, 'A', 2, 'B']),
+            ("INSERT INTO visits (id, ward) VALUES (?, lower(?)) ;", [3, 'C']),
+        ])
+
+    def test_batched_values_against_sqlite(self):
+        executemany_f(self.cursor, "INSERT INTO visits VALUES (%S, %S, %S)",
+                      iter(self.rows), batchsize=4, paramstyle='qmark')
+        self.assertEqual(self.fetch(), self.rows)
+
+    def test_batching_rejects_unsupported_queries(self):
+        cursor = RecordingCursor()
+        self.assertRaises(ValueError, executemany_f, cursor,
+                          "UPDATE visits SET cost = %S", [(1,)], batchsize=10)
+        self.assertRaises(ValueError, executemany_f, cursor,
+                          "INSERT INTO %s VALUES (%S)", [(1,)], batchsize=10)
+        self.assertRaises(ValueError, executemany_f, cursor,
+                          "INSERT INTO visits VALUES (%S, %(ward)S)", [(1,)],
+                          ward='a', batchsize=10)
+        self.assertRaises(TypeError, executemany_f, cursor,
+                          "INSERT INTO visits VALUES (%S, %S)", [(1,)], batchsize=10)
+
+
+class CountingCursor(object):
+    """Wraps a cursor to count the fetchmany() calls."""
+    def __init__(self, curs):
+        self.curs = curs
+        self.fetches = []
+
+    def __getattr__(self, name):
+        return getattr(self.curs, name)
+
+    def fetchmany(self, size):
+        self.fetches.append(size)
+        return self.curs.fetchmany(size)
+
+
+class TestRowObjects(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.addCleanup(self.conn.close)
+        self.conn.execute("CREATE TABLE visits (id INTEGER, ward TEXT, cost REAL)")
+        self.rows = [(i, 'ward%d' % (i % 3), i * 1.5) for i in range(25)]
+        self.conn.executemany("INSERT INTO visits VALUES (?, ?, ?)", self.rows)
+        self.query = "SELECT id, ward, cost FROM visits ORDER BY id"
+
+    def test_ntuples_reuse_cached_class(self):
+        first = list(execute_obj(self.conn, self.query))
+        second = list(execute_obj(self.conn, self.query))
+        self.assertEqual(first, self.rows)
+        self.assertIs(type(first[0]), type(second[0]))
+        self.assertEqual((first[3].id, first[3].ward), (3, 'ward0'))
+
+    def test_column_names_are_munged(self):
+        row, = execute_obj(self.conn, 'SELECT 1 AS "a$b", 2 AS class, 3 AS "1x", 4 AS a_b')
+        self.assertEqual(row._fields, ('a_b', 'class_', 'f1x', 'a_b_'))
+
+    def test_rows_are_fetched_in_batches(self):
+        curs = CountingCursor(self.conn.cursor())
+        curs.execute(self.query)
+        self.assertEqual(len(list(fetch_rows(curs, 'tuple', arraysize=10))), 25)
+        self.assertEqual(curs.fetches, [10, 10, 10, 10])
+
+    def test_row_types(self):
+        self.assertEqual(list(execute_obj(self.conn, self.query, rowtype='tuple')), self.rows)
+        dicts = list(execute_obj(self.conn, self.query, rowtype='dict'))
+        self.assertEqual(dicts[1], {'id': 1, 'ward': 'ward1', 'cost': 1.5})
+
+        records = list(execute_obj(self.conn, self.query, rowtype='slots'))
+        self.assertEqual([tuple(r) for r in records], self.rows)
+        self.assertEqual(records[2].cost, 3.0)
+        self.assertFalse(hasattr(records[2], '__dict__'))
+        self.assertEqual(records[2]._asdict(), {'id': 2, 'ward': 'ward2', 'cost': 3.0})
+
+        self.assertRaises(ValueError, execute_obj, self.conn, self.query, rowtype='xml')
+
+    def test_columnar_batches(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("requires numpy")
+        batches = list(execute_obj(self.conn, self.query, rowtype='numpy', arraysize=20))
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(batches[0]['id'].dtype, numpy.int64)
+        self.assertEqual(list(batches[1]['id']), list(range(20, 25)))
+
+    def test_arrow_batches(self):
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest("requires pyarrow")
+        batch, = execute_obj(self.conn, self.query, rowtype='arrow')
+        self.assertEqual(batch.num_rows, 25)
+        self.assertEqual(batch.schema.names, ['id', 'ward', 'cost'])
+
+
+class ListCursor(object):
+    """Cursor over canned rows, with the given description type codes."""
+    def __init__(self, columns, rows, rowcount=-1):
+        self.description = [(name, code, None, None, None, None, None)
+                            for name, code in columns]
+        self.rows = list(rows)
+        self.rowcount = rowcount
+        self.arraysize = 1
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+
+@unittest.skipIf(numpy is None, "requires numpy and pandas")
+class TestFetchColumns(unittest.TestCase):
+
+    def test_sqlite_columns_are_typed(self):
+        conn = sqlite3.connect(':memory:')
+        self.addCleanup(conn.close)
+        conn.execute("CREATE TABLE visits (id INTEGER, ward TEXT, cost REAL, stay INTEGER)")
+        conn.executemany("INSERT INTO visits VALUES (?, ?, ?, ?)",
+                         [(i, 'w%d' % i, i * 0.5, None if i == 7 else i) for i in range(10)])
+        curs = conn.execute("SELECT id, ward, cost, stay FROM visits ORDER BY id")
+        df = fetch_columns(curs, arraysize=4)
+        self.assertEqual(list(df.columns), ['id', 'ward', 'cost', 'stay'])
+        self.assertEqual([str(t) for t in df.dtypes], ['int64', 'object', 'float64', 'float64'])
+        self.assertEqual(list(df['id']), list(range(10)))
+        self.assertTrue(numpy.isnan(df['stay'][7]))
+        self.assertEqual(df['stay'][8], 8.0)
+
+    def test_description_type_codes_and_overrides(self):
+        stamp = datetime.datetime(2024, 5, 1, 12, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+        curs = ListCursor([('n', 'INTEGER'), ('flag', 'BOOLEAN'), ('day', 'DATE'),
+                           ('at', 'TIMESTAMP'), ('code', None)],
+                          [(1, True, datetime.date(2024, 5, 1), stamp, '7'),
+                           (2, None, None, None, '8')])
+        arrays = fetch_columns(curs, frame=False, dtypes={'code': 'int32'})
+        self.assertEqual(arrays['n'].dtype, numpy.int64)
+        self.assertEqual(list(arrays['flag']), [True, None])
+        self.assertEqual(arrays['day'].dtype, numpy.dtype('datetime64[D]'))
+        self.assertTrue(numpy.isnat(arrays['day'][1]))
+        self.assertEqual(arrays['at'][0], numpy.datetime64('2024-05-01T10:00'))
+        self.assertEqual(list(arrays['code']), [7, 8])
+
+        curs.rows = [(1, True, None, stamp, '7')]
+        df = fetch_columns(curs)
+        self.assertEqual(str(df['at'].dt.tz), 'UTC')
+        self.assertEqual(df['at'][0].hour, 10)
+
+    def test_arrays_grow_and_are_trimmed(self):
+        curs = ListCursor([('n', None)], [(i,) for i in range(2500)], rowcount=10)
+        arrays = fetch_columns(curs, frame=False, arraysize=1000)
+        self.assertEqual(len(arrays['n']), 2500)
+        self.assertEqual(int(arrays['n'].sum()), sum(range(2500)))
+
+    def test_large_ints_become_objects(self):
+        curs = ListCursor([('n', None)], [(1,), (2 ** 70,)])
+        arrays = fetch_columns(curs, frame=False, arraysize=1)
+        self.assertEqual(list(arrays['n']), [1, 2 ** 70])
+
+    def test_nullable_ints_keep_their_precision(self):
+        curs = ListCursor([('n', None)], [(1,), (None,), (2 ** 70 + 1,)])
+        arrays = fetch_columns(curs, frame=False, arraysize=1)
+        self.assertEqual(arrays['n'].dtype, object)
+        self.assertEqual(list(arrays['n']), [1, None, 2 ** 70 + 1])
+
+        curs = ListCursor([('n', None)], [(2 ** 53 + 1,), (None,)])
+        arrays = fetch_columns(curs, frame=False)
+        self.assertEqual(list(arrays['n']), [2 ** 53 + 1, None])
+
+        # Already promoted to float64, a later batch still must not round.
+        curs = ListCursor([('n', None)], [(1,), (None,), (2 ** 53 + 1,)])
+        arrays = fetch_columns(curs, frame=False, arraysize=2)
+        self.assertEqual(arrays['n'].dtype, object)
+        self.assertEqual(list(arrays['n']), [1, None, 2 ** 53 + 1])
+
+        curs = ListCursor([('n', None)], [(2 ** 53,), (None,)])
+        arrays = fetch_columns(curs, frame=False)
+        self.assertEqual(arrays['n'].dtype, numpy.float64)
+
+    def test_mixed_ints_and_floats_are_not_truncated(self):
+        rows = [(1, True), (1.5, 0.5), (2.7, False)]
+        for arraysize in (3, 1):
+            curs = ListCursor([('n', None), ('flag', 'BOOLEAN')], rows)
+            arrays = fetch_columns(curs, frame=False, arraysize=arraysize)
+            self.assertEqual(arrays['n'].dtype, numpy.float64)
+            self.assertEqual(list(arrays['n']), [1.0, 1.5, 2.7])
+            self.assertEqual(list(arrays['flag']), [True, 0.5, False])
+
+        curs = ListCursor([('n', None)], [(2 ** 53 + 1,), (0.5,)])
+        arrays = fetch_columns(curs, frame=False, arraysize=1)
+        self.assertEqual(list(arrays['n']), [2 ** 53 + 1, 0.5])
+
+    def test_empty_result(self):
+        df = fetch_columns(ListCursor([('a', 'INTEGER'), ('b', None)], []))
+        self.assertEqual(len(df), 0)
+        self.assertEqual(list(df.columns), ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
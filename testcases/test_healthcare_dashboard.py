@@ -2,16 +2,34 @@ import unittest
 from unittest.mock import patch, MagicMock, call
 import pandas as pd
 import os
+import subprocess
 import sys
+import threading
+import time
 import warnings
 from google.cloud import bigquery
 
 # Add the project root to the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# Scripts import their sibling modules directly, as under `streamlit run`
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'Scripts')))
 from Scripts.streamlit_app import (
     run_bigquery_query,
     column_exists,
-    get_all_columns
+    get_all_columns,
+    find_changed_rows,
+    build_merge_query,
+    apply_batched_update,
+    aggregate_for_chart,
+    get_view_refresher,
+    render_chart
+)
+from cms_rollups import build_rollups, rollup_definitions, route_rollup
+from materialized_views import (
+    ViewRefresher,
+    refresh_materialized_views,
+    rewrite_group_by_query,
+    rewrite_top_n_query
 )
 
 class TestHealthcareAnalytics(unittest.TestCase):
@@ -28,18 +46,15 @@ class TestHealthcareAnalytics(unittest.TestCase):
         
         cls.empty_data = pd.DataFrame()
 
-    @patch('Scripts.streamlit_app.client.query')
-    @patch('Scripts.streamlit_app.bigquery.Client')
-    def test_run_bigquery_query_success(self, mock_client, mock_query):
+    @patch('Scripts.streamlit_app.get_cached_client')
+    def test_run_bigquery_query_success(self, mock_get_client):
         """Test successful query execution."""
         # Setup mock
         mock_query_job = MagicMock()
         mock_query_job.to_dataframe.return_value = self.sample_data
+        mock_query = mock_get_client.return_value.query
         mock_query.return_value = mock_query_job
         
-        # Need to mock the client instance used in the module
-        mock_client.return_value = MagicMock()
-        
         # Execute
         result = run_bigquery_query("SELECT * FROM `dataset.table`")
         
@@ -50,13 +65,13 @@ class TestHealthcareAnalytics(unittest.TestCase):
         self.assertListEqual(list(result.columns), 
                            ['PROVIDER', 'APPOINTMENTS', 'PATIENT_ID', 'REVENUE'])
 
-    @patch('Scripts.streamlit_app.client.query')
+    @patch('Scripts.streamlit_app.get_cached_client')
     @patch('Scripts.streamlit_app.logger.error')
-    def test_run_bigquery_query_failure(self, mock_logger, mock_query):
+    def test_run_bigquery_query_failure(self, mock_logger, mock_get_client):
         """Test query execution failure."""
         # Setup mock
         test_error = Exception("400 Table must be qualified with a dataset")
-        mock_query.side_effect = test_error
+        mock_get_client.return_value.query.side_effect = test_error
         
         # Execute
         result = run_bigquery_query("SELECT * FROM non_existent_table")
@@ -120,6 +135,206 @@ class TestHealthcareAnalytics(unittest.TestCase):
         self.assertEqual(filtered_query, 
                        "SELECT * FROM healthcare_analytics.provider_productivity WHERE 1=1 AND `PROVIDER` IN ('Dr. Smith')")
 
+    def test_find_changed_rows(self):
+        """Test only edited cells are collected, keyed by primary key."""
+        original = pd.DataFrame({'id': [1, 2, 3], 'name': ['a', 'b', None], 'score': [1.0, 2.0, 3.0]})
+        edited = original.copy()
+        edited.loc[1, 'score'] = 5.0
+        edited.loc[2, 'name'] = 'c'
+
+        changes = find_changed_rows(original, edited, 'id')
+
+        self.assertEqual(changes, {2: {'score': (2.0, 5.0)}, 3: {'name': (None, 'c')}})
+
+    def test_build_merge_query(self):
+        """Test the MERGE applies flagged columns and guards concurrent edits."""
+        query = build_merge_query('cms_data', '_staging_cms', 'id', ['name', 'score'])
+        self.assertIn("MERGE `healthcare_analytics.cms_data` T", query)
+        self.assertIn("USING `healthcare_analytics._staging_cms` S", query)
+        self.assertIn("`score` = IF(S._chg_1, S._new_1, T.`score`)", query)
+        self.assertIn("(NOT S._chg_0 OR T.`name` IS NOT DISTINCT FROM S._old_0)", query)
+
+        versioned = build_merge_query('cms_data', '_staging_cms', 'id', ['name'], use_row_version=True)
+        self.assertIn("T.`row_version` = S._row_version", versioned)
+        self.assertIn("`row_version` = T.`row_version` + 1", versioned)
+
+    @patch('Scripts.streamlit_app.st.error')
+    @patch('Scripts.streamlit_app.get_cached_client')
+    @patch('Scripts.streamlit_app.get_column_data_type')
+    def test_apply_batched_update_unknown_types(self, mock_get_type, mock_get_client, mock_st_error):
+        """Test edits are not staged when a column type cannot be looked up."""
+        mock_get_type.side_effect = lambda table, col: None if col == 'id' else 'STRING'
+
+        result = apply_batched_update('cms_data', 'id', {1: {'name': ('a', 'b')}})
+
+        self.assertIsNone(result)
+        self.assertIn('id', mock_st_error.call_args[0][0])
+        mock_get_client.return_value.load_table_from_dataframe.assert_not_called()
+        mock_get_client.return_value.query.assert_not_called()
+
+    def test_build_rollups(self):
+        """Test rollups sum counts and average the readmission ratio like the loaded rows."""
+        cms = pd.DataFrame({
+            'Facility Name': ['A', 'A', 'B'],
+            'Facility ID': [1, 1, 2],
+            'State': ['AL', 'AL', 'AL'],
+            'Measure Name': ['AMI', 'HF', 'AMI'],
+            'Number of Discharges': [100.0, 50.0, 300.0],
+            'Number of Readmissions': ['10', 'Too Few to Report', '30'],
+            'Excess Readmission Ratio': [1.0, 0.0, 1.2]
+        })
+
+        ami = build_rollups(cms)['cms_rollup_measure'].set_index('Measure Name').loc['AMI']
+
+        self.assertEqual(ami['Number of Discharges'], 400.0)
+        self.assertEqual(ami['Number of Readmissions'], 40.0)
+        self.assertEqual(ami['Record Count'], 2)
+        self.assertAlmostEqual(ami['ERR Sum'], 2.2)
+        self.assertAlmostEqual(ami['Excess Readmission Ratio'], cms.groupby('Measure Name')['Excess Readmission Ratio'].mean()['AMI'])
+        hf = build_rollups(cms)['cms_rollup_measure'].set_index('Measure Name').loc['HF']
+        self.assertEqual(hf['Excess Readmission Ratio'], 0.0)
+
+    def test_rollup_definitions(self):
+        """Test the rollups can be rebuilt from cms_data with the same columns."""
+        statements = rollup_definitions('ds')
+        self.assertEqual(len(statements), 3)
+        measure = statements[0]
+        self.assertTrue(measure.startswith("CREATE OR REPLACE TABLE `ds.cms_rollup_measure` AS SELECT `Measure Name`, "))
+        self.assertIn("FROM `ds.cms_data` GROUP BY `Measure Name`", measure)
+        for column in ('Number of Discharges', 'Number of Readmissions', 'ERR Sum', 'Record Count',
+                       'Excess Readmission Ratio'):
+            self.assertIn(f"AS `{column}`", measure)
+
+    def test_route_rollup_picks_smallest(self):
+        """Test routing picks the smallest rollup covering grouped and filtered columns."""
+        self.assertEqual(route_rollup(['Measure Name']), 'cms_rollup_measure')
+        self.assertEqual(route_rollup(['State']), 'cms_rollup_state_measure')
+        self.assertEqual(route_rollup(['State'], ['Facility Name']), 'cms_rollup_facility')
+        self.assertIsNone(route_rollup(['State'], ['Start Date']))
+
+    @patch('Scripts.streamlit_app.run_bigquery_query')
+    def test_aggregate_for_chart_uses_rollup(self, mock_run_query):
+        """Test CMS chart aggregates are read from a rollup instead of the loaded rows."""
+        rollup_df = pd.DataFrame({'State': ['AL'], 'Number of Discharges': [400.0]})
+        mock_run_query.return_value = rollup_df
+        cms = pd.DataFrame({'State': ['AL'], 'Number of Discharges': [1.0]})
+
+        result = aggregate_for_chart(cms, 'cms_data', 'State', 'Number of Discharges', 'sum')
+
+        self.assertIs(result, rollup_df)
+        self.assertIn('cms_rollup_state_measure', mock_run_query.call_args[0][0])
+
+        # Searches filter on every string column, so fall back to the loaded rows
+        result = aggregate_for_chart(cms, 'cms_data', 'State', 'Number of Discharges', 'sum', search_term='x')
+        self.assertEqual(result['Number of Discharges'].tolist(), [1.0])
+        mock_run_query.assert_called_once()
+
+    def test_rewrite_top_n_query(self):
+        """Test unfiltered bar chart requests are rewritten to the top-N view."""
+        query = rewrite_top_n_query('ds', 'cms_data', 'State', 'Number of Discharges')
+        self.assertEqual(query, "SELECT `State`, `Number of Discharges` FROM "
+                                "`ds.mv_cms_data_top_number_of_discharges` "
+                                "ORDER BY `Number of Discharges` DESC LIMIT 10")
+
+        self.assertIsNone(rewrite_top_n_query('ds', 'cms_data', 'State', 'Number of Discharges',
+                                              ["`State` IN ('AL')"]))
+        self.assertIsNone(rewrite_top_n_query('ds', 'cms_data', 'State', 'Footnote'))
+
+    def test_rewrite_group_by_query(self):
+        """Test grouped aggregates are rewritten only when the view can apply the filters."""
+        query = rewrite_group_by_query('ds', 'cms_data', 'Start Date', 'Predicted Readmission Rate', 'mean',
+                                       ['Start Date'], ["`Start Date` IN ('07/01/2020')"])
+        self.assertIn("FROM `ds.mv_cms_data_by_start_date`", query)
+        self.assertIn("SAFE_DIVIDE(`Predicted Readmission Rate Sum`, `Predicted Readmission Rate Count`)", query)
+
+        self.assertIsNone(rewrite_group_by_query('ds', 'cms_data', 'Start Date', 'Predicted Readmission Rate',
+                                                 'sum', ['Facility Name']))
+
+    def test_refresh_materialized_views(self):
+        """Test the refresh hook rebuilds a table's views in one job."""
+        mock_client = MagicMock()
+
+        refreshed = refresh_materialized_views(mock_client, 'ds', ['provider_productivity'])
+
+        self.assertEqual(refreshed, 1)
+        mock_client.query.assert_called_once()
+        self.assertIn("CREATE OR REPLACE TABLE `ds.mv_provider_productivity_top_encounter_count`",
+                      mock_client.query.call_args[0][0])
+
+    def test_view_refresher_debounces_in_background(self):
+        """Test writes are refreshed once, off the request, and leave their tables stale until then."""
+        refreshed = []
+        done = threading.Event()
+
+        def refresh(table_names):
+            refreshed.append(table_names)
+            done.set()
+
+        refresher = ViewRefresher(refresh, delay=0.05)
+        refresher.schedule('cms_data')
+        refresher.schedule('cms_data')
+        refresher.schedule('provider_productivity')
+        self.assertTrue(refresher.is_stale('cms_data'))
+        self.assertEqual(refreshed, [])
+
+        self.assertTrue(done.wait(5))
+        self.assertEqual(refreshed, [{'cms_data', 'provider_productivity'}])
+        for _ in range(100):
+            if not refresher.is_stale('cms_data'):
+                break
+            time.sleep(0.01)
+        self.assertFalse(refresher.is_stale('cms_data'))
+
+    def test_view_refresher_keeps_tables_stale_on_failure(self):
+        """Test a failed refresh keeps routing queries to the base table."""
+        done = threading.Event()
+
+        def refresh(table_names):
+            done.set()
+            raise RuntimeError("quota exceeded")
+
+        refresher = ViewRefresher(refresh, delay=0)
+        refresher.schedule('cms_data')
+        self.assertTrue(done.wait(5))
+        time.sleep(0.05)
+        self.assertTrue(refresher.is_stale('cms_data'))
+
+    @patch('Scripts.streamlit_app.run_bigquery_query')
+    def test_aggregate_for_chart_skips_stale_views(self, mock_run_query):
+        """Test charts aggregate the loaded rows while a refresh of their views is pending."""
+        cms = pd.DataFrame({'State': ['AL', 'AL'], 'Number of Discharges': [1.0, 2.0]})
+        with patch.object(get_view_refresher(), 'is_stale', return_value=True):
+            result = aggregate_for_chart(cms, 'cms_data', 'State', 'Number of Discharges', 'sum')
+        self.assertEqual(result['Number of Discharges'].tolist(), [3.0])
+        mock_run_query.assert_not_called()
+
+    @patch('Scripts.streamlit_app.st.plotly_chart')
+    def test_render_chart_caches_figure_spec(self, mock_plotly_chart):
+        """Test a chart is only built once per chart type, columns and filters."""
+        figure = MagicMock()
+        figure.to_dict.return_value = {'data': [], 'layout': {}}
+        build_figure = MagicMock(return_value=figure)
+
+        render_chart('Bar Chart', ('PROVIDER', 'encounter_count'), build_figure)
+        render_chart('Bar Chart', ('PROVIDER', 'encounter_count'), build_figure)
+
+        build_figure.assert_called_once()
+        self.assertEqual(mock_plotly_chart.call_count, 2)
+        mock_plotly_chart.assert_called_with({'data': [], 'layout': {}}, use_container_width=True)
+
+    def test_import_defers_heavy_modules(self):
+        """Test importing the dashboard loads no plotting or BigQuery libraries."""
+        project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        code = (
+            "import sys; sys.path.insert(0, 'Scripts'); import Scripts.streamlit_app; "
+            "print(sorted(m for m in ('google.cloud.bigquery', 'plotly.express', 'matplotlib', 'seaborn') "
+            "if m in sys.modules))"
+        )
+        result = subprocess.run([sys.executable, '-c', code], cwd=project_root,
+                                capture_output=True, text=True, timeout=120)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip().splitlines()[-1], '[]')
+
 if __name__ == '__main__':
     # Suppress warnings during tests
     warnings.filterwarnings("ignore", message="BigQuery Storage module not found")